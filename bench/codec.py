@@ -0,0 +1,74 @@
+"""Benchmark for codecs.
+
+This benchmark measures the time needed to encode and decode the
+statistics of many clients with each available codec. It also
+compares the work done by the web service to forward those
+statistics: decoding the answer of the helper and encoding it again
+or passing it through without decoding it. Run it with::
+
+    $ python -m bench.codec [clients...]
+"""
+
+import sys
+import time
+import json
+
+from kitero import codec
+
+def stats(count):
+    """Build statistics for `count` clients spread over 4 interfaces."""
+    result = {}
+    for i in range(count):
+        interface = result.setdefault("eth%d" % (i % 4 + 1),
+                                      dict(clients=0, up=0, down=0, details={}))
+        interface['clients'] += 1
+        interface['details']["10.%d.%d.%d" % ((i >> 16) & 0xff,
+                                              (i >> 8) & 0xff,
+                                              i & 0xff)] = dict(up=i*1789,
+                                                                down=i*17801)
+    return result
+
+def timeit(fn, *args):
+    """Return the best time out of 5 runs."""
+    best = None
+    for i in range(5):
+        start = time.time()
+        fn(*args)
+        elapsed = time.time() - start
+        best = best is None and elapsed or min(best, elapsed)
+    return best
+
+def bench(count):
+    value = stats(count)
+    print "%d clients:" % count
+    for name in sorted(codec.codecs):
+        c = codec.codecs[name]
+        encoded = c.dumps(value)
+        print "  %-10s encode %7.2fms, decode %7.2fms, size %5.2f MiB" % (
+            name,
+            timeit(c.dumps, value)*1000,
+            timeit(c.loads, encoded)*1000,
+            len(encoded)/1024./1024)
+    # Web service forwarding an answer from the helper
+    c = codec.get("json")
+    answer = '{"id":4,"status":0,"value":%s}' % c.dumps(value)
+    def legacy():
+        value = json.loads(answer)['value']
+        return json.dumps(dict(status=0, time=time.time(), value=value), indent=2)
+    def decode():
+        value = c.loads(answer)['value']
+        return c.dumps(dict(status=0, time=time.time(), value=value))
+    def passthrough():
+        prefix = '{"id":4,"status":0,"value":'
+        assert answer.startswith(prefix)
+        value = answer[len(prefix):answer.rindex("}")]
+        return '{"status":0,"time":%s,"value":%s}' % (
+            c.dumps(time.time()), value)
+    for name, fn in (("legacy", legacy),
+                     ("decode", decode),
+                     ("raw", passthrough)):
+        print "  forward %-10s %7.2fms" % (name, timeit(fn)*1000)
+
+if __name__ == "__main__":
+    for count in [int(x) for x in sys.argv[1:]] or [20000]:
+        bench(count)
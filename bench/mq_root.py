@@ -0,0 +1,86 @@
+"""Benchmark for the spreading of clients over transmit queues.
+
+This benchmark measures the throughput and the CPU needed to forward
+one Gbit of traffic when many clients are bound, with a single tree
+of DRR classes and with one tree for each transmit queue under a `mq`
+root, like :class:`LinuxBinder` does with the `queues` directive. The
+namespaces of :mod:`bench.qdisc_tree` are used, with multiqueue veth
+interfaces. Many clients should send traffic at once to contend for
+the lock of the root queueing discipline. It needs root and removes
+the namespaces once done. Run it with::
+
+    $ sudo python -m bench.mq_root [clients] [active] [seconds] [queues]
+"""
+
+import sys
+import os
+
+from kitero.helper.qdisc import plan
+from bench.qdisc_tree import QOS, address, setup, cleanup, batch, netns, traffic
+
+def shape(queues, clients):
+    """Build the classes of clients on the outgoing interface of the router.
+
+    With one queue, there is a single tree with root `1:`. Otherwise,
+    each queue gets its own tree and clients are assigned to them by
+    their ticket.
+    """
+    p = plan(QOS)
+    tc = []
+    roots = ["1"]
+    if queues > 1:
+        roots = ["b%x" % (queue + 1) for queue in range(queues)]
+        tc.append("qdisc add dev r1 root handle 1: mq")
+        tc.append("qdisc add dev r1 clsact")
+        for queue, root in enumerate(roots):
+            tc.append("qdisc add dev r1 parent 1:%x handle %s: drr" % (queue + 1, root))
+            tc.append("filter add dev r1 egress prio 1 basic"
+                      " match \"meta(priority mask 0xffff0000 eq 0x%s0000)\""
+                      " action skbedit queue_mapping %d" % (root, queue))
+    else:
+        tc.append("qdisc add dev r1 root handle 1: drr")
+    for queue, root in enumerate(roots):
+        # Default class for unclassified traffic, including ARP
+        tc.append("class add dev r1 parent %s: classid %s:2 drr" % (root, root))
+        tc.append("qdisc add dev r1 parent %s:2 handle d%x: sfq" % (root, queue + 1))
+        tc.append("filter add dev r1 parent %s: prio 1 matchall flowid %s:2" % (root, root))
+    rules = ["*mangle"]
+    for i in range(clients):
+        ticket = i + 1
+        root = roots[ticket % len(roots)]
+        tc.append("class add dev r1 parent %s: classid %s:%d0 %s" % (
+                root, root, ticket, p.classes.up.spec))
+        for qdisc in p.up:
+            parent = qdisc.parent % dict(ticket=ticket)
+            if parent.startswith("1:"):
+                parent = root + parent[1:]
+            tc.append("qdisc add dev r1 parent %s handle %s %s" % (
+                    parent, qdisc.handle % dict(ticket=ticket), qdisc.spec))
+        rules.append("-A POSTROUTING -o r1 -s %s -j CLASSIFY --set-class %s:%d0" % (
+                address(i), root, ticket))
+    rules.append("COMMIT")
+    netns("kitero-r", "tc", "qdisc", "del", "dev", "r1", "root",
+          stderr=open(os.devnull, "w")).wait()
+    netns("kitero-r", "tc", "qdisc", "del", "dev", "r1", "clsact",
+          stderr=open(os.devnull, "w")).wait()
+    netns("kitero-r", "iptables", "-t", "mangle", "-F", "POSTROUTING").wait()
+    batch("kitero-r", "tc", tc)
+    batch("kitero-r", "iptables-restore", rules)
+
+def bench(queues, clients, active, seconds):
+    shape(queues, clients)
+    bits, cpu = traffic(clients, active, seconds)
+    print "%3d queues: %7d clients, %3d active: %6.2f Gbit/s, %6.2f CPU seconds per Gbit" % (
+        queues, clients, active, bits / 1e9 / seconds, cpu / (bits / 1e9))
+
+if __name__ == "__main__":
+    args = [int(x) for x in sys.argv[1:]]
+    defaults = [1000, 64, 10, os.sysconf("SC_NPROCESSORS_ONLN")]
+    clients, active, seconds, queues = (args + defaults[len(args):])[:4]
+    cleanup()
+    try:
+        setup(clients, queues)
+        for count in [1, queues]:
+            bench(count, clients, active, seconds)
+    finally:
+        cleanup()
@@ -0,0 +1,56 @@
+"""Benchmark for persistency of bindings.
+
+This benchmark measures the time needed to save and load the
+bindings of many clients with :class:`PersistentBinder`. Run it with::
+
+    $ python -m bench.persistency [clients...]
+"""
+
+import sys
+import os
+import time
+import tempfile
+import shutil
+
+from kitero.helper.binder import PersistentBinder
+
+class FakeRouter(object):
+    """Router only able to provide hints."""
+    def hints(self, client):
+        index = int(client.split(".")[-1]) + (int(client.split(".")[-2]) << 8)
+        return dict(slot=index % 256, ticket=index + 1)
+
+def clients(count):
+    """Generate `count` client IP addresses."""
+    for i in range(count):
+        yield "10.%d.%d.%d" % ((i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff)
+
+def bench(count):
+    temp = tempfile.mkdtemp()
+    try:
+        router = FakeRouter()
+        binder = PersistentBinder(os.path.join(temp, "save"))
+        binder.bindings = dict((client, ("eth1", "qos1", router.hints(client)))
+                               for client in clients(count))
+        start = time.time()
+        binder.compact()
+        save = time.time() - start
+        start = time.time()
+        for i in range(1000):
+            binder.notify("unbind", router, client="10.0.0.%d" % (i % 256))
+            binder.notify("bind", router, client="10.0.0.%d" % (i % 256),
+                          interface="eth1", qos="qos2")
+        event = (time.time() - start) / 2000
+        size = os.path.getsize(binder.save)
+        start = time.time()
+        loaded = binder.load()
+        load = time.time() - start
+        assert len(loaded) == count
+        print "%7d clients: save %6.3fs, load %6.3fs, event %5.1fus, size %5.1f MiB" % (
+            count, save, load, event*1000000, size/1024./1024)
+    finally:
+        shutil.rmtree(temp)
+
+if __name__ == "__main__":
+    for count in [int(x) for x in sys.argv[1:]] or [10000, 50000, 100000]:
+        bench(count)
@@ -0,0 +1,155 @@
+"""Benchmark for trees of classes.
+
+This benchmark measures the CPU needed to forward one Gbit of traffic
+with each tree of classes (see :data:`kitero.helper.qdisc.TREES`) when
+many clients are bound. Three network namespaces are created: clients,
+router and server. Each client gets its own address, class and
+queueing disciplines on the router, like with :class:`LinuxBinder`,
+but only some of them send traffic, with ``iperf3``. With CAKE, all
+clients share one tier. It needs root
+and removes the namespaces once done. Run it with::
+
+    $ sudo python -m bench.qdisc_tree [clients] [active] [seconds]
+"""
+
+import sys
+import os
+import json
+import time
+import tempfile
+import subprocess
+
+from kitero.helper.qdisc import plan, link, TREES
+
+NETNS = ["kitero-c", "kitero-r", "kitero-s"]
+QOS = {'bandwidth': "100mbit buffer 100kbit latency 50ms"}
+
+def sh(*args):
+    subprocess.check_call(args)
+
+def netns(ns, *args, **kwargs):
+    return subprocess.Popen(["ip", "netns", "exec", ns] + list(args), **kwargs)
+
+def address(i):
+    """Address of the `i`-th client."""
+    return "10.0.%d.%d" % ((i + 1) >> 8, (i + 1) & 0xff)
+
+def setup(clients, queues=1):
+    for ns in NETNS:
+        sh("ip", "netns", "add", ns)
+    for a, nsa, b, nsb in [("c0", "kitero-c", "r0", "kitero-r"),
+                           ("r1", "kitero-r", "s0", "kitero-s")]:
+        sh("ip", "link", "add", a, "netns", nsa,
+           "numtxqueues", str(queues), "numrxqueues", str(queues),
+           "type", "veth", "peer", "name", b, "netns", nsb,
+           "numtxqueues", str(queues), "numrxqueues", str(queues))
+    commands = [("kitero-c", "ip addr add 10.0.255.253/16 dev c0"),
+                ("kitero-c", "ip link set up dev c0"),
+                ("kitero-c", "ip route add default via 10.0.255.254"),
+                ("kitero-r", "ip addr add 10.0.255.254/16 dev r0"),
+                ("kitero-r", "ip addr add 172.31.0.1/30 dev r1"),
+                ("kitero-r", "ip link set up dev r0"),
+                ("kitero-r", "ip link set up dev r1"),
+                ("kitero-r", "sysctl -q -w net.ipv4.ip_forward=1"),
+                ("kitero-s", "ip addr add 172.31.0.2/30 dev s0"),
+                ("kitero-s", "ip link set up dev s0"),
+                ("kitero-s", "ip route add 10.0.0.0/16 via 172.31.0.1")]
+    for ns, command in commands:
+        netns(ns, *command.split()).wait()
+    batch("kitero-c", "ip", ["addr add %s/16 dev c0" % address(i)
+                             for i in range(clients)])
+
+def cleanup():
+    for ns in NETNS:
+        subprocess.call(["ip", "netns", "del", ns])
+
+def batch(ns, command, lines):
+    """Run a batch of commands in a namespace."""
+    fd, path = tempfile.mkstemp(prefix="kitero-")
+    try:
+        os.write(fd, "".join(["%s\n" % line for line in lines]))
+        os.close(fd)
+        if command == "iptables-restore":
+            if netns(ns, command, "--noflush", path).wait():
+                raise RuntimeError("unable to run %s" % command)
+        elif netns(ns, command, "-batch", path).wait():
+            raise RuntimeError("unable to run %s" % command)
+    finally:
+        os.unlink(path)
+
+def shape(kind, clients):
+    """Build the tree of classes on the outgoing interface of the router."""
+    tree = TREES[kind]
+    rates = link(None)
+    p = plan(not tree.tiers and QOS or {}, tree, rates) # Tiers use the link rate
+    parent = tree.parent()
+    tc = ["qdisc add dev r1 root handle 1: %s" % tree.kind]
+    if tree.shaping:
+        tc.append("class add dev r1 parent 1: classid %s %s" % (
+                parent, tree.leaf(rates['up'], rates['up']).spec))
+    rules = ["*mangle"]
+    for i in range(clients):
+        ticket = tree.tiers and "c1" or str(i + 1)
+        if not tree.tiers or i == 0:
+            tc.append("class add dev r1 parent %s classid 1:%s0 %s" % (
+                    parent, ticket, p.classes.up.spec))
+            for qdisc in p.up:
+                tc.append("qdisc add dev r1 parent %s handle %s %s" % (
+                        qdisc.parent % dict(ticket=ticket),
+                        qdisc.handle % dict(ticket=ticket),
+                        qdisc.spec))
+        rules.append("-A POSTROUTING -o r1 -s %s -j CLASSIFY --set-class 1:%s0" % (
+                address(i), ticket))
+    rules.append("COMMIT")
+    netns("kitero-r", "tc", "qdisc", "del", "dev", "r1", "root",
+          stderr=open(os.devnull, "w")).wait()
+    netns("kitero-r", "iptables", "-t", "mangle", "-F", "POSTROUTING").wait()
+    batch("kitero-r", "tc", tc)
+    batch("kitero-r", "iptables-restore", rules)
+
+def busy():
+    """CPU time used by the whole system, in seconds."""
+    fields = [int(x) for x in open("/proc/stat").readline().split()[1:]]
+    # user, nice, system, idle, iowait, irq, softirq, steal
+    used = sum(fields[:3]) + sum(fields[5:8])
+    return used / float(os.sysconf("SC_CLK_TCK"))
+
+def traffic(clients, active, seconds):
+    """Send traffic from `active` clients.
+
+    :return: bits received by the server and CPU seconds used
+    """
+    servers = [netns("kitero-s", "iperf3", "-s", "-1", "-p", str(5201 + i),
+                     stdout=open(os.devnull, "w"))
+               for i in range(active)]
+    time.sleep(0.5)
+    start = busy()
+    senders = [netns("kitero-c", "iperf3", "-J", "-c", "172.31.0.2",
+                     "-p", str(5201 + i), "-B", address(i * clients // active),
+                     "-t", str(seconds), stdout=subprocess.PIPE)
+               for i in range(active)]
+    bits = 0
+    for sender in senders:
+        result = json.loads(sender.communicate()[0])
+        bits = bits + result['end']['sum_received']['bytes'] * 8
+    cpu = busy() - start
+    for server in servers:
+        server.wait()
+    return bits, cpu
+
+def bench(kind, clients, active, seconds):
+    shape(kind, clients)
+    bits, cpu = traffic(clients, active, seconds)
+    print "%4s: %7d clients, %3d active: %6.2f Gbit/s, %6.2f CPU seconds per Gbit" % (
+        kind, clients, active, bits / 1e9 / seconds, cpu / (bits / 1e9))
+
+if __name__ == "__main__":
+    args = [int(x) for x in sys.argv[1:]]
+    clients, active, seconds = (args + [1000, 32, 10][len(args):])[:3]
+    cleanup()
+    try:
+        setup(clients)
+        for kind in ["drr", "htb", "hfsc", "cake"]:
+            bench(kind, clients, active, seconds)
+    finally:
+        cleanup()
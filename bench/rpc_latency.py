@@ -0,0 +1,52 @@
+"""Benchmark for latency of helper RPC transports.
+
+This benchmark measures the round trip time of a ``ping`` call to
+:class:`RPCServer` over TCP and over a Unix socket. Calls are made one
+after the other on a single connection. Run it with::
+
+    $ python -m bench.rpc_latency [calls]
+"""
+
+import sys
+import os
+import time
+import socket
+import tempfile
+import shutil
+
+from kitero.helper.rpc import RPCServer
+
+def bench(server, sock, calls):
+    read = sock.makefile('rb')
+    request = '["ping"]\n'
+    for i in range(100):        # Warm up
+        sock.sendall(request)
+        read.readline()
+    start = time.time()
+    for i in range(calls):
+        sock.sendall(request)
+        read.readline()
+    elapsed = time.time() - start
+    sock.close()
+    server.stop()
+    return elapsed / calls
+
+if __name__ == "__main__":
+    calls = len(sys.argv) > 1 and int(sys.argv[1]) or 10000
+    temp = tempfile.mkdtemp()
+    try:
+        # TCP
+        server = RPCServer.run("127.0.0.1", 18862)
+        sock = socket.create_connection(("127.0.0.1", 18862))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        tcp = bench(server, sock, calls)
+        # Unix socket
+        path = os.path.join(temp, "kitero.sock")
+        server = RPCServer.run(path, None)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        unix = bench(server, sock, calls)
+    finally:
+        shutil.rmtree(temp)
+    print "%d calls: TCP %5.1fus, Unix %5.1fus per call (%.0f%%)" % (
+        calls, tcp*1000000, unix*1000000, 100.*unix/tcp)
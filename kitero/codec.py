@@ -0,0 +1,126 @@
+# Codecs for messages exchanged between the helper and the web service.
+
+import json
+import struct
+
+class RawJSON(str):
+    """JSON encoded value.
+
+    Such a value is already encoded and should be included as is in a
+    JSON document instead of being encoded again.
+    """
+
+class JSONCodec(object):
+    """Compact JSON codec using the standard library.
+
+    Encoded messages do not contain any newline and are therefore
+    delimited by a newline.
+    """
+    name = "json"
+    framed = False              # Are messages length-prefixed?
+    encoder = json.JSONEncoder(separators=(',', ':'))
+
+    def dumps(self, obj):
+        """Encode an object.
+
+        :param obj: object to encode
+        :return: encoded object
+        :rtype: string
+        """
+        return self.encoder.encode(obj)
+
+    def loads(self, data):
+        """Decode an object.
+
+        :param data: encoded object
+        :type data: string
+        :return: decoded object
+        """
+        return json.loads(data)
+
+    def ismap(self, data):
+        """Tell if an encoded object is a dictionary.
+
+        :param data: encoded object
+        :type data: string
+        """
+        return data.lstrip()[:1] == "{"
+
+    def frame(self, data):
+        """Delimit an encoded message.
+
+        :param data: encoded message
+        :return: message ready to be sent
+        """
+        return "%s\n" % data
+
+class FastJSONCodec(JSONCodec):
+    """JSON codec using ``ujson`` or ``simplejson``."""
+    name = "fastjson"
+
+    def __init__(self, module):
+        self.dumps = module.dumps
+        self.loads = module.loads
+
+class MsgpackCodec(object):
+    """MessagePack codec using ``msgpack``.
+
+    Encoded messages are prefixed by their length as a 32-bit integer
+    in network order.
+    """
+    name = "msgpack"
+    framed = True
+
+    def __init__(self, module):
+        self.module = module
+
+    def dumps(self, obj):
+        return self.module.packb(obj, use_bin_type=False)
+
+    def loads(self, data):
+        return self.module.unpackb(data, raw=False)
+
+    def ismap(self, data):
+        first = ord(data[:1] or "\0")
+        return 0x80 <= first <= 0x8f or first in (0xde, 0xdf)
+
+    def frame(self, data):
+        return struct.pack("!I", len(data)) + data
+
+codecs = {}                     # Available codecs
+
+def register(codec):
+    """Register a codec.
+
+    :param codec: codec to register
+    """
+    codecs[codec.name] = codec
+
+def get(name):
+    """Get a codec.
+
+    :param name: name of the codec
+    :type name: string
+    :return: the requested codec
+    :raise ValueError: the codec is not available
+    """
+    try:
+        return codecs[name]
+    except KeyError:
+        raise ValueError("codec %r is not available" % name)
+
+register(JSONCodec())
+try:
+    import ujson as fastjson
+except ImportError:             # pragma: no cover
+    try:
+        import simplejson as fastjson
+    except ImportError:
+        fastjson = None
+if fastjson is not None:
+    register(FastJSONCodec(fastjson))
+try:
+    import msgpack
+    register(MsgpackCodec(msgpack))
+except ImportError:             # pragma: no cover
+    pass
@@ -7,11 +7,22 @@ default = {
         'port': 8187,
         'debug': False,
         'expire': 15*60,        # Expire unalive clients after 15 minutes
+        'pool': 4,              # Maximum number of connections to the helper
+        'codec': 'json',        # Preferred codec to talk to the helper
+        'timeout': 30,          # Seconds to wait for an answer of the helper
+        'replica': False,       # Answer from a local replica of the helper
         },
     'helper': {
         # Helper application should listen to this IP:port
         'listen': '127.0.0.1',
         'port': 18861,
+        'workers': 4,           # Number of threads processing requests
+        'sample': 5,            # Push stats to subscribers every 5 seconds
+        'expire': 15*60,        # Unbind clients without heartbeat after 15 minutes
+        'idle': None,           # Unbind clients without traffic after this many seconds
+        'scheduler': 'drr',     # Tree of classes: drr, htb, hfsc or cake
+        'ifb': None,            # IFB device to shape downloads once
+        'queues': None,         # Number of transmit queues to spread clients over
         }
     }
 
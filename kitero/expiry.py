@@ -0,0 +1,71 @@
+# Deadlines of clients.
+
+import heapq
+import threading
+
+class Expiry(object):
+    """Deadlines of clients, kept in a min-heap.
+
+    Refreshing the deadline of a client pushes a new entry in the heap
+    and leaves the previous one in place. Outdated entries are skipped
+    when they reach the top of the heap. The heap is rebuilt when they
+    are too numerous. Refreshing a client and expiring a client are
+    therefore O(log n).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.deadlines = {}     # Current deadline of each client
+        self.heap = []          # Tuples (deadline, client)
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def __contains__(self, client):
+        return client in self.deadlines
+
+    def refresh(self, client, deadline):
+        """Set the deadline of a client.
+
+        :param client: client to refresh
+        :param deadline: time at which the client expires
+        """
+        with self.lock:
+            self.deadlines[client] = deadline
+            heapq.heappush(self.heap, (deadline, client))
+            if len(self.heap) > 2 * len(self.deadlines) + 64:
+                self.heap = [(d, c) for c, d in self.deadlines.items()]
+                heapq.heapify(self.heap)
+
+    def remove(self, client):
+        """Forget a client.
+
+        :param client: client to forget
+        """
+        with self.lock:
+            self.deadlines.pop(client, None)
+
+    def expire(self, now):
+        """Remove expired clients.
+
+        :param now: current time
+        :return: list of expired clients
+        """
+        expired = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                deadline, client = heapq.heappop(self.heap)
+                if self.deadlines.get(client) == deadline:
+                    del self.deadlines[client]
+                    expired.append(client)
+        return expired
+
+    def next(self):
+        """Return the next deadline.
+
+        :return: the time of the next deadline or `None` if there is
+            no client. The returned value may be earlier than the
+            actual next deadline.
+        """
+        with self.lock:
+            return self.heap and self.heap[0][0] or None
@@ -1,4 +1,8 @@
 import re
+import os
+import json
+import tempfile
+import urllib
 import zope.interface
 import logging
 logger = logging.getLogger("kitero.helper.binder")
@@ -6,7 +10,9 @@ import cPickle as pickle
 
 from kitero.helper.router import Router
 from kitero.helper.commands import Commands
-from kitero.helper.interface import IBinder, IStatsProvider
+from kitero.helper.qdisc import plan, link, TREES, UNLIMITED
+from kitero.helper.interface import IStatsProvider, IHintsProvider, \
+    INeighborsProvider, IBatchBinder, IRebinder
 
 class Mark(object):
     """Class to provides Netfilter marks for each interface/slot."""
@@ -68,20 +74,26 @@ class SlotsProvider(object):
         self.interfaces = {}
         self.max_slots = max_slots
 
-    def request(self, interface, client):
+    def request(self, interface, client, slot=None):
         """Request a new slot for a given client on the given interface.
 
         :param interface: interface the client will be bound too
         :type interface: string
         :param client: client IP requesting a slot for the interface
         :type client: string
-        :return: minimal slot number
+        :param slot: preferred slot, used if it is still free
+        :type slot: integer or `None`
+        :return: preferred slot or minimal slot number
         :rtype: integer
         """
         if interface not in self.interfaces:
             self.interfaces[interface] = {}
         if client in self.interfaces[interface]:
             raise ValueError("client %r has already a slot for %r" % (client, interface))
+        if slot is not None and 0 <= slot < self.max_slots and \
+                slot not in self.interfaces[interface].values():
+            self.interfaces[interface][client] = slot
+            return slot
         slots = self.interfaces[interface].values()
         slots.sort()
         i = 0
@@ -128,16 +140,22 @@ class TicketsProvider(object):
     def __init__(self):
         self.clients = {}
 
-    def request(self, client):
+    def request(self, client, ticket=None):
         """Request a new ticket for the client.
 
         :param client: IP address of the client
         :type client: string
+        :param ticket: preferred ticket, used if it is still free
+        :type ticket: integer or `None`
         :return: ticket
         :rtype: integer
         """
         if client in self.clients:
             raise ValueError("client %r has already a ticket" % client)
+        if ticket is not None and ticket > 0 and \
+                ticket not in self.clients.values():
+            self.clients[client] = ticket
+            return ticket
         values = self.clients.values()
         values.sort()
         i = 0
@@ -167,6 +185,21 @@ class TicketsProvider(object):
         del self.clients[client]
         return ticket
 
+def rooted(handle):
+    """Template of a handle in the tree of classes of a ticket.
+
+    Handles of :class:`kitero.helper.qdisc.Qdisc` are relative to the
+    root `1:`. It is replaced by the major number of the tree (see
+    :meth:`LinuxBinder.root`).
+
+    :param handle: handle or parent of a queueing discipline
+    :type handle: string
+    :rtype: string
+    """
+    if handle.startswith("1:"):
+        return "%(root)s" + handle[1:]
+    return handle
+
 class LinuxBinder(object):
     """Handle client binding on a Linux hosts.
 
@@ -195,6 +228,31 @@ class LinuxBinder(object):
     integers associated to only one client. This ticket is multiplied
     by 10 and we add 0, 1 or 2 to build the class of each QoS.
 
+    The tree of classes depends on the scheduler (see
+    :data:`kitero.helper.qdisc.TREES`). With the `cake` scheduler,
+    clients bound to the same interface and QoS share the class of
+    their tier and binding a client only changes its classification.
+
+    Downloads are shaped on each incoming interface. With an IFB
+    device (`ifb`), the traffic leaving incoming interfaces is
+    redirected to this device and downloads are shaped only once, on
+    it. Classification survives the redirection since it is done by
+    `iptables` before.
+
+    With several transmit queues (`queues`), the root queueing
+    discipline of each interface is `mq` and each queue gets its own
+    tree of classes, with its own lock. A client is assigned to a
+    queue by its ticket: its traffic is classified in the tree of
+    this queue and steered to it with a `clsact` filter matching the
+    major number of the class. Only trees without shared bandwidth
+    can be split this way.
+
+    Slots and tickets are exported as hints (see
+    :class:`IHintsProvider`). When a binding is restored with those
+    hints, the same slot and ticket are allocated again. Therefore,
+    connections established before a restart keep a valid connection
+    mark.
+
     Keep in mind that the binder should work even in case of SNAT on
     output interfaces. This makes things a bit difficult and explain
     why we rely heavily on marks: in ``POSTROUTING``, the source
@@ -206,16 +264,25 @@ class LinuxBinder(object):
     This binder handles IPv6.
     """
 
-    zope.interface.implements(IBinder, IStatsProvider)
+    zope.interface.implements(IBatchBinder, IRebinder, IStatsProvider,
+                              IHintsProvider, INeighborsProvider)
 
     iptables = [ "iptables", "ip6tables" ]
     ipcmd = [ "ip", "ip -6" ]
 
-    def __init__(self, max_users=256):
+    def __init__(self, max_users=256, scheduler="drr", ifb=None, queues=None):
         """Not really the constructor of the class.
 
         The :method:`setup` is the real constructor but needs to be
         called with a router.
+
+        :param max_users: maximum number of users per interface
+        :param scheduler: kind of tree of classes (see
+            :data:`kitero.helper.qdisc.TREES`)
+        :param ifb: name of the IFB device to shape downloads or
+            `None` to shape them on each incoming interface
+        :param queues: number of transmit queues to spread clients
+            over or `None` for a single tree of classes
         """
         self.router = None      # Router handled
         self.config = {
@@ -223,6 +290,9 @@ class LinuxBinder(object):
             "postrouting": "kitero-POSTROUTING", # postrouting chain name
             "accounting": "kitero-ACCOUNTING",   # accounting chain name
             "max_users": max_users,              # maximum number of users **per interface**
+            "scheduler": scheduler,              # tree of classes
+            "ifb": ifb,                          # IFB device for downloads
+            "queues": queues,                    # number of transmit queues
             }
 
     def isipv6(self, client):
@@ -233,14 +303,25 @@ class LinuxBinder(object):
         """Setup the binder for the first time.
 
         Cleaning is also handled here since the binder has no way to
-        clean on exit.
+        clean on exit. QoS settings are compiled first: invalid
+        settings are detected before anything is changed.
         """
+        if self.config['scheduler'] not in TREES:
+            raise ValueError("unknown scheduler %r" % self.config['scheduler'])
+        self.tree = TREES[self.config['scheduler']]
+        if self.config['queues'] and self.tree.shaping:
+            raise ValueError("scheduler %r cannot be split in several queues" %
+                             self.config['scheduler'])
+        self.plans, self.links = self.compile()
         self.interfaces = self.router.interfaces.keys() # Ordered interface list
         self.interfaces.sort()
+        self.downlinks = self.config['ifb'] and [self.config['ifb']] or \
+            self.router.incoming                              # Where downloads are shaped
         self.mark = Mark(len(self.interfaces),                # Netfilter mark producer
                          self.config['max_users'])
         self.slots = SlotsProvider(self.config['max_users'])  # Slot producer
         self.tickets = TicketsProvider()                      # Ticket producer
+        self.tiers = TicketsProvider()                        # Tier producer
 
         # Netfilter
         for chain in [ "prerouting", "accounting", "postrouting" ]:
@@ -263,40 +344,314 @@ class LinuxBinder(object):
                              **subs)
 
         # Setup QoS
-        for interface in self.interfaces + self.router.incoming:
-            logger.info("setup QoS for interface %s" % interface)
-            Commands.run_noerr("tc qdisc del dev %(interface)s root", interface=interface)
+        if self.config['ifb']:
+            self.setup_ifb()
+        for interface in self.interfaces + self.downlinks:
+            self.setup_qos(interface)
+        for interface in self.interfaces:
+            self.setup_link(interface)
+
+        # Setup routing rules
+        for interface in self.interfaces:
+            self.setup_rules(interface)
+
+    def setup_qos(self, interface):
+        """Setup QoS for an interface.
+
+        :param interface: name of the interface
+        :type interface: string
+        """
+        logger.info("setup QoS for interface %s" % interface)
+        Commands.run_noerr("tc qdisc del dev %(interface)s root", interface=interface)
+        if self.config['queues']:
+            self.setup_queues(interface)
+        else:
+            Commands.run("tc qdisc add dev %(interface)s root handle 1: %(kind)s",
+                         interface=interface, kind=self.tree.kind)
+            rate, parent = UNLIMITED, "1:"
+            if self.tree.shaping and interface not in self.downlinks:
+                # Class for the whole link
+                rate, parent = self.links[interface]['up'], self.tree.parent()
+                Commands.run("tc class add dev %(interface)s parent 1: classid %(parent)s"
+                             "  %(spec)s",
+                             interface=interface, parent=parent,
+                             spec=self.tree.leaf(rate, rate).spec)
             Commands.run(
-                # Flush QoS
-                "tc qdisc add dev %(interface)s root handle 1: drr",
                 # Default class
-                "tc class add dev %(interface)s parent 1: classid 1:2 drr",
+                "tc class add dev %(interface)s parent %(parent)s classid 1:2 %(spec)s",
                 "tc qdisc add dev %(interface)s parent 1:2 handle 12: sfq",
                 # Use default class for unmatched traffic
                 "tc filter add dev %(interface)s protocol arp parent 1:0"
                 "  prio 1 u32 match u32 0 0 flowid 1:2", # ARP
-                interface=interface, **self.config)
-            for iptables in self.iptables:
+                interface=interface, parent=parent,
+                spec=self.tree.leaf(rate, rate).spec, **self.config)
+        # Traffic redirected to the IFB device is classified on
+        # incoming interfaces
+        outputs = (interface == self.config['ifb']) and self.router.incoming or [interface]
+        for iptables in self.iptables:
+            for output in outputs:
                 Commands.run(
                     "%(iptables)s -t mangle -A %(postrouting)s"
-                    "  -o %(interface)s -j CLASSIFY --set-class 1:2", # IP
+                    "  -o %(output)s -j CLASSIFY --set-class 1:2", # IP
                     iptables=iptables,
-                    interface=interface, **self.config)
+                    output=output, **self.config)
 
-        # Setup routing rules
-        for interface in self.interfaces:
-            logger.info("setup ip rules for interface %s" % interface)
-            for ip in self.ipcmd:
-                Commands.run_noerr("%(ip)s rule del fwmark %(mark)s table %(interface)s",
-                                   mark="%s/%s" % self.mark(self.interfaces.index(interface)),
-                                   ip = ip,
-                                   interface=interface)
+    def setup_queues(self, interface):
+        """Setup a tree of classes for each transmit queue of an interface.
+
+        Each tree gets its own default class for unclassified traffic,
+        including ARP. Classified packets are steered to the queue of
+        their tree by filters on a `clsact` queueing discipline.
+
+        :param interface: name of the interface
+        :type interface: string
+        """
+        Commands.run_noerr("tc qdisc del dev %(interface)s clsact", interface=interface)
+        Commands.run("tc qdisc add dev %(interface)s root handle 1: mq",
+                     "tc qdisc add dev %(interface)s clsact",
+                     interface=interface)
+        for queue in range(self.config['queues']):
+            Commands.run(
+                "tc qdisc add dev %(interface)s parent 1:%(queue)x"
+                "  handle %(root)s: %(kind)s",
+                # Default class
+                "tc class add dev %(interface)s parent %(root)s: classid %(root)s:2 %(spec)s",
+                "tc qdisc add dev %(interface)s parent %(root)s:2 handle d%(queue)x: sfq",
+                "tc filter add dev %(interface)s parent %(root)s:"
+                "  prio 1 matchall flowid %(root)s:2",
+                # Steer classified packets to the queue
+                "tc filter add dev %(interface)s egress prio 1"
+                "  basic match 'meta(priority mask 0xffff0000 eq 0x%(root)s0000)'"
+                "  action skbedit queue_mapping %(index)d",
+                interface=interface, queue=queue + 1, index=queue,
+                root=self.root(queue), kind=self.tree.kind,
+                spec=self.tree.leaf().spec)
+
+    def root(self, ticket):
+        """Major number of the tree of classes of a ticket.
+
+        Without several transmit queues, there is only one tree. With
+        them, the ticket of a user or of a tier (or the index of a
+        queue) is hashed to one of the queues. Those major numbers
+        contain a letter and cannot conflict with handles of
+        queueing disciplines of users.
+
+        :param ticket: ticket of a user or a tier
+        :rtype: string
+        """
+        if not self.config['queues']:
+            return "1"
+        return "b%x" % (int(str(ticket).lstrip("c")) % self.config['queues'] + 1)
+
+    def setup_ifb(self):
+        """Redirect the traffic of incoming interfaces to the IFB device.
+
+        The device is created if needed. Queueing disciplines of
+        incoming interfaces are replaced by a `clsact` queueing
+        discipline redirecting all outgoing packets to the device.
+        """
+        logger.info("redirect incoming interfaces to %(ifb)s" % self.config)
+        Commands.run_noerr("ip link add dev %(ifb)s numtxqueues %(txqueues)d type ifb",
+                           txqueues=self.config['queues'] or 1, **self.config)
+        Commands.run("ip link set up dev %(ifb)s", **self.config)
+        for incoming in self.router.incoming:
+            Commands.run_noerr("tc qdisc del dev %(incoming)s root",
+                               "tc qdisc del dev %(incoming)s clsact",
+                               incoming=incoming)
+            Commands.run("tc qdisc add dev %(incoming)s clsact",
+                         "tc filter add dev %(incoming)s egress matchall"
+                         "  action mirred egress redirect dev %(ifb)s",
+                         incoming=incoming, **self.config)
+
+    def cleanup_qos(self, interface):
+        """Remove QoS from an interface.
+
+        :param interface: name of the interface
+        :type interface: string
+        """
+        logger.info("remove QoS from interface %s" % interface)
+        Commands.run_noerr("tc qdisc del dev %(interface)s root", interface=interface)
+        if self.config['queues']:
+            Commands.run_noerr("tc qdisc del dev %(interface)s clsact", interface=interface)
+        for iptables in self.iptables:
+            Commands.run_noerr(
+                "%(iptables)s -t mangle -D %(postrouting)s"
+                "  -o %(interface)s -j CLASSIFY --set-class 1:2",
+                iptables=iptables,
+                interface=interface, **self.config)
+
+    def setup_link(self, interface, bind="add"):
+        """Setup, change or remove the classes of an outgoing interface.
+
+        With a tree shaping the traffic, each outgoing interface gets
+        a class on incoming interfaces (or on the IFB device), limited
+        to the download rate of the link. The classes of its clients
+        are attached to it.
+
+        With a tree of tiers, the tiers of the outgoing interface are
+        setup or removed instead (see :meth:`setup_tier`).
+
+        :param interface: name of the outgoing interface
+        :type interface: string
+        :param bind: `add`, `change` or `del`
+        :type bind: string
+        """
+        if self.tree.tiers:
+            if bind == "add":
+                for qos in sorted(self.router.interfaces[interface].qos):
+                    self.setup_tier(interface, qos)
+            elif bind == "del":
+                for i, qos in sorted(self.tiers.clients):
+                    if i == interface:
+                        self.setup_tier(interface, qos, bind=False)
+            return
+        if not self.tree.shaping:
+            return
+        rate = self.links[interface]['down']
+        opts = dict(spec=self.tree.leaf(rate, rate).spec,
+                    parent=self.tree.parent(self.interfaces.index(interface)),
+                    add=bind)
+        if bind == "change":
+            up = self.links[interface]['up']
+            Commands.run("tc class change dev %(interface)s parent 1:"
+                         "  classid %(parent)s %(spec)s",
+                         interface=interface, parent=self.tree.parent(),
+                         spec=self.tree.leaf(up, up).spec)
+        for incoming in self.downlinks:
+            Commands.run("tc class %(add)s dev %(incoming)s parent 1:"
+                         "  classid %(parent)s %(spec)s",
+                         incoming=incoming, **opts)
+
+    def setup_rules(self, interface, add=True):
+        """Setup or remove routing rules for an interface.
+
+        The firewall mark of the interface depends on its index in
+        :attr:`interfaces`.
+
+        :param interface: name of the interface
+        :type interface: string
+        :param add: add or only remove rules?
+        :type add: boolean
+        """
+        logger.info("%s ip rules for interface %s" % (add and "setup" or "remove",
+                                                      interface))
+        for ip in self.ipcmd:
+            Commands.run_noerr("%(ip)s rule del fwmark %(mark)s table %(interface)s",
+                               mark="%s/%s" % self.mark(self.interfaces.index(interface)),
+                               ip = ip,
+                               interface=interface)
+            if add:
                 Commands.run("%(ip)s rule add fwmark %(mark)s table %(interface)s",
                              ip = ip,
                              mark="%s/%s" % self.mark(self.interfaces.index(interface)),
                              interface=interface)
 
-    def bind(self, client, interface, qos, bind=True):
+    def reload(self):
+        """Apply a new configuration of the router.
+
+        Only the differences with the current configuration are
+        applied. QoS and routing rules are setup for new interfaces
+        and removed for old ones. Clients whose QoS settings have
+        changed are reshaped (see :meth:`reshape`). Clients bound to
+        an interface or a QoS which does not exist anymore should
+        already be unbound.
+
+        An interface keeps its index, and therefore its firewall mark,
+        as long as it exists. New interfaces get the free indexes
+        first. If more bits are needed to encode the interfaces in
+        the firewall mark, all clients are bound again with their new
+        mark.
+        """
+        plans, links = self.compile()
+        previous_links = self.links
+        names = self.router.interfaces.keys()
+        removed = [i for i in self.interfaces if i is not None and i not in names]
+        added = sorted([i for i in names if i not in self.interfaces])
+        interfaces = [(i not in removed) and i or None for i in self.interfaces]
+        for interface in added:
+            if None in interfaces:
+                interfaces[interfaces.index(None)] = interface
+            else:
+                interfaces.append(interface)
+        mark = Mark(len(interfaces), self.config['max_users'])
+        rebuild = mark.bits != self.mark.bits
+        clients = self.router.clients
+
+        commands = []
+        def run(*args, **kwargs):
+            commands.extend([command % kwargs for command in args])
+        for interface in removed:
+            self.setup_rules(interface, add=False)
+            self.setup_link(interface, "del")
+            self.cleanup_qos(interface)
+        if self.tree.tiers:
+            for interface, qos in sorted(self.tiers.clients):
+                if interface in names and (interface, qos) not in plans:
+                    self.setup_tier(interface, qos, bind=False)
+        if rebuild:
+            logger.info("firewall marks have changed, bind all clients again")
+            for client, (interface, qos) in clients.items():
+                self.bind(client, interface, qos, bind=False, run=run)
+            for interface in self.interfaces:
+                if interface is not None and interface not in removed:
+                    self.setup_rules(interface, add=False)
+        previous, self.links = self.plans, links
+        self.interfaces, self.mark, self.plans = interfaces, mark, plans
+        for interface in added:
+            self.setup_qos(interface)
+            self.setup_link(interface)
+        for interface in names:
+            if interface not in added and links[interface] != previous_links[interface]:
+                logger.info("change bandwidth of interface %s" % interface)
+                self.setup_link(interface, "change")
+        if self.tree.tiers:
+            for interface, qos in sorted(plans):
+                if interface in added:
+                    continue
+                if (interface, qos) not in self.tiers.clients:
+                    self.setup_tier(interface, qos)
+                elif previous[interface, qos] != plans[interface, qos]:
+                    logger.info("reshape tier for %s and %s" % (interface, qos))
+                    self.reshape_class(interface, self.tier(interface, qos),
+                                       previous[interface, qos], plans[interface, qos],
+                                       run=run)
+        for interface in interfaces:
+            if interface is not None and (rebuild or interface in added):
+                self.setup_rules(interface)
+        for client, (interface, qos) in clients.items():
+            if rebuild:
+                self.bind(client, interface, qos, run=run)
+            elif self.tree.tiers:
+                continue
+            elif previous[interface, qos] != plans[interface, qos]:
+                logger.info("reshape %s" % client)
+                self.reshape(client, interface,
+                             previous[interface, qos], plans[interface, qos], run=run)
+        self.execute(commands)
+
+    def compile(self):
+        """Compile the QoS settings of each interface.
+
+        :return: a dictionary mapping each interface and QoS to a
+           :class:`kitero.helper.qdisc.Plan` and a dictionary mapping
+           each interface to the rates of its link (see
+           :func:`kitero.helper.qdisc.link`)
+        """
+        plans = {}
+        links = {}
+        for name, interface in self.router.interfaces.items():
+            try:
+                links[name] = link(interface.bandwidth)
+            except ValueError as e:
+                raise ValueError("invalid bandwidth for %r: %s" % (name, e))
+            for q, qos in interface.qos.items():
+                try:
+                    plans[name, q] = plan(qos.settings, self.tree, links[name])
+                except ValueError as e:
+                    raise ValueError("invalid QoS %r for %r: %s" % (q, name, e))
+        return plans, links
+
+    def bind(self, client, interface, qos, bind=True, run=Commands.run):
         """Bind or unbind a user.
 
         This is the method that will issue all `tc` and `iptables`
@@ -313,95 +668,46 @@ class LinuxBinder(object):
         :type slot: integer
         :param bind: bind or unbind?
         :type bind: boolean
+        :param run: function to run commands, see :meth:`Commands.run`
         """
         ticket = self.tickets.get(client)
         slot = self.slots.get(client)
         mark = self.mark(self.interfaces.index(interface), slot)
         # tc qdisc and classes for the user
-        def build(interface, qos, what):
-            r = self.router.interfaces[interface].qos[qos].settings.get(what, None)
-            result = { 'up': r, 'down': r }
-            if type(r) is dict:
-                result['up'] = r.get('up', None)
-                result['down'] = r.get('down', None)
-            return result
-        bw = build(interface, qos, "bandwidth")
-        netem = build(interface, qos, "netem")
-        for iface in [interface,] + self.router.incoming:
-            direction = (iface in self.router.incoming) and 'down' or 'up'
-            opts=dict(iface=iface,
-                      mark=mark[0],
-                      ticket=ticket,
-                      bw=bw[direction],
-                      netem=netem[direction],
-                      add=(bind and "add" or "del"))
-            # Create a deficit round robin scheduler
-            Commands.run("tc class %(add)s dev %(iface)s parent 1: classid 1:%(ticket)s0 drr",
-                         **opts)
-            if bw[direction] is not None and bind:
-                # TBF for bandwidth limit...
-                Commands.run(
-                    "tc qdisc %(add)s dev %(iface)s parent 1:%(ticket)s0 handle %(ticket)s0:"
-                    "  tbf rate %(bw)s", **opts)
-                if netem[direction] is not None and bind:
-                    # ...and netem
-                    Commands.run(
-                        "tc qdisc %(add)s dev %(iface)s parent %(ticket)s0:1 "
-                        "  handle %(ticket)s1:"
-                        "  netem %(netem)s", **opts)
-            elif netem[direction] is not None and bind:
-                # Just netem
-                Commands.run(
-                    "tc qdisc %(add)s dev %(iface)s parent 1:%(ticket)s0 handle %(ticket)s0:"
-                    "  netem %(netem)s", **opts)
-            elif bind:
-                # No QoS: just use SFQ
-                Commands.run(
-                    "tc qdisc %(add)s dev %(iface)s parent 1:%(ticket)s0"
-                    "  handle %(ticket)s0: sfq",
-                    **opts)
+        if not self.tree.tiers:
+            self.setup_class(interface, ticket, self.plans[interface, qos], bind, run)
         # iptables to classify and accounting
         opts = dict(
             A=(bind and "A" or "D"),
             outgoing=interface,
             client=client,
             mark=mark[0], mask=mark[1],
-            ticket=ticket,
             iptables=self.isipv6(client) and "ip6tables" or "iptables",
             **self.config)
         for incoming in self.router.incoming:
-            Commands.run(
+            run(
                 # Mark the incoming packet from the client
                 "%(iptables)s -t mangle -%(A)s %(prerouting)s -i %(incoming)s"
                 "  -s %(client)s -j MARK --set-mark %(mark)s/%(mask)s",
                 incoming=incoming,
                 **opts)
-        Commands.run(
+        run(
             # Keep the mark only if we reached the output interface
             "%(iptables)s -t mangle -%(A)s %(postrouting)s "
             "  -o %(outgoing)s -s %(client)s -m mark --mark %(mark)s/%(mask)s"
             "  -j CONNMARK --save-mark --nfmask %(mask)s --ctmask %(mask)s",
-            # Classify. Outgoing
-            "%(iptables)s -t mangle -%(A)s %(postrouting)s"
-            "  -o %(outgoing)s -m connmark --mark %(mark)s/%(mask)s"
-            "  -j CLASSIFY --set-class 1:%(ticket)s0",
             **opts)
-        for incoming in self.router.incoming:
-            Commands.run(
-                # Classify. Incoming
-                "%(iptables)s -t mangle -%(A)s %(postrouting)s"
-                "  -o %(incoming)s -m connmark --mark %(mark)s/%(mask)s"
-                "  -j CLASSIFY --set-class 1:%(ticket)s0",
-                incoming=incoming,
-                **opts)
-        Commands.run(
+        if self.tree.tiers:
+            ticket = self.tier(interface, qos)
+        self.classify(client, interface, ticket, bind, run)
+        run(
             # Accounting. Outgoing
             "%(iptables)s -t mangle -%(A)s %(accounting)s"
             "  -o %(outgoing)s -m connmark --mark %(mark)s/%(mask)s"
             "  -m comment --comment up-%(outgoing)s-%(client)s",
             **opts)
         for incoming in self.router.incoming:
-            Commands.run(
+            run(
                 # Accouting. Incoming
                 "%(iptables)s -t mangle -%(A)s %(accounting)s"
                 "  -o %(incoming)s -m connmark --mark %(mark)s/%(mask)s"
@@ -409,12 +715,214 @@ class LinuxBinder(object):
                 incoming=incoming,
                 **opts)
 
+    def classify(self, client, interface, ticket, bind=True, run=Commands.run):
+        """Classify or stop classifying the traffic of a user.
+
+        :param client: IP of the user
+        :type client: string
+        :param interface: name of the outgoing interface
+        :type interface: string
+        :param ticket: ticket of the user or its tier
+        :param bind: classify or stop classifying?
+        :type bind: boolean
+        :param run: function to run commands, see :meth:`Commands.run`
+        """
+        mark = self.mark(self.interfaces.index(interface), self.slots.get(client))
+        opts = dict(
+            A=(bind and "A" or "D"),
+            outgoing=interface,
+            mark=mark[0], mask=mark[1],
+            ticket=ticket, root=self.root(ticket),
+            iptables=self.isipv6(client) and "ip6tables" or "iptables",
+            **self.config)
+        run(
+            # Classify. Outgoing
+            "%(iptables)s -t mangle -%(A)s %(postrouting)s"
+            "  -o %(outgoing)s -m connmark --mark %(mark)s/%(mask)s"
+            "  -j CLASSIFY --set-class %(root)s:%(ticket)s0",
+            **opts)
+        for incoming in self.router.incoming:
+            run(
+                # Classify. Incoming
+                "%(iptables)s -t mangle -%(A)s %(postrouting)s"
+                "  -o %(incoming)s -m connmark --mark %(mark)s/%(mask)s"
+                "  -j CLASSIFY --set-class %(root)s:%(ticket)s0",
+                incoming=incoming,
+                **opts)
+
+    def setup_class(self, interface, ticket, plan, bind=True, run=Commands.run):
+        """Setup or remove a class and its queueing disciplines.
+
+        The class is created on the outgoing interface and on each
+        incoming interface or on the IFB device.
+
+        :param interface: name of the outgoing interface
+        :type interface: string
+        :param ticket: ticket of a user or a tier
+        :param plan: plan of the QoS
+        :type plan: :class:`kitero.helper.qdisc.Plan`
+        :param bind: setup or remove?
+        :type bind: boolean
+        :param run: function to run commands, see :meth:`Commands.run`
+        """
+        for iface in [interface,] + self.downlinks:
+            direction = (iface in self.downlinks) and 'down' or 'up'
+            opts=dict(iface=iface,
+                      ticket=ticket, root=self.root(ticket),
+                      add=(bind and "add" or "del"))
+            run("tc class %(add)s dev %(iface)s parent %(parent)s"
+                "  classid %(root)s:%(ticket)s0 %(spec)s",
+                parent=self.parent(interface, direction, ticket),
+                spec=getattr(plan.classes, direction).spec,
+                **opts)
+            if bind:
+                for qdisc in getattr(plan, direction):
+                    run("tc qdisc %(add)s dev %(iface)s parent " + rooted(qdisc.parent) +
+                        "  handle " + qdisc.handle + "  %(qdisc)s",
+                        qdisc=qdisc.spec, **opts)
+
+    def tier(self, interface, qos):
+        """Ticket of the tier of an interface and a QoS.
+
+        Tiers are only used with a tree of tiers (see
+        :class:`kitero.helper.qdisc.CakeTree`). Their tickets contain
+        a letter and cannot conflict with tickets of users.
+        """
+        return "c%d" % self.tiers.get((interface, qos))
+
+    def setup_tier(self, interface, qos, bind=True, run=Commands.run):
+        """Setup or remove the tier of an interface and a QoS.
+
+        :param interface: name of the outgoing interface
+        :type interface: string
+        :param qos: QoS name
+        :type qos: string
+        :param bind: setup or remove?
+        :type bind: boolean
+        :param run: function to run commands, see :meth:`Commands.run`
+        """
+        if bind:
+            self.tiers.request((interface, qos))
+        logger.info("%s tier for %s and %s" % (bind and "setup" or "remove",
+                                                interface, qos))
+        self.setup_class(interface, self.tier(interface, qos),
+                         self.plans[interface, qos], bind, run)
+        if not bind:
+            self.tiers.release((interface, qos))
+
+    def parent(self, interface, direction, ticket=None):
+        """Parent class of the classes of clients.
+
+        :param interface: name of the outgoing interface
+        :type interface: string
+        :param direction: `up` or `down`
+        :type direction: string
+        :param ticket: ticket of a user or a tier
+        :return: class ID
+        :rtype: string
+        """
+        if self.config['queues']:
+            return "%s:" % self.root(ticket) # Flat trees only
+        if direction == 'down':
+            return self.tree.parent(self.interfaces.index(interface))
+        return self.tree.parent()
+
+    def rebind(self, client, interface, previous, qos, run=Commands.run):
+        """Change the QoS of a user.
+
+        The class of the user, its firewall mark and its `iptables`
+        rules are kept: established flows stay classified. When the
+        queueing disciplines are of the same kind, their parameters
+        are changed in place. Otherwise, they are deleted and added
+        again.
+
+        :param client: IP of the user
+        :type client: string
+        :param interface: name of the outgoing interface
+        :type interface: string
+        :param previous: current QoS name
+        :type previous: string
+        :param qos: new QoS name
+        :type qos: string
+        :param run: function to run commands, see :meth:`Commands.run`
+
+        With a tree of tiers, only the classification of the user
+        changes.
+        """
+        if self.tree.tiers:
+            self.classify(client, interface, self.tier(interface, qos), run=run)
+            self.classify(client, interface, self.tier(interface, previous),
+                          bind=False, run=run)
+            return
+        self.reshape(client, interface,
+                     self.plans[interface, previous], self.plans[interface, qos],
+                     run=run)
+
+    def reshape(self, client, interface, old, new, run=Commands.run):
+        """Replace the queueing disciplines of a user.
+
+        See :meth:`rebind`.
+
+        :param client: IP of the user
+        :type client: string
+        :param interface: name of the outgoing interface
+        :type interface: string
+        :param old: current plan
+        :type old: :class:`kitero.helper.qdisc.Plan`
+        :param new: new plan
+        :type new: :class:`kitero.helper.qdisc.Plan`
+        :param run: function to run commands, see :meth:`Commands.run`
+        """
+        self.reshape_class(interface, self.tickets.get(client), old, new, run)
+
+    def reshape_class(self, interface, ticket, old, new, run=Commands.run):
+        """Replace the queueing disciplines of a class.
+
+        See :meth:`reshape`.
+
+        :param interface: name of the outgoing interface
+        :type interface: string
+        :param ticket: ticket of a user or a tier
+        :param old: current plan
+        :type old: :class:`kitero.helper.qdisc.Plan`
+        :param new: new plan
+        :type new: :class:`kitero.helper.qdisc.Plan`
+        :param run: function to run commands, see :meth:`Commands.run`
+        """
+        layout = lambda qdiscs: [qdisc[:3] for qdisc in qdiscs]
+        for iface in [interface,] + self.downlinks:
+            direction = (iface in self.downlinks) and 'down' or 'up'
+            opts = dict(iface=iface, ticket=ticket, root=self.root(ticket))
+            if getattr(old.classes, direction) != getattr(new.classes, direction):
+                run("tc class change dev %(iface)s parent %(parent)s"
+                    "  classid %(root)s:%(ticket)s0 %(spec)s",
+                    parent=self.parent(interface, direction, ticket),
+                    spec=getattr(new.classes, direction).spec, **opts)
+            currents = getattr(old, direction)
+            qdiscs = getattr(new, direction)
+            if layout(currents) == layout(qdiscs):
+                for qdisc, current in zip(qdiscs, currents):
+                    if qdisc != current:
+                        run("tc qdisc change dev %(iface)s parent " + rooted(qdisc.parent) +
+                            "  handle " + qdisc.handle + "  %(qdisc)s",
+                            qdisc=qdisc.spec, **opts)
+                continue
+            run("tc qdisc del dev %(iface)s parent %(root)s:%(ticket)s0", **opts)
+            for qdisc in qdiscs:
+                run("tc qdisc add dev %(iface)s parent " + rooted(qdisc.parent) +
+                    "  handle " + qdisc.handle + "  %(qdisc)s",
+                    qdisc=qdisc.spec, **opts)
+
     def notify(self, event, router, **kwargs):
         """Handle an event.
 
-        The event is either binding a user or unbinding it. It this is
-        the first time we bind a user, :func:`setup` is called. The
-        real work for binding/unbinding is done by :func:`bind`.
+        The event is either binding a user, changing its QoS settings,
+        unbinding it or a batch of those. It this is the first time we
+        bind a user, :func:`setup` is called. The real work for
+        binding/unbinding is done by :func:`bind` and by
+        :func:`rebind` for QoS changes. Commands for a batch are
+        executed at once (see :func:`execute`). A new configuration
+        of the router is applied by :func:`reload`.
 
         :param event: event received
         :type event: string
@@ -422,28 +930,126 @@ class LinuxBinder(object):
         :type router: instance of :class:`Router`
         """
         if self.router is None:
+            if event == "start":
+                config = kwargs.get('config', {})
+                for key in ('scheduler', 'ifb', 'queues'):
+                    self.config[key] = config.get(key) or self.config[key]
             self.router = router
             self.setup()
         elif self.router != router:
             raise ValueError(
                 "already bound to another router (%s != %s)" % (self.router, router))
-        if event == "bind":
-            client = kwargs['client']
-            interface = kwargs['interface']
-            qos = kwargs['qos']
-            logger.info("bind %s" % client)
-            # Do the binding
-            slot = self.slots.request(interface, client)
-            ticket = self.tickets.request(client)
-            self.bind(client, interface, qos)
-        elif event == "unbind":
-            client = kwargs['client']
-            interface, qos = self.router.clients[client]
-            logger.info("unbind %s from interface %s" % (client, interface))
-            # Undo the binding
-            self.bind(client, interface, qos, bind=False)
-            slot = self.slots.release(client)
-            ticket = self.tickets.release(client)
+        if event == "batch":
+            self.apply(kwargs['events'])
+        elif event == "reload":
+            self.reload()
+        else:
+            self.apply([(event, kwargs)], run=Commands.run)
+
+    def apply(self, events, run=None):
+        """Bind, rebind and unbind several clients.
+
+        Unless a function to run commands is provided, commands are
+        collected and executed at once with :meth:`execute`. If
+        something goes wrong, slots and tickets are given back.
+
+        :param events: list of tuples (event, keyword arguments)
+        :type events: list
+        :param run: function to run commands, see :meth:`Commands.run`
+        """
+        commands = []
+        if run is None:
+            def run(*args, **kwargs):
+                commands.extend([command % kwargs for command in args])
+        undo = []
+        clients = self.router.clients # A copy: only take it once
+        try:
+            for event, kwargs in events:
+                client = kwargs.get('client')
+                if event == "bind":
+                    interface = kwargs['interface']
+                    qos = kwargs['qos']
+                    hints = kwargs.get('hints', {})
+                    logger.info("bind %s" % client)
+                    # Do the binding
+                    self.slots.request(interface, client, hints.get('slot', None))
+                    undo.append(lambda client=client: self.slots.release(client))
+                    self.tickets.request(client, hints.get('ticket', None))
+                    undo.append(lambda client=client: self.tickets.release(client))
+                    self.bind(client, interface, qos, run=run)
+                elif event == "rebind":
+                    logger.info("rebind %s to QoS %s" % (client, kwargs['qos']))
+                    self.rebind(client, kwargs['interface'],
+                                kwargs['previous'], kwargs['qos'], run=run)
+                elif event == "unbind":
+                    interface, qos = clients[client]
+                    logger.info("unbind %s from interface %s" % (client, interface))
+                    # Undo the binding
+                    self.bind(client, interface, qos, bind=False, run=run)
+                    slot = self.slots.release(client)
+                    undo.append(lambda client=client, interface=interface, slot=slot:
+                                    self.slots.request(interface, client, slot))
+                    ticket = self.tickets.release(client)
+                    undo.append(lambda client=client, ticket=ticket:
+                                    self.tickets.request(client, ticket))
+            self.execute(commands)
+        except:
+            for action in reversed(undo):
+                action()
+            raise
+
+    def execute(self, commands):
+        """Execute a list of commands at once.
+
+        `tc` commands are given to ``tc -batch`` and `iptables`
+        commands to ``iptables-restore --noflush``. Therefore, binding
+        many clients only needs a few processes. Rules are applied
+        atomically by `iptables-restore`.
+
+        :param commands: list of commands, already formatted
+        :type commands: list of strings
+        """
+        tc = []
+        tables = {}             # (iptables, table) -> list of rules
+        for command in commands:
+            args = command.split()
+            if args[0] == "tc":
+                tc.append(" ".join(args[1:]))
+            elif args[0] in ("iptables", "ip6tables") and args[1] == "-t":
+                tables.setdefault((args[0], args[2]), []).append(" ".join(args[3:]))
+            else:
+                raise ValueError("unable to batch command %r" % command)
+        if tc:
+            self._batch("tc -batch %(batch)s", tc)
+        for (iptables, table), rules in sorted(tables.items()):
+            self._batch("%(iptables)s-restore --noflush %(batch)s",
+                        ["*%s" % table] + rules + ["COMMIT"],
+                        iptables=iptables)
+
+    def _batch(self, command, lines, **kwargs):
+        """Write lines to a temporary file and run a command on it."""
+        fd, batch = tempfile.mkstemp(prefix="kitero-")
+        try:
+            try:
+                os.write(fd, "".join(["%s\n" % line for line in lines]))
+            finally:
+                os.close(fd)
+            Commands.run(command, batch=batch, **kwargs)
+        finally:
+            os.unlink(batch)
+
+    def hints(self, client):
+        """Return slot and ticket allocated to a client.
+
+        :param client: IP address of the client
+        :type client: string
+        :return: dictionary with `slot` and `ticket` keys if the
+           client is bound, an empty dictionary otherwise
+        """
+        if self.router is None or client not in self.tickets.clients:
+            return {}
+        return dict(slot=self.slots.get(client),
+                    ticket=self.tickets.get(client))
 
     STATSRE=re.compile(
         r'^.* --comment "(?P<direction>up|down)-(?P<interface>[^"]+)-'
@@ -480,14 +1086,59 @@ class LinuxBinder(object):
             stats[interface]["down"] = down
         return stats
 
+    NEIGHRE=re.compile(
+        r'^(?P<client>[0-9a-f:.]+) dev (?P<interface>\S+) .*\b(?P<state>[A-Z]+)$')
+
+    def neighbors(self):
+        """Return clients present in the neighbor table.
+
+        Only entries on incoming interfaces which are reachable or
+        being checked are considered. Stale entries may belong to
+        clients that left long ago.
+        """
+        if self.router is None:
+            return set()        # Setup is not done yet
+        output = "\n".join([Commands.run("%(ipcmd)s neigh show", ipcmd=ipcmd)
+                            for ipcmd in self.ipcmd])
+        neighbors = set()
+        for line in output.split("\n"):
+            mo = self.NEIGHRE.match(line.strip())
+            if mo and mo.group('interface') in self.router.incoming and \
+                    mo.group('state') in ('REACHABLE', 'DELAY', 'PROBE', 'PERMANENT'):
+                neighbors.add(mo.group('client'))
+        return neighbors
+
 class PersistentBinder(object):
     """Keep track of client bindings and allow persistence to a file.
 
     This binder will just record each client binding into a file and
-    allow to restore them when the application restarts.
+    allow to restore them when the application restarts. Hints about
+    each binding (see :meth:`Router.hints`) are recorded too. For
+    them to be available, this binder should be registered after the
+    binders providing them.
+
+    The file is a journal. The first line is a header with the version
+    of the format. Each following line is either a binding (``+``
+    followed by the client, the interface, the QoS and optionally the
+    hints as JSON) or an unbinding (``-`` followed by the client)::
+
+        # kitero bindings 1
+        + 192.168.1.15 eth1 qos1 {"slot":0,"ticket":1}
+        + 192.168.1.16 eth1 qos2 {"slot":1,"ticket":2}
+        - 192.168.1.15
+
+    Each event appends one line to the journal. A batch of events is
+    appended with a single write. When the journal becomes too large
+    compared to the number of bindings, it is rewritten with only the
+    current bindings. Files written by older versions (a pickled
+    dictionary) can still be restored.
     """
 
-    zope.interface.implements(IBinder)
+    zope.interface.implements(IBatchBinder, IRebinder)
+
+    version = 1
+    header = "# kitero bindings %d\n"
+    encoder = json.JSONEncoder(separators=(',', ':'))
 
     def __init__(self, save):
         """Initialize this instance of saving binder.
@@ -497,6 +1148,75 @@ class PersistentBinder(object):
         """
         self.save = save
         self.bindings = {}
+        self.journal = None     # Journal opened for append
+        self.records = 0        # Number of records in the journal
+
+    def load(self):
+        """Load bindings from saved file.
+
+        :return: dictionary of bindings. Each binding is a tuple
+           interface, QoS and hints.
+        """
+        bindings = {}
+        f = file(self.save, "r")
+        try:
+            first = f.readline()
+            if not first.startswith("# kitero bindings "):
+                # Previous format
+                f.seek(0)
+                for client, binding in pickle.load(f).items():
+                    bindings[client] = (binding[0], binding[1],
+                                        len(binding) > 2 and binding[2] or {})
+                return bindings
+            version = int(first.split()[-1])
+            if version != self.version:
+                raise ValueError("unknown version %d for %s" % (version, self.save))
+            unquote = lambda field: "%" in field and urllib.unquote(field) or field
+            for line in f:
+                fields = line.rstrip("\n").split(" ", 4)
+                try:
+                    if fields[0] == "+":
+                        hints = len(fields) > 4 and json.loads(fields[4]) or {}
+                        bindings[unquote(fields[1])] = (unquote(fields[2]),
+                                                        unquote(fields[3]),
+                                                        hints)
+                    elif fields[0] == "-":
+                        bindings.pop(unquote(fields[1]), None)
+                    else:
+                        raise ValueError("unknown record")
+                except (ValueError, IndexError):
+                    logger.warning("ignore invalid record %r in %s" % (line, self.save))
+            return bindings
+        finally:
+            f.close()
+
+    def compact(self):
+        """Rewrite the journal with only the current bindings."""
+        logger.info("save bindings to %s" % self.save)
+        if self.journal is not None:
+            self.journal.close()
+        temp = "%s.tmp" % self.save
+        f = file(temp, "w")
+        f.write(self.header % self.version)
+        for client, (interface, qos, hints) in self.bindings.iteritems():
+            f.write(self._record(client, interface, qos, hints))
+        f.close()
+        os.rename(temp, self.save)
+        self.journal = file(self.save, "a")
+        self.records = len(self.bindings)
+
+    def _record(self, client, interface=None, qos=None, hints=None):
+        """Build a journal record for the given binding.
+
+        Without an interface, the record is an unbinding.
+        """
+        if interface is None:
+            return "- %s\n" % urllib.quote(client, ":.")
+        fields = ["+", urllib.quote(client, ":."),
+                  urllib.quote(interface, ""), urllib.quote(qos, "")]
+        if hints:
+            fields.append(self.encoder.encode(hints))
+        return "%s\n" % " ".join(fields)
 
     def restore(self, router):
         """Restore bindings from saved file
@@ -505,31 +1225,69 @@ class PersistentBinder(object):
         :type router: :class:`Router`
         """
         logger.info("restore bindings from %s" % self.save)
-        self.bindings = pickle.load(file(self.save, "r"))
-        for client in self.bindings:
-            eth, qos = self.bindings[client]
-            try:
-                router.bind(client, eth, qos)
-            except:
-                logger.exception("unable to rebind %r" % client)
+        bindings = self.load()
+        # Clients with hints are restored first to get their resources back
+        clients = bindings.keys()
+        clients.sort(key=lambda client: not bindings[client][2])
+        valid = []
+        for client in clients:
+            eth, qos, hints = bindings[client]
+            if eth not in router.interfaces or qos not in router.interfaces[eth].qos:
+                logger.warning("unable to rebind %r: no %r for %r" % (client, qos, eth))
+                continue
+            valid.append((client, eth, qos, hints))
+        self.bindings = {}
+        try:
+            # All bindings are restored at once...
+            router.bind_many(valid)
+        except:
+            # ...or one by one if this is not possible
+            logger.exception("unable to rebind %d clients at once" % len(valid))
+            for client, eth, qos, hints in valid:
+                try:
+                    router.bind_many([(client, eth, qos, hints)])
+                except:
+                    logger.exception("unable to rebind %r" % client)
+        for client in router.clients:
+            eth, qos = router.clients[client]
+            self.bindings[client] = (eth, qos, router.hints(client))
+        self.compact()
 
     def notify(self, event, router, **kwargs):
         """Handle an event.
 
-        The event is either binding a user or unbinding it. We update
-        our client table and save it to disk.
+        The event is either binding a user, changing its QoS settings,
+        unbinding it or a batch of those. We update our client table
+        and append the events to the journal.
 
         :param event: event received
         :type event: string
         :param router: router that triggered the event
         :type router: instance of :class:`Router`
         """
-        if event == "bind":
-            self.bindings[kwargs['client']] = (kwargs['interface'], kwargs['qos'])
-        elif event == "unbind":
-            del self.bindings[kwargs['client']]
-        logger.info("save bindings to %s" % self.save)
-        pickle.dump(self.bindings, file(self.save, "w"))
+        if event == "batch":
+            events = kwargs['events']
+        else:
+            events = [(event, kwargs)]
+        records = []
+        for event, kwargs in events:
+            if event in ("bind", "rebind"):
+                client = kwargs['client']
+                self.bindings[client] = (kwargs['interface'], kwargs['qos'],
+                                         router.hints(client))
+                records.append(self._record(client, *self.bindings[client]))
+            elif event == "unbind":
+                del self.bindings[kwargs['client']]
+                records.append(self._record(kwargs['client']))
+        if not records:
+            return
+        if self.journal is None or \
+                self.records + len(records) > 2*len(self.bindings) + 100:
+            self.compact()
+        else:
+            self.journal.write("".join(records))
+            self.journal.flush()
+            self.records = self.records + len(records)
 
 class LinuxBinderIPv4(LinuxBinder):
     """IPv4 only version of `LinuxBinder`."""
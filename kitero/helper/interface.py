@@ -10,6 +10,16 @@ class IBinder(zope.interface.Interface):
         :type event: string
         :param router: router that triggered the event
         :type router: instance of :class:`Router`
+
+        On `bind`, keyword arguments are `client`, `interface`, `qos`
+        and `hints` (a dictionary, see :class:`IHintsProvider`). On
+        `unbind`, the only keyword argument is `client`. A `start`
+        event is sent when the helper service starts, with the
+        configuration of the helper as `config` keyword argument. A
+        `reload` event is sent when the configuration of the router
+        has changed (see :meth:`Router.reload`); the only keyword
+        argument is `previous`, the previous interfaces. Unknown
+        events should be ignored.
         """
 
 class IStatsProvider(zope.interface.Interface):
@@ -41,3 +51,65 @@ class IStatsProvider(zope.interface.Interface):
                   "172.16.10.15": dict(up=14, down=155)
                 }))
         """
+
+class IHintsProvider(zope.interface.Interface):
+    """Interface for binders able to provide hints about a binding.
+
+    Hints are opaque values that a binder attaches to a client when
+    it binds it (for example, the firewall mark or the traffic class
+    it allocated). They can be saved along with the binding and given
+    back to the router when the binding is restored. The binder should
+    then try to allocate the exact same resources.
+    """
+
+    def hints(client):
+        """Return hints for the given client.
+
+        :param client: IP address of the client
+        :type client: string
+        :return: a dictionary of hints (empty if the client is unknown)
+
+        Here is an example of allowed output::
+
+            dict(slot=4, ticket=18)
+        """
+
+class INeighborsProvider(zope.interface.Interface):
+    """Interface for binders able to tell which clients are present.
+
+    A client is present when it recently answered at the link layer,
+    as recorded in the neighbor table of the kernel.
+    """
+
+    def neighbors():
+        """Return present clients.
+
+        :return: a set of IP addresses of present clients
+        """
+
+class IBatchBinder(IBinder):
+    """Interface for binders able to handle several events at once.
+
+    Such a binder receives a single `batch` event when several clients
+    are bound or unbound together (see :meth:`Router.bind_many` and
+    :meth:`Router.unbind_many`). The only keyword argument is
+    `events`, a list of tuples whose first element is the event (bind
+    or unbind) and whose second element is the dictionary of keyword
+    arguments that would have been received for this event alone.
+
+    Binders not providing this interface receive one event for each
+    client instead.
+    """
+
+class IRebinder(IBinder):
+    """Interface for binders able to change the QoS of a bound client.
+
+    Such a binder receives a `rebind` event when a bound client
+    switches to another QoS on the same interface (see
+    :meth:`Router.rebind`). Keyword arguments are `client`,
+    `interface`, `qos` (the new QoS) and `previous` (the current
+    QoS). Resources allocated to the client should be kept.
+
+    Binders not providing this interface receive an `unbind` event
+    followed by a `bind` event instead.
+    """
@@ -0,0 +1,166 @@
+import time
+import threading
+import zope.interface
+import logging
+logger = logging.getLogger("kitero.helper.liveness")
+
+from kitero.helper.interface import IRebinder
+from kitero.expiry import Expiry
+
+class Liveness(object):
+    """Unbind clients that are not alive anymore.
+
+    Each bound client gets a deadline. The deadline is pushed back
+    each time a heartbeat is received for this client. A background
+    thread unbinds the clients whose deadline has passed. Clients
+    already bound when the liveness tracker is created get a deadline
+    too.
+
+    Optionally, idle clients are detected from the statistics and the
+    neighbor table of the router. A client whose counters changed or
+    which is present in the neighbor table is active: this counts as a
+    heartbeat. A client which has not been active for `idle` seconds
+    is unbound, even if heartbeats are still received. This is checked
+    every :attr:`sweep` seconds with one read of the statistics and of
+    the neighbor table.
+    """
+    zope.interface.implements(IRebinder)
+
+    def __init__(self, router, lock, timeout=900, idle=None):
+        """Create a new liveness tracker.
+
+        :param router: router whose clients should be tracked
+        :param lock: lock to access the router
+        :param timeout: default number of seconds a client stays alive
+            without heartbeat
+        :param idle: number of seconds without activity before a
+            client is unbound or `None` to not detect idle clients
+        """
+        self.router = router
+        self.lock = lock
+        self.timeout = timeout
+        self.idle = idle
+        self.sweep = idle and max(idle / 4., 1) or None
+        self.swept = time.time()  # Time of the last sweep
+        self.counters = {}      # Last counters of each client
+        self.active = {}        # Last activity of each client
+        self.expiry = Expiry()
+        self._stop = threading.Event()
+        self._wake = threading.Event() # A deadline may be earlier
+        self._thread = None
+        deadline = time.time() + timeout
+        for client in router.clients:
+            self.expiry.refresh(client, deadline)
+
+    def notify(self, event, source, **kwargs):
+        if event in ("bind", "rebind"):
+            self.expiry.refresh(kwargs["client"], time.time() + self.timeout)
+        elif event == "unbind":
+            self.expiry.remove(kwargs["client"])
+
+    def heartbeat(self, client, timeout=None):
+        """Tell that a client is alive.
+
+        Should be called with the lock held.
+
+        :param client: IP address of the client
+        :param timeout: number of seconds the client stays alive, the
+            default timeout if `None`
+        :return: `True` if the client is bound
+        """
+        if client not in self.expiry:
+            return False
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.time() + timeout
+        following = self.expiry.next()
+        self.expiry.refresh(client, deadline)
+        if following is None or deadline < following:
+            self._wake.set()
+        return True
+
+    def expire(self, now=None):
+        """Unbind expired clients.
+
+        :param now: current time
+        :return: list of unbound clients
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            clients = self.expiry.expire(now)
+            for client in clients:
+                logger.info("client %s is not alive anymore", client)
+            self.router.unbind_many(clients)
+        return clients
+
+    def detect(self, now=None):
+        """Detect active and idle clients.
+
+        Idle clients are unbound.
+
+        :param now: current time
+        :return: list of idle clients
+        """
+        if now is None:
+            now = time.time()
+        idle = []
+        with self.lock:
+            stats = self.router.stats
+            neighbors = self.router.neighbors
+            counters = {}
+            for interface in stats.values():
+                for client, current in interface.get('details', {}).items():
+                    if current:
+                        counters[client] = (current.get('up'), current.get('down'))
+            active = {}
+            for client in self.router.clients:
+                present = neighbors is not None and client in neighbors
+                known = client in counters
+                if present or \
+                        (known and counters[client] != self.counters.get(client)):
+                    active[client] = now
+                    self.heartbeat(client)
+                elif not known and neighbors is None:
+                    continue    # Nothing to tell
+                else:
+                    active[client] = self.active.get(client, now)
+                    if now - active[client] > self.idle:
+                        idle.append(client)
+            self.counters, self.active = counters, active
+            for client in idle:
+                logger.info("client %s is idle", client)
+            self.router.unbind_many(idle)
+        return idle
+
+    def start(self):
+        """Start to expire clients in the background."""
+        self._thread = threading.Thread(target=self._run)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop to expire clients."""
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.isSet():
+            if self.sweep and time.time() - self.swept >= self.sweep:
+                self.swept = time.time()
+                try:
+                    self.detect()
+                except Exception: # pragma: no cover
+                    logger.exception("unable to detect idle clients")
+            deadline = self.expiry.next()
+            delay = deadline is None and 1 or deadline - time.time()
+            if delay > 0:
+                self._wake.wait(min(delay, 1))
+                self._wake.clear()
+                continue
+            try:
+                self.expire()
+            except Exception: # pragma: no cover
+                logger.exception("unable to expire clients")
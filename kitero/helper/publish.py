@@ -0,0 +1,107 @@
+import threading
+import zope.interface
+import logging
+logger = logging.getLogger("kitero.helper.publish")
+
+from kitero.helper.interface import IRebinder
+
+class Publisher(object):
+    """Publish changes of the router to subscribers.
+
+    Subscribers are RPC handlers. They get an event for each binding
+    change and, periodically, a sample of the statistics. Each event
+    is a dictionary with the name of the event (`event`), a sequence
+    number (`seq`) and additional keys:
+
+     - `bind`: `client`, `interface` and `qos`, also used when a
+       client changes its QoS settings
+     - `unbind`: `client`
+     - `stats`: `stats`, as returned by :attr:`Router.stats`
+     - `catalogue`: `version`, the new version of the catalogue
+       after a reload of the configuration
+
+    Events are published while holding the lock to the router. The
+    sequence number is therefore consistent with the snapshot returned
+    on subscription.
+    """
+    zope.interface.implements(IRebinder)
+
+    def __init__(self, router, lock, interval=5):
+        """Create a new publisher.
+
+        :param router: router to observe
+        :param lock: lock to access the router
+        :param interval: interval between two stats samples in seconds
+        """
+        self.router = router
+        self.lock = lock
+        self.interval = interval
+        self.seq = 0
+        self.subscribers = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def notify(self, event, source, **kwargs):
+        if event in ("bind", "rebind"):
+            self.publish("bind", client=kwargs["client"],
+                         interface=kwargs["interface"], qos=kwargs["qos"])
+        elif event == "unbind":
+            self.publish("unbind", client=kwargs["client"])
+
+    def publish(self, event, **kwargs):
+        """Publish an event to all subscribers.
+
+        Should be called with the lock held.
+
+        :param event: name of the event
+        :type event: string
+        """
+        self.seq += 1
+        if not self.subscribers:
+            return
+        kwargs.update(event=event, seq=self.seq)
+        for handler in self.subscribers[:]:
+            if not handler.push(kwargs):
+                self.subscribers.remove(handler)
+
+    def subscribe(self, handler):
+        """Subscribe a handler to events.
+
+        Should be called with the lock held.
+
+        :param handler: handler of the connection to push events to
+        :type handler: :class:`RPCRequestHandler`
+        :return: a snapshot of the router: the current sequence number
+            (`seq`), the bound clients (`clients`) and the
+            statistics (`stats`)
+        """
+        if handler not in self.subscribers:
+            self.subscribers.append(handler)
+        return dict(seq=self.seq,
+                    clients=self.router.clients,
+                    stats=self.router.stats)
+
+    def sample(self):
+        """Publish a sample of the statistics if someone is listening."""
+        with self.lock:
+            if self.subscribers:
+                self.publish("stats", stats=self.router.stats)
+
+    def start(self):
+        """Start to publish statistics periodically."""
+        self._thread = threading.Thread(target=self._run)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop to publish statistics."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.sample()
+            except Exception: # pragma: no cover
+                logger.exception("unable to publish statistics")
@@ -0,0 +1,308 @@
+import re
+from collections import namedtuple
+
+class Qdisc(namedtuple("Qdisc", "parent handle kind params")):
+    """A queueing discipline attached to the class of a client.
+
+    `parent` and `handle` should be formatted with the ticket of the
+    client. `params` are the parameters given to `tc` after the kind
+    of the queueing discipline.
+    """
+    __slots__ = ()
+
+    @property
+    def spec(self):
+        """Kind and parameters, as given to `tc`."""
+        return " ".join([self.kind] + list(self.params))
+
+class Class(namedtuple("Class", "kind params")):
+    """A class of a client or of a link.
+
+    `params` are the parameters given to `tc` after the kind of the
+    class.
+    """
+    __slots__ = ()
+
+    @property
+    def spec(self):
+        """Kind and parameters, as given to `tc`."""
+        return " ".join([self.kind] + list(self.params))
+
+class Classes(namedtuple("Classes", "up down")):
+    """Classes of a client for both directions."""
+    __slots__ = ()
+
+class Plan(namedtuple("Plan", "up down classes")):
+    """Queueing disciplines for both directions of a QoS.
+
+    Each direction is a tuple of :class:`Qdisc`, the first one being
+    attached to the class of the client. `classes` are the classes
+    of the client (see :class:`Classes`), DRR classes if omitted.
+    """
+    __slots__ = ()
+
+    def __new__(cls, up, down, classes=None):
+        if classes is None:
+            classes = Classes(DRR.leaf(), DRR.leaf())
+        return super(Plan, cls).__new__(cls, up, down, classes)
+
+_number = r'\d+(?:\.\d+)?'
+RATE = re.compile(r'^%s(?:[kmgt]i?)?(?:bit|bps)?$' % _number, re.I)
+SIZE = re.compile(r'^%s(?:[kmgt]i?)?(?:b|bit)?$' % _number, re.I)
+TIME = re.compile(r'^%s(?:s|sec|secs|ms|msec|msecs|us|usec|usecs)?$' % _number, re.I)
+VALUE = re.compile(r'^%s(?:[a-z]+|%%)?$' % _number, re.I)
+
+# Parameters of TBF and how to check their values
+TBF = { 'buffer': SIZE, 'burst': SIZE, 'maxburst': SIZE,
+        'limit': SIZE, 'latency': TIME,
+        'peakrate': RATE, 'mtu': SIZE, 'minburst': SIZE,
+        'overhead': re.compile(r'^-?\d+$'),
+        'linklayer': re.compile(r'^(ethernet|atm|adsl)$') }
+
+# Keywords of netem
+NETEM = set(['delay', 'distribution', 'loss', 'random', 'state', 'gemodel',
+             'corrupt', 'duplicate', 'reorder', 'gap', 'rate', 'slot',
+             'packets', 'bytes', 'limit', 'ecn', 'seed'])
+
+# Rate used for links without bandwidth
+UNLIMITED = "10gbit"
+
+def bandwidth(rate):
+    """Check a bandwidth limit.
+
+    :param rate: rate followed by other TBF parameters
+    :type rate: string
+    :return: arguments and set of given TBF parameters
+    :rtype: tuple
+    """
+    args = str(rate).split()
+    if not args or not RATE.match(args[0]):
+        raise ValueError("invalid rate in %r" % rate)
+    options = args[1:]
+    if len(options) % 2:
+        raise ValueError("missing value in %r" % rate)
+    given = set()
+    for keyword, value in zip(options[::2], options[1::2]):
+        if keyword not in TBF or not TBF[keyword].match(value):
+            raise ValueError("invalid parameter %r in %r" % (keyword, rate))
+        given.add(keyword)
+    return args, given
+
+def tbf(rate):
+    """Check a bandwidth limit and return the matching parameters.
+
+    :param rate: rate followed by other TBF parameters
+    :type rate: string
+    :return: parameters of the `tbf` queueing discipline
+    :rtype: tuple of strings
+    """
+    args, given = bandwidth(rate)
+    if not given & set(['buffer', 'burst', 'maxburst']):
+        raise ValueError("burst is required in %r" % rate)
+    if not given & set(['limit', 'latency']):
+        raise ValueError("limit or latency is required in %r" % rate)
+    return tuple(["rate"] + args)
+
+def netem(settings):
+    """Check netem settings and return the matching parameters.
+
+    :param settings: netem settings
+    :type settings: string
+    :return: parameters of the `netem` queueing discipline
+    :rtype: tuple of strings
+    """
+    args = str(settings).split()
+    if not args or args[0] not in NETEM:
+        raise ValueError("invalid netem settings %r" % settings)
+    for previous, arg in zip([None] + args, args):
+        if previous == "distribution":
+            continue            # Name of a distribution table
+        if arg not in NETEM and not VALUE.match(arg):
+            raise ValueError("invalid parameter %r in %r" % (arg, settings))
+    return tuple(args)
+
+def link(rates):
+    """Check the rates of a link.
+
+    :param rates: rate of the link, for both directions or as a
+        mapping with `up` and `down` keys, or `None`
+    :return: rate of the link for each direction
+    :rtype: dictionary
+    """
+    if rates is None:
+        return dict(up=UNLIMITED, down=UNLIMITED)
+    if type(rates) is not dict:
+        rates = dict(up=rates, down=rates)
+    if set(rates) - set(['up', 'down']):
+        raise ValueError("unknown direction in %r" % rates)
+    result = {}
+    for direction in ('up', 'down'):
+        rate = rates.get(direction, UNLIMITED)
+        if not RATE.match(str(rate)):
+            raise ValueError("invalid rate %r" % rate)
+        result[direction] = str(rate)
+    return result
+
+class Tree(object):
+    """Strategy to build the tree of classes of an interface.
+
+    The root queueing discipline has handle `1:`. The class of each
+    client is a child of a parent class: the class of the link for an
+    outgoing interface, the class of the outgoing interface for an
+    incoming interface. Unclassified traffic goes to class `1:2`.
+    """
+
+    name = None
+    kind = None                 # Kind of the root and of the classes
+    shaping = False             # Do classes limit the bandwidth?
+    tiers = False               # Are classes shared by clients?
+
+    def leaf(self, rate=None, ceil=None):
+        """Class for a given bandwidth.
+
+        :param rate: guaranteed rate
+        :type rate: string
+        :param ceil: maximum rate
+        :type ceil: string
+        :rtype: :class:`Class`
+        """
+        raise NotImplementedError # pragma: no cover
+
+    def parent(self, index=None):
+        """Parent class of the clients.
+
+        :param index: index of the outgoing interface when building
+            classes for an incoming interface, `None` otherwise
+        :return: class ID
+        :rtype: string
+        """
+        if index is None:
+            return "1:1"
+        return "1:a%d" % index
+
+class DRRTree(Tree):
+    """Deficit round robin between clients.
+
+    There is no hierarchy: classes of clients are attached to the
+    root. Bandwidth is limited with TBF (see :func:`plan`).
+    """
+
+    name = kind = "drr"
+
+    def leaf(self, rate=None, ceil=None):
+        return Class("drr", ())
+
+    def parent(self, index=None):
+        return "1:"
+
+class HTBTree(Tree):
+    """Hierarchical token bucket.
+
+    Classes of clients get a guaranteed rate and can borrow unused
+    bandwidth from their parent up to their ceiling.
+    """
+
+    name = kind = "htb"
+    shaping = True
+
+    def leaf(self, rate=None, ceil=None):
+        return Class("htb", ("rate", rate, "ceil", ceil))
+
+class HFSCTree(Tree):
+    """Hierarchical fair service curve.
+
+    Classes of clients get a service curve at their rate and an upper
+    limit at their ceiling.
+    """
+
+    name = kind = "hfsc"
+    shaping = True
+
+    def leaf(self, rate=None, ceil=None):
+        return Class("hfsc", ("sc", "rate", rate, "ul", "rate", ceil))
+
+class CakeTree(DRRTree):
+    """One CAKE queueing discipline for each interface and QoS.
+
+    Clients bound to the same interface and QoS share a tier: a DRR
+    class with a `cake` queueing discipline isolating hosts. The
+    bandwidth of the QoS is shared by the clients of the tier. Binding
+    a client only changes its classification.
+    """
+
+    name = "cake"
+    tiers = True
+
+DRR = DRRTree()
+TREES = dict((tree.name, tree) for tree in [DRR, HTBTree(), HFSCTree(), CakeTree()])
+
+def plan(settings, tree=DRR, link={}):
+    """Compile QoS settings to queueing disciplines.
+
+    Settings are checked: invalid parameters raise :exc:`ValueError`.
+
+    With a tree shaping the traffic, bandwidth is limited by the
+    class of the client: the rate of the bandwidth is guaranteed and
+    the client can borrow up to the ceiling (``ceil``), the rate by
+    default. Without bandwidth, both are the rate of the link. Other
+    TBF parameters are ignored. With a tree of tiers, `cake` is used
+    with the rate of the bandwidth, the ceiling or the rate of the
+    link. Otherwise, TBF is used and the ceiling is ignored.
+
+    :param settings: settings of a QoS (see :attr:`QoS.settings`)
+    :type settings: dictionary
+    :param tree: tree of classes
+    :type tree: :class:`Tree`
+    :param link: rate of the link for each direction
+    :type link: dictionary
+    :return: queueing disciplines for each direction
+    :rtype: :class:`Plan`
+    """
+    def get(what, direction):
+        r = settings.get(what, None)
+        if type(r) is dict:
+            if set(r) - set(['up', 'down']):
+                raise ValueError("unknown direction in %r" % r)
+            return r.get(direction, None)
+        return r
+    directions = {}
+    classes = {}
+    for direction in ('up', 'down'):
+        bw = get("bandwidth", direction)
+        delay = get("netem", direction)
+        ceil = get("ceil", direction)
+        if ceil is not None and not RATE.match(str(ceil)):
+            raise ValueError("invalid ceil %r" % ceil)
+        if tree.shaping:
+            rate = bw is not None and bandwidth(bw)[0][0] or None
+            rate = rate or ceil or link.get(direction) or UNLIMITED
+            classes[direction] = tree.leaf(rate, ceil or rate)
+            bw = None           # No TBF
+        else:
+            classes[direction] = tree.leaf()
+        if tree.tiers:
+            # CAKE for the tier, isolating clients
+            rate = bw is not None and bandwidth(bw)[0][0] or None
+            rate = rate or ceil or link.get(direction) or UNLIMITED
+            isolation = direction == 'up' and ("dual-srchost", "nat") or ("dual-dsthost",)
+            cake = ("bandwidth", rate) + isolation
+            if delay is not None:
+                qdiscs = [Qdisc("1:%(ticket)s0", "%(ticket)s0:", "netem", netem(delay)),
+                          Qdisc("%(ticket)s0:1", "%(ticket)s1:", "cake", cake)]
+            else:
+                qdiscs = [Qdisc("1:%(ticket)s0", "%(ticket)s0:", "cake", cake)]
+        elif bw is not None:
+            # TBF for bandwidth limit...
+            qdiscs = [Qdisc("1:%(ticket)s0", "%(ticket)s0:", "tbf", tbf(bw))]
+            if delay is not None:
+                # ...and netem
+                qdiscs.append(Qdisc("%(ticket)s0:1", "%(ticket)s1:",
+                                    "netem", netem(delay)))
+        elif delay is not None:
+            # Just netem
+            qdiscs = [Qdisc("1:%(ticket)s0", "%(ticket)s0:", "netem", netem(delay))]
+        else:
+            # No QoS: just use SFQ
+            qdiscs = [Qdisc("1:%(ticket)s0", "%(ticket)s0:", "sfq", ())]
+        directions[direction] = tuple(qdiscs)
+    return Plan(classes=Classes(**classes), **directions)
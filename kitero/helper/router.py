@@ -1,9 +1,11 @@
 from netaddr import IPAddress
 
+import sys
 import logging
 logger = logging.getLogger("kitero.helper.router")
 
-from kitero.helper.interface import IBinder, IStatsProvider
+from kitero.helper.interface import IBinder, IStatsProvider, IHintsProvider, \
+    INeighborsProvider, IBatchBinder, IRebinder
 
 class Router(object):
     """A router manages interfaces, QoS settings and clients.
@@ -50,7 +52,8 @@ class Router(object):
             interfaces[i]=Interface(yaml['interfaces'][i]['name'],
                                     yaml['interfaces'][i]['description'],
                                     q,
-                                    yaml['interfaces'][i].get('password', None))
+                                    yaml['interfaces'][i].get('password', None),
+                                    yaml['interfaces'][i].get('bandwidth', None))
         return cls(yaml["clients"], interfaces)
 
     def __init__(self, incoming, interfaces={}):
@@ -71,6 +74,8 @@ class Router(object):
         self._clients = {}
         self._observers = []
         self._stats = None
+        self._hints = []
+        self._neighbors = None
         # Check that we don't have conflicting interfaces
         for i in incoming:
             if i in interfaces:
@@ -93,6 +98,21 @@ class Router(object):
         interface, it will be queried for statistics. Only one stat
         provider is allowed (the last one will be used).
 
+        If the observer provides :class:`IHintsProvider` interface, it
+        will be queried for hints about bound clients.
+
+        If the observer provides :class:`INeighborsProvider`
+        interface, it will be queried for present clients. Only one
+        provider is allowed (the last one will be used).
+
+        If the observer provides :class:`IBatchBinder` interface, it
+        will receive a single `batch` event when several clients are
+        bound or unbound at once.
+
+        If the observer provides :class:`IRebinder` interface, it will
+        receive a `rebind` event when a bound client only changes its
+        QoS settings.
+
         :param observer: observer object to be notified
         """
         if not IBinder.providedBy(observer):
@@ -100,6 +120,10 @@ class Router(object):
         self._observers.append(observer)
         if IStatsProvider.providedBy(observer):
             self._stats = observer
+        if IHintsProvider.providedBy(observer):
+            self._hints.append(observer)
+        if INeighborsProvider.providedBy(observer):
+            self._neighbors = observer
 
     def notify(self, event, **kwargs):
         """Notify all observers.
@@ -110,6 +134,38 @@ class Router(object):
         for obs in self._observers:
             obs.notify(event, self, **kwargs)
 
+    def notify_many(self, events):
+        """Notify all observers of several events.
+
+        Observers providing :class:`IBatchBinder` get one `batch`
+        event. Other observers get each event in turn.
+
+        :param events: list of tuples (event, keyword arguments)
+        :type events: list
+        """
+        for obs in self._observers:
+            if IBatchBinder.providedBy(obs):
+                obs.notify("batch", self, events=events)
+            else:
+                for event, kwargs in events:
+                    obs.notify(event, self, **kwargs)
+
+    def hints(self, client):
+        """Return hints about the binding of a client.
+
+        Hints from all observers implementing :class:`IHintsProvider`
+        are merged. They can be given back to :meth:`bind` to restore
+        the exact same binding.
+
+        :param client: IP address of client
+        :type client: string
+        :return: dictionary of hints
+        """
+        result = {}
+        for provider in self._hints:
+            result.update(provider.hints(client))
+        return result
+
     @property
     def stats(self):
         """Return statistics about each interface.
@@ -148,6 +204,17 @@ class Router(object):
                 result[interface]['down'] = down
         return result
 
+    @property
+    def neighbors(self):
+        """Clients present in the neighbor table.
+
+        This is a set of IP addresses or `None` if no binder is able
+        to tell (see :class:`INeighborsProvider`).
+        """
+        if self._neighbors is None:
+            return None
+        return self._neighbors.neighbors()
+
     @property
     def incoming(self):
         """List of the interfaces where clients are connected"""
@@ -177,7 +244,7 @@ class Router(object):
                                                                      len(self.clients),
                                                                      len(self.interfaces))
 
-    def bind(self, client, interface, qos, password=None):
+    def bind(self, client, interface, qos, password=None, hints=None):
         """Bind a client to an interface and QoS settings.
 
         :param client: IP address of client
@@ -188,6 +255,8 @@ class Router(object):
         :type qos: string
         :param password: supplied password
         :type password: string, int or `None`
+        :param hints: hints from a previous binding (see :meth:`hints`)
+        :type hints: dictionary or `None`
 
         If the provided password is incorrect, `AssertionError` will
         be raised.
@@ -199,15 +268,100 @@ class Router(object):
         if not self.interfaces[interface].check_password(password):
             logger.info("Client %r provided incorrect password for %r" % (client, interface))
             raise AssertionError("Incorrect password provided for interface %r" % interface)
-        # Search the interface
+        q = self._qos(interface, qos)
+        logger.info("bind %r to %r" % (client, (interface, q)))
+        self.notify("bind", client=client, interface=interface, qos=q,
+                    hints=hints or {})
+        self._clients[client] = (interface, q)
+
+    def rebind(self, client, interface, qos, password=None):
+        """Bind a client which may already be bound.
+
+        If the client is already bound to the same interface and QoS
+        settings, nothing happens. If only the QoS settings change,
+        observers providing :class:`IRebinder` get a `rebind` event
+        while other observers get an `unbind` event followed by a
+        `bind` event. Otherwise, the client is unbound and bound
+        again.
+
+        :param client: IP address of client
+        :type client: string
+        :param interface: interface to use for binding
+        :type interface: string
+        :param qos: QoS settings to use
+        :type qos: string
+        :param password: supplied password
+        :type password: string, int or `None`
+
+        If the provided password is incorrect, `AssertionError` will
+        be raised and the current binding is kept.
+        """
+        client = str(IPAddress(client))
+        if client not in self._clients:
+            return self.bind(client, interface, qos, password)
+        if not self.interfaces[interface].check_password(password):
+            logger.info("Client %r provided incorrect password for %r" % (client, interface))
+            raise AssertionError("Incorrect password provided for interface %r" % interface)
+        q = self._qos(interface, qos)
+        current, previous = self._clients[client]
+        if (current, previous) == (interface, q):
+            return              # Nothing to do
+        if current != interface:
+            self.unbind(client)
+            return self.bind(client, interface, q, password)
+        logger.info("rebind %r to %r" % (client, (interface, q)))
+        hints = self.hints(client)
+        for obs in self._observers:
+            if IRebinder.providedBy(obs):
+                obs.notify("rebind", self, client=client, interface=interface,
+                           qos=q, previous=previous)
+            else:
+                obs.notify("unbind", self, client=client)
+                obs.notify("bind", self, client=client, interface=interface,
+                           qos=q, hints=hints)
+        self._clients[client] = (interface, q)
+
+    def _qos(self, interface, qos):
+        """Search a QoS settings of an interface."""
         for q in self.interfaces[interface].qos:
             if q == qos:
-                logger.info("bind %r to %r" % (client, (interface, q)))
-                self.notify("bind", client=client, interface=interface, qos=q)
-                self._clients[client] = (interface, q)
-                return
+                return q
         raise KeyError("No %r for %r" % (qos, interface))
 
+    def bind_many(self, bindings):
+        """Bind several clients at once.
+
+        Observers are notified once for all clients (see
+        :meth:`notify_many`). Passwords are not checked: this is meant
+        for the helper itself (for example, to restore bindings). If a
+        binding is invalid, an exception is raised and no client is
+        bound.
+
+        :param bindings: bindings, each of them being a tuple client,
+           interface, QoS and optionally hints
+        :type bindings: list of tuples
+        """
+        events = []
+        clients = set()
+        for binding in bindings:
+            client, interface, qos = binding[:3]
+            hints = len(binding) > 3 and binding[3] or {}
+            client = str(IPAddress(client))
+            if client in self._clients or client in clients:
+                raise ValueError("Client %r is already bound" % client)
+            if interface not in self.interfaces:
+                raise KeyError("No interface %r" % interface)
+            clients.add(client)
+            events.append(("bind", dict(client=client, interface=interface,
+                                        qos=self._qos(interface, qos),
+                                        hints=hints)))
+        if not events:
+            return
+        logger.info("bind %d clients" % len(events))
+        self.notify_many(events)
+        for event, kwargs in events:
+            self._clients[kwargs['client']] = (kwargs['interface'], kwargs['qos'])
+
     def unbind(self, client):
         """Unbind a client from the router.
 
@@ -220,22 +374,86 @@ class Router(object):
         self.notify("unbind", client=client)
         del self._clients[client]
 
+    def unbind_many(self, clients):
+        """Unbind several clients at once.
+
+        Observers are notified once for all clients (see
+        :meth:`notify_many`). Clients not bound are ignored.
+
+        :param clients: IP addresses of clients
+        :type clients: list of strings
+        """
+        events = []
+        seen = set()
+        for client in clients:
+            if client in self._clients and client not in seen:
+                seen.add(client)
+                events.append(("unbind", dict(client=client)))
+        if not events:
+            return
+        logger.info("unbind %d clients from %r" % (len(events), self))
+        self.notify_many(events)
+        for client in seen:
+            del self._clients[client]
+
+    def reload(self, router):
+        """Use the interfaces of another router.
+
+        Clients bound to an interface or a QoS which does not exist
+        in the new router are unbound. Other clients are kept and
+        observers are notified with a `reload` event so that they can
+        apply the new settings. If an observer fails, the previous
+        interfaces are restored and unbound clients are bound again,
+        with their hints.
+
+        :param router: router with the new configuration
+        :type router: instance of :class:`Router`
+        """
+        if sorted(router.incoming) != sorted(self.incoming):
+            raise ValueError("incoming interfaces cannot be changed (%r != %r)" % (
+                    router.incoming, self.incoming))
+        interfaces = router.interfaces
+        gone = [(client, i, q, self.hints(client))
+                for client, (i, q) in self._clients.items()
+                if i not in interfaces or q not in interfaces[i].qos]
+        self.unbind_many([binding[0] for binding in gone])
+        logger.info("reload %r" % self)
+        previous = self._interfaces
+        self._interfaces = interfaces
+        try:
+            self.notify("reload", previous=previous)
+        except:
+            error = sys.exc_info()
+            self._interfaces = previous
+            try:
+                self.bind_many(gone)
+            except Exception:
+                logger.exception("unable to bind again %d clients", len(gone))
+            raise error[0], error[1], error[2]
+
     def __getstate__(self):
         """When pickling, we only need interfaces, clients and incoming interface"""
         return { "interfaces": self._interfaces,
                  "incoming": self._incoming,
                  "clients": self._clients,
+                 "hints": dict((client, self.hints(client))
+                               for client in self._clients),
                  "observers": self._observers }
     def __setstate__(self, state):
         """Unpickle and rebind clients"""
         self._interfaces = state["interfaces"]
         self._incoming = state["incoming"]
-        self._observers = state["observers"]
+        self._observers = []
+        self._stats = None
+        self._hints = []
+        self._neighbors = None
+        for observer in state["observers"]:
+            self.register(observer)
         self._clients = {}
         # Rebind clients
-        for client in state["clients"]:
-            i, q = state["clients"][client]
-            self.bind(client, i, q)
+        hints = state.get("hints", {})
+        self.bind_many([(client, i, q, hints.get(client))
+                        for client, (i, q) in state["clients"].items()])
 
 class Interface(object):
     """An interface represents an outgoing interface with its QoS settings.
@@ -244,7 +462,9 @@ class Interface(object):
     possible to append a new QoS settings.
     """
 
-    def __init__(self, name, description, qos={}, password=None):
+    _bandwidth = None           # Interfaces pickled without bandwidth
+
+    def __init__(self, name, description, qos={}, password=None, bandwidth=None):
         """Create a new interface.
 
         :param name: name of the outgoing interface
@@ -255,11 +475,15 @@ class Interface(object):
         :type qos: dictionary of :class:`QoS`
         :param password: password protecting the interface
         :type password: string or `None`
+        :param bandwidth: bandwidth of the link, for both directions
+            or as a dictionary with `up` and `down` keys
+        :type bandwidth: string, dictionary or `None`
         """
         self._name = name
         self._description = description
         self._qos = qos
         self._password = password
+        self._bandwidth = bandwidth
 
     @property
     def name(self):
@@ -270,6 +494,9 @@ class Interface(object):
     @property
     def qos(self):
         return self._qos.copy()
+    @property
+    def bandwidth(self):
+        return self._bandwidth
 
     def check_password(self, password):
         """Check the given password is appropriate for this interface.
@@ -289,7 +516,8 @@ class Interface(object):
             return False
         return self.name == other.name and \
             self.description == other.description and \
-            self.qos == other.qos
+            self.qos == other.qos and \
+            self.bandwidth == other.bandwidth
     def __ne__(self, other):
         return not(self == other)
     def __repr__(self):
@@ -1,31 +1,92 @@
-import json
+import os
 import socket
 import threading
-import SocketServer
+import asyncore
+import asynchat
+import collections
+import Queue
+import struct
+import stat
+import pwd
 import logging
 logger = logging.getLogger("kitero.helper.rpc")
 import traceback
 
+from kitero import codec
+
+# Not exported by Python 2 socket module. This is the value for Linux.
+SO_PEERCRED = getattr(socket, "SO_PEERCRED", 17)
+
 def expose(fn):
     """Expose a function to be available as a RPC"""
     fn._kitero_rpc = True
     return fn
 
-class RPCRequestHandler(SocketServer.StreamRequestHandler):
+class RPCRequestHandler(object):
     """Handle one RPC connection.
 
     Should be subclassed to be useful. Only function exposed are
-    exported as RPC. Nothing is done to help to resolve threading
-    issues.
+    exported as RPC. One instance is created for each connection.
+    Requests from several connections, as well as requests with an
+    identifier from the same connection, may be processed at the same
+    time in different threads. Nothing is done to help to resolve
+    threading issues.
     """
 
+    def __init__(self, server, client_address):
+        """Create a new handler for a connection.
+
+        :param server: server that accepted the connection
+        :type server: :class:`RPCServer`
+        :param client_address: address of the remote end
+        """
+        self.server = server
+        self.client_address = client_address
+        self.codec = codec.get("json")
+        self.switch = None      # Codec to use after the current request
+        self.channel = None     # Connection, set by the server
+
     def process(self, data):
         """Process received data.
 
-        :param data: received data in JSON format
-        :type data: JSON string
-        :return: answer
-        :rtype: JSON string
+        The protocol is pretty simple. We wait for a tuple whose first
+        member is the name of the function to invoke and the remaining
+        members are arguments. This tuple is provided as a JSON
+        string on a single line. We execute the function with the
+        given arguments if it is exposed and return the value as a
+        JSON string, on a single line too.
+
+        Moreover, the returned value is wrapped into a dictionary
+        containing the key `status` (whose value is `0` if there were
+        no exceptions and `-1` is an exception was raised), `value`
+        (who contains the returned value) if there was no exception
+        and `exception` which encodes the exception.
+
+        The tuple can also be wrapped into a dictionary with the key
+        `call` and a request identifier as `id`::
+
+            { id: 17, call: ['client', '192.168.1.4'] }
+
+        The identifier is then copied into the answer. Such requests
+        may be processed concurrently and their answers sent in any
+        order, allowing several calls to be multiplexed over one
+        connection. Requests without identifier are processed one
+        after the other.
+
+        If the dictionary also contains `raw` set to `true`, the answer
+        is built with `id` as the first key and the encoded `value`
+        last. The value can then be extracted without decoding it.
+
+        A method may return a :class:`RawJSON` value. With the JSON
+        codec, it is included as is in the answer instead of being
+        encoded again.
+
+        Another codec can be negotiated with :func:`negotiate`.
+
+        :param data: received data, encoded with the current codec
+        :type data: string
+        :return: encoded answer
+        :rtype: string
 
         If there is an exception, the returned JSON string is::
 
@@ -41,83 +102,428 @@ class RPCRequestHandler(SocketServer.StreamRequestHandler):
 
             { status: 0, value: ...}
         """
+        ident = None
+        raw = False
         try:
-            data = json.loads(data)
-            if type(data) is not list:
-                raise ValueError("Invalid RPC: not a list")
-            if not len(data):
-                raise ValueError("Invalid RPC: empty list")
-            function = data[0]
-            args = tuple(data[1:])
-            # We need to find the function
-            method = getattr(self, function)
-            if not hasattr(method, "_kitero_rpc") or \
-                    not method._kitero_rpc:
-                raise ValueError("Method %r is not exported" % method)
-            logger.debug("executing %s%s" % (method, args))
-            result = method(*args)
-            result = json.dumps({'status': 0,
-                                 'value': result})
-            return result
+            data = self.codec.loads(data)
+            if type(data) is dict:
+                if data.get("id") is None:
+                    raise ValueError("Invalid RPC: no request ID")
+                ident = data["id"]
+                raw = data.get("raw", False) and \
+                    isinstance(self.codec, codec.JSONCodec)
+                data = data.get("call")
+            value = self.invoke(data)
+            if isinstance(value, codec.RawJSON):
+                if isinstance(self.codec, codec.JSONCodec):
+                    raw = True
+                else:
+                    value = codec.get("json").loads(value)
+            if raw:
+                if not isinstance(value, codec.RawJSON):
+                    value = self.codec.dumps(value)
+                if ident is None:
+                    return '{"status":0,"value":%s}' % value
+                return '{"id":%s,"status":0,"value":%s}' % (
+                    self.codec.dumps(ident), value)
+            result = {'status': 0,
+                      'value': value}
         except Exception as e:
-            # We got an exception
-            logger.exception("while executing %r, got exception" % data)
-            return json.dumps({'status': -1,
-                               'exception': {
-                        'class': e.__class__.__name__,
-                        'message': str(e),
-                        'traceback': traceback.format_exc()
-                        }})
-
-    def handle(self):
-        """Handle one connection.
+            result = self.failure(data, e)
+        if ident is not None:
+            result['id'] = ident
+        return self.codec.dumps(result)
 
-        The protocol is pretty simple. We wait for a tuple whose first
-        member is the name of the function to invoke and the remaining
-        members are arguments. This tuple is provided as a JSON
-        string. We execute the function with the given arguments if it
-        is exposed and return the value as a JSON string.
+    def invoke(self, data):
+        """Invoke an exposed method.
 
-        Moreover, the returned value is wrapped into a dictionary
-        containing the key `status` (whose value is `0` if there were
-        no exceptions and `-1` is an exception was raised), `value`
-        (who contains the returned value) if there was no exception
-        and `exception` which encodes the exception.
+        :param data: decoded call, a list whose first member is the
+            name of the method and the remaining members are arguments
+        :return: value returned by the method
         """
-        while True:
-            data = self.rfile.readline()
-            if not data:
-                break
-            result = self.process(data)
-            self.wfile.write("%s\n" % result)
+        if type(data) is not list:
+            raise ValueError("Invalid RPC: not a list")
+        if not len(data):
+            raise ValueError("Invalid RPC: empty list")
+        function = data[0]
+        args = tuple(data[1:])
+        # We need to find the function
+        method = getattr(self, function)
+        if not hasattr(method, "_kitero_rpc") or \
+                not method._kitero_rpc:
+            raise ValueError("Method %r is not exported" % method)
+        logger.debug("executing %s%s" % (method, args))
+        return method(*args)
+
+    def failure(self, data, e):
+        """Build the answer for a call that raised an exception.
+
+        Should be called while handling the exception.
+
+        :param data: call that raised the exception
+        :param e: exception raised
+        :return: answer to be encoded
+        """
+        logger.exception("while executing %r, got exception" % data)
+        return {'status': -1,
+                'exception': {
+                'class': e.__class__.__name__,
+                'message': str(e),
+                'traceback': traceback.format_exc()
+                }}
+
+    @expose
+    def batch(self, calls):
+        """Execute several calls at once.
+
+        :param calls: list of calls, each of them being a list whose
+            first member is the name of the function to invoke and the
+            remaining members are arguments
+        :return: list of answers in the same order, each of them being
+            a dictionary with `status` and `value` or `exception` as
+            described in :func:`process`. An exception in one call does
+            not prevent the remaining ones to be executed.
+        """
+        if type(calls) is not list:
+            raise ValueError("Invalid RPC: batch is not a list")
+        answers = []
+        for data in calls:
+            try:
+                value = self.invoke(data)
+                if isinstance(value, codec.RawJSON):
+                    value = codec.get("json").loads(value)
+                answers.append({'status': 0,
+                                'value': value})
+            except Exception as e:
+                answers.append(self.failure(data, e))
+        return answers
+
+    def push(self, message):
+        """Push a message to the remote end.
+
+        The message is sent as is, outside of any answer. This method
+        can be called from any thread.
+
+        :param message: message to encode and send
+        :return: `False` if the connection is closed
+        """
+        if self.channel is None or not self.channel.connected:
+            return False
+        self.server.push(self.channel, self.codec.dumps(message))
+        return True
+
+    @expose
+    def negotiate(self, *names):
+        """Negotiate the codec to use.
+
+        The first available codec is selected. It will be used for the
+        requests following this one. The answer to this request is
+        still encoded with the previous codec. Other requests should
+        not be sent before receiving this answer.
+
+        :param names: names of acceptable codecs, by order of preference
+        :return: name of the selected codec
+        """
+        for name in names:
+            if name in codec.codecs:
+                self.switch = codec.get(name)
+                return name
+        raise ValueError("no acceptable codec in %r" % (names,))
 
     @expose
     def ping(self):
         """Simple example of RPC function"""
         return None
 
-class RPCServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+class RPCChannel(asynchat.async_chat):
+    """One connection to the RPC server.
 
-    allow_reuse_address = True
+    I/O are done by the event loop of the server. Each complete
+    message is queued and handed to the workers of the server.
+    Requests without identifier are handed one at a time: such a
+    request is only processed once the answers for the previous ones
+    have been sent. Requests with an identifier are handed as soon as
+    possible.
+
+    Messages are delimited by a newline unless the codec used by the
+    handler needs them to be prefixed by their length.
+    """
+
+    def __init__(self, server, sock, address):
+        asynchat.async_chat.__init__(self, sock, map=server._map)
+        self.server = server
+        self.handler = server.handler(server, address)
+        self.handler.channel = self
+        self.incoming = []
+        self.pending = collections.deque() # Requests not processed yet
+        self.busy = False                  # Is a serialized request being processed?
+        self.inflight = 0                  # Number of tagged requests being processed
+        self.framing()
+
+    def framing(self):
+        """Setup message delimitation for the current codec."""
+        if self.handler.codec.framed:
+            self.header = True  # Waiting for the length of a message
+            self.set_terminator(4)
+        else:
+            self.set_terminator("\n")
+
+    def collect_incoming_data(self, data):
+        self.incoming.append(data)
+
+    def found_terminator(self):
+        data, self.incoming = "".join(self.incoming), []
+        if self.handler.codec.framed:
+            if self.header:
+                length, = struct.unpack("!I", data)
+                if length:
+                    self.header = False
+                    self.set_terminator(length)
+                    return
+            else:
+                self.header = True
+                self.set_terminator(4)
+        self.pending.append((data, self.handler.codec.ismap(data)))
+        self.process()
+
+    def process(self):
+        """Hand the next requests to the workers if possible."""
+        while not self.busy and self.pending:
+            data, tagged = self.pending[0]
+            if tagged:
+                self.inflight += 1
+            elif self.inflight:
+                break
+            else:
+                self.busy = True
+            self.pending.popleft()
+            self.server.submit(self, data, tagged)
+
+    def deliver(self, message):
+        """Send a message outside of any answer.
+
+        :param message: encoded message
+        """
+        if self.connected:
+            self.push(self.handler.codec.frame(message))
+
+    def answer(self, tagged, result):
+        """Send the answer for a processed request.
+
+        :param tagged: does the request carry an identifier?
+        :param result: answer to send
+        """
+        if tagged:
+            self.inflight -= 1
+        else:
+            self.busy = False
+        if not self.connected:
+            return
+        self.push(self.handler.codec.frame(result))
+        if self.handler.switch is not None:
+            # A new codec has been negotiated
+            self.handler.codec, self.handler.switch = self.handler.switch, None
+            self.framing()
+        self.process()
+
+    def handle_close(self):
+        self.close()
+
+    def handle_error(self):
+        logger.exception("unexpected error with %r" % (self.addr,))
+        self.close()
+
+class RPCWaker(asyncore.file_dispatcher):
+    """Wake up the event loop of a server from another thread."""
+
+    def __init__(self, server):
+        self.server = server
+        self.lock = threading.Lock()
+        rpipe, self.wpipe = os.pipe()
+        asyncore.file_dispatcher.__init__(self, rpipe, map=server._map)
+        os.close(rpipe)
+
+    def wake(self):
+        # The event loop may already be gone: waking it is then a no-op.
+        with self.lock:
+            if self.wpipe is not None:
+                os.write(self.wpipe, "x")
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(512)
+        self.server.flush()
+
+    def handle_error(self):
+        logger.exception("unexpected error while sending answers")
+
+    def close(self):
+        with self.lock:
+            os.close(self.wpipe)
+            self.wpipe = None
+        asyncore.file_dispatcher.close(self)
+
+class RPCServer(asyncore.dispatcher):
+    """RPC server.
+
+    One thread runs an event loop for all the I/O. Requests are
+    processed by a bounded pool of worker threads. Therefore, the
+    number of threads does not grow with the number of connections.
+    """
+
+    workers = 4                 # Default number of workers
+
+    def __init__(self, address, handler=RPCRequestHandler, workers=None,
+                 users=None):
+        """Create a new server.
+
+        :param address: tuple IP and port to listen to or path of a
+            Unix socket
+        :param handler: request handler
+        :param workers: number of worker threads
+        :type workers: integer
+        :param users: users allowed to connect to the Unix socket, in
+            addition to the user running the server
+        :type users: list of user names or UID
+        """
+        asyncore.dispatcher.__init__(self, map={})
+        self.handler = handler
+        self.path = None
+        if isinstance(address, basestring):
+            self.path = address
+            self.uids = set([os.getuid()])
+            for user in users or []:
+                if not isinstance(user, (int, long)):
+                    user = pwd.getpwnam(user).pw_uid
+                self.uids.add(user)
+            if os.path.exists(address) and \
+                    stat.S_ISSOCK(os.stat(address).st_mode):
+                os.unlink(address) # Stale socket
+            self.create_socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.set_reuse_addr()
+        self.bind(address)
+        if self.path is not None:
+            # Anybody can connect, allowed users are checked on accept
+            os.chmod(self.path, 0666)
+        self.listen(socket.SOMAXCONN)
+        self._running = True
+        self._requests = Queue.Queue()          # Requests for workers
+        self._answers = collections.deque()     # Answers for the event loop
+        self._waker = RPCWaker(self)
+        self._workers = []
+        for i in range(workers or self.workers):
+            worker = threading.Thread(target=self._work)
+            worker.setDaemon(True)
+            worker.start()
+            self._workers.append(worker)
 
     @classmethod
-    def run(cls, host, port, handler=RPCRequestHandler):
+    def run(cls, host, port, handler=RPCRequestHandler, workers=None,
+            users=None):
         """Start a new server.
 
-        :param host: IP to listen to
+        :param host: IP to listen to or path of a Unix socket if
+            `port` is `None`
         :type host: string
         :param port: port to listen to
         :type port: integer
         :param handler: request handler
+        :param workers: number of worker threads
+        :type workers: integer
+        :param users: users allowed to connect to the Unix socket
         :return: the server instance started
         """
-        server = cls((host, port), handler)
+        server = cls(port is None and host or (host, port),
+                     handler, workers, users)
         server._thread = threading.Thread(target=server.serve_forever)
         server._thread.setDaemon(True)
         server._thread.start()
-        logger.info("RPC server for %r started on %s:%s" % (handler, host, port))
+        logger.info("RPC server for %r started on %s" % (
+                handler, port is None and host or "%s:%s" % (host, port)))
         return server
 
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is None:
+            return
+        sock, address = pair
+        if self.path is not None:
+            # Check credentials of the peer
+            pid, uid, gid = struct.unpack("3i",
+                sock.getsockopt(socket.SOL_SOCKET, SO_PEERCRED,
+                                struct.calcsize("3i")))
+            if uid not in self.uids:
+                logger.warning("connection from unauthorized user %d "
+                               "(PID %d) refused" % (uid, pid))
+                sock.close()
+                return
+            address = "pid %d, uid %d" % (pid, uid)
+        RPCChannel(self, sock, address)
+
+    def submit(self, channel, data, tagged):
+        """Submit a request to the workers.
+
+        :param channel: channel which received the request
+        :param data: request to process
+        :param tagged: does the request carry an identifier?
+        """
+        self._requests.put((channel, data, tagged))
+
+    def push(self, channel, message):
+        """Send a message outside of any answer.
+
+        This method can be called from any thread.
+
+        :param channel: channel to send the message to
+        :param message: encoded message
+        """
+        self._answers.append((channel, None, message))
+        self._waker.wake()
+
+    def _work(self):
+        """Process requests until the server is stopped."""
+        while True:
+            request = self._requests.get()
+            if request is None:
+                break
+            channel, data, tagged = request
+            self._answers.append((channel, tagged,
+                                  channel.handler.process(data)))
+            self._waker.wake()
+
+    def flush(self):
+        """Send the answers computed by workers.
+
+        This method should only be called from the event loop.
+        """
+        while self._answers:
+            channel, tagged, result = self._answers.popleft()
+            if tagged is None:
+                channel.deliver(result)
+            else:
+                channel.answer(tagged, result)
+
+    def serve_forever(self):
+        """Run the event loop until the server is stopped."""
+        try:
+            while self._running:
+                asyncore.loop(timeout=1, use_poll=True, map=self._map, count=1)
+        finally:
+            for worker in self._workers:
+                self._requests.put(None)
+            asyncore.close_all(map=self._map)
+            if self.path is not None:
+                os.unlink(self.path)
+
+    def shutdown(self):
+        """Ask the event loop to stop."""
+        self._running = False
+        self._waker.wake()
+
     def stop(self):
         """Stop the running server."""
         self.shutdown()
@@ -1,5 +1,8 @@
 import sys
+import json
 import yaml
+import signal
+import hashlib
 import threading
 
 import logging
@@ -9,26 +12,30 @@ logger = logging.getLogger("kitero.helper.service")
 from kitero.helper.router import Router
 from kitero.helper.rpc import RPCServer, RPCRequestHandler, expose
 from kitero.helper.binder import PersistentBinder
+from kitero.helper.publish import Publisher
+from kitero.helper.liveness import Liveness
+from kitero.helper.stats import Rates, select
+from kitero.codec import RawJSON
 import kitero.config
 
-class RouterRPCService(RPCRequestHandler):
-    """Helper service as an RPC service.
+class Catalogue(object):
+    """Catalogue of interfaces and QoS of a router.
 
-    This is the actual class that will be instantiated for each
-    connection and serve RPC queries.
+    Interfaces of a router only change when the configuration is
+    reloaded. The catalogue is therefore built and encoded in JSON
+    only once for each configuration. Its version is a hash of the
+    encoded catalogue.
     """
 
-    router_lock = threading.Lock() # Lock to access the router
-    router = None
+    encoder = json.JSONEncoder(separators=(',', ':'), sort_keys=True)
 
-    @expose
-    def interfaces(self):
-        """Return the dictionary of known interfaces.
+    def __init__(self, router):
+        """Build the catalogue of a router.
 
-        :return: dictionary of interfaces
+        :param router: router to describe
         """
         interfaces = {}
-        for i, interface in self.router.interfaces.items():
+        for i, interface in router.interfaces.items():
             interfaces[i] = {
                 'name': interface.name,
                 'description': interface.description,
@@ -41,16 +48,80 @@ class RouterRPCService(RPCRequestHandler):
                     }
                 qos[q].update(qq.settings)
             interfaces[i]['qos'] = qos
-        return interfaces
+        self.interfaces = RawJSON(self.encoder.encode(interfaces))
+        self.version = hashlib.sha1(self.interfaces).hexdigest()
+        self.encoded = RawJSON('{"version":"%s","interfaces":%s}' % (
+                self.version, self.interfaces))
+
+class RouterRPCService(RPCRequestHandler):
+    """Helper service as an RPC service.
+
+    This is the actual class that will be instantiated for each
+    connection and serve RPC queries.
+    """
+
+    router_lock = threading.RLock() # Lock to access the router
+    router = None
+    router_catalogue = None     # Catalogue of the router
+    service = None
+    publisher = None
+    liveness = None
+    rates = Rates()             # Rates of clients, for stats queries
 
     @expose
-    def stats(self):
+    def batch(self, calls):
+        """Execute several calls at once.
+
+        The lock to the router is held for the whole batch: other
+        connections cannot modify the router between two calls of the
+        batch.
+
+        :param calls: list of calls
+        :return: list of answers
+        """
+        with self.router_lock:
+            return RPCRequestHandler.batch(self, calls)
+
+    @expose
+    def interfaces(self):
+        """Return the dictionary of known interfaces.
+
+        :return: dictionary of interfaces
+        """
+        return self.router_catalogue.interfaces
+
+    @expose
+    def catalogue(self, version=None):
+        """Return the catalogue of interfaces with its version.
+
+        :param version: version of the catalogue already known
+        :type version: string
+        :return: `None` if `version` is the current version, otherwise
+            a dictionary with the version of the catalogue
+            (`version`) and the dictionary of interfaces
+            (`interfaces`)
+        """
+        if version == self.router_catalogue.version:
+            return None
+        return self.router_catalogue.encoded
+
+    @expose
+    def stats(self, query=None):
         """Return the stats for each interface.
 
+        :param query: optional dictionary to select a part of the
+            statistics, with the keys `interface`, `client`,
+            `details`, `top` and `sort`. See :func:`select`. Rates used
+            to sort clients are computed between calls at least one
+            second apart.
         :return: dictionary of stats
         """
         with self.router_lock:
-            return self.router.stats
+            stats = self.router.stats
+            if not query:
+                return stats
+            rates = self.rates.update(stats)
+        return select(stats, rates, **dict((str(k), v) for k, v in query.items()))
 
     @expose
     def client(self, client):
@@ -79,11 +150,59 @@ class RouterRPCService(RPCRequestHandler):
         :type qos: string
         :param password: supplied password
         :type password: string, int or `None`
+
+        If the client is already bound, its binding is changed in
+        place when possible (see :meth:`Router.rebind`).
         """
         with self.router_lock:
-            if client in self.router.clients:
-                self.router.unbind(client)
-            self.router.bind(client, interface, qos, password)
+            self.router.rebind(client, interface, qos, password)
+
+    @expose
+    def seq(self):
+        """Return the sequence number of the last event published.
+
+        Used in a batch, it tells which events the other answers of
+        the batch are consistent with (see :meth:`subscribe`).
+
+        :return: sequence number
+        :rtype: integer
+        """
+        with self.router_lock:
+            return self.publisher.seq
+
+    @expose
+    def subscribe(self):
+        """Subscribe to changes of the router.
+
+        Once subscribed, events are pushed on this connection as they
+        happen. See :class:`Publisher` for their format. Events with a
+        sequence number lower or equal to the one of the snapshot
+        should be ignored. They may be received before the snapshot.
+
+        :return: a snapshot of the router with the sequence number
+            (`seq`), the bound clients (`clients`), the statistics
+            (`stats`) and the version of the catalogue (`catalogue`)
+        """
+        with self.router_lock:
+            snapshot = self.publisher.subscribe(self)
+            snapshot['catalogue'] = self.router_catalogue.version
+            return snapshot
+
+    @expose
+    def heartbeat(self, client, timeout=None):
+        """Tell that a client is alive.
+
+        A bound client is unbound when no heartbeat is received for
+        `timeout` seconds.
+
+        :param client: IP address of the client
+        :type client: string
+        :param timeout: number of seconds the client stays alive,
+            ``expire`` directive of the configuration if `None`
+        :return: `True` if the client is bound
+        """
+        with self.router_lock:
+            return self.liveness.heartbeat(client, timeout)
 
     @expose
     def unbind_client(self, client):
@@ -96,6 +215,32 @@ class RouterRPCService(RPCRequestHandler):
             if client in self.router.clients:
                 self.router.unbind(client)
 
+    @expose
+    def unbind_clients(self, clients=None):
+        """Unbind several clients at once.
+
+        :param clients: IP addresses of the clients, all bound clients
+           if `None`
+        :type clients: list of strings
+        :return: number of unbound clients
+        """
+        with self.router_lock:
+            if clients is None:
+                clients = self.router.clients.keys()
+            count = len(set(clients) & set(self.router.clients))
+            self.router.unbind_many(clients)
+            return count
+
+    @expose
+    def reload(self):
+        """Reload the configuration of the router.
+
+        See :meth:`Service.reload`.
+
+        :return: version of the catalogue
+        """
+        return self.service.reload()
+
 class Service(object):
     """Helper service.
 
@@ -108,6 +253,8 @@ class Service(object):
     :classmethod:`run` class method.
     """
 
+    source = None               # Configuration file
+
     def __init__(self, config, router):
         """Create helper service.
 
@@ -115,8 +262,11 @@ class Service(object):
         :param router: router that should be serviced
         """
         # Create RPC service
+        self.router = router
         config = kitero.config.merge(config)
         config = config['helper']
+        # Let binders set themselves up and check QoS settings
+        router.notify("start", config=config)
         # Bind persistency module
         save = config.get("save", None)
         if save is not None:
@@ -126,15 +276,64 @@ class Service(object):
             except IOError as e:
                 logger.warning("unable to restore previous configuration: %s", e)
             router.register(save)
+        # Publish changes to subscribers
+        self.publisher = Publisher(router, RouterRPCService.router_lock,
+                                   config['sample'])
+        router.register(self.publisher)
+        self.publisher.start()
+        # Unbind clients that are not alive anymore
+        self.liveness = Liveness(router, RouterRPCService.router_lock,
+                                 config['expire'], config['idle'])
+        router.register(self.liveness)
+        self.liveness.start()
+        RouterRPCService.service = self
         RouterRPCService.router = router
-        self.server = RPCServer.run(config['listen'],
-                                    config['port'],
-                                    handler=RouterRPCService)
-        logger.info('create RPC server on %s:%d',
-                    config['listen'], config['port'])
+        RouterRPCService.router_catalogue = Catalogue(router)
+        RouterRPCService.publisher = self.publisher
+        RouterRPCService.liveness = self.liveness
+        if config.get('socket') is not None:
+            self.server = RPCServer.run(config['socket'], None,
+                                        handler=RouterRPCService,
+                                        workers=config['workers'],
+                                        users=config.get('users'))
+            logger.info('create RPC server on %s', config['socket'])
+        else:
+            self.server = RPCServer.run(config['listen'],
+                                        config['port'],
+                                        handler=RouterRPCService,
+                                        workers=config['workers'])
+            logger.info('create RPC server on %s:%d',
+                        config['listen'], config['port'])
+
+    def reload(self):
+        """Reload the configuration of the router.
+
+        The configuration file is read again and only the changes are
+        applied to the router (see :meth:`Router.reload`). Clients
+        bound to a removed interface or QoS are unbound. When the
+        catalogue changes, subscribers get a `catalogue` event with
+        the new version.
+
+        :return: version of the catalogue
+        """
+        if self.source is None:
+            raise ValueError("no configuration file to reload")
+        logger.info("reload configuration file %r" % self.source)
+        config = yaml.safe_load(file(self.source))
+        config = kitero.config.merge(config)
+        router = Router.load(config['router'])
+        with RouterRPCService.router_lock:
+            self.router.reload(router)
+            catalogue = Catalogue(self.router)
+            if catalogue.version != RouterRPCService.router_catalogue.version:
+                RouterRPCService.router_catalogue = catalogue
+                self.publisher.publish("catalogue", version=catalogue.version)
+            return catalogue.version
 
     def stop(self):
         """Stop the helper service."""
+        self.liveness.stop()
+        self.publisher.stop()
         self.server.stop()
         self.server = None
 
@@ -149,7 +348,7 @@ class Service(object):
 
         This method should be used to instantiate
         :class:`Service`. The configuration file must be provided as
-        an argument.
+        an argument. It is reloaded on ``SIGHUP`` (see :meth:`reload`).
 
         :param args: list of command line arguments
         :type args: list of strings
@@ -211,6 +410,13 @@ class Service(object):
                 router.register(binder)
             # Start service
             s = cls(config, router)
+            s.source = args[0]
+            def reload(signum, frame): # pragma: no cover
+                try:
+                    s.reload()
+                except Exception:
+                    logger.exception("unable to reload configuration")
+            signal.signal(signal.SIGHUP, reload)
             s.wait()
         except Exception as e:
             logger.exception("unhandled error received")
@@ -0,0 +1,87 @@
+import time
+import heapq
+
+class Rates(object):
+    """Rates of each client computed from successive statistics.
+
+    Rates are computed between two samples at least :attr:`interval`
+    seconds apart. Until then, the previous rates are kept.
+    """
+
+    def __init__(self, interval=1):
+        """Create a new rate estimator.
+
+        :param interval: minimal time between two samples in seconds
+        """
+        self.interval = interval
+        self.previous = None    # Time and statistics of the previous sample
+        self.rates = {}
+
+    def update(self, stats, now=None):
+        """Update rates with new statistics.
+
+        :param stats: statistics, as returned by :attr:`Router.stats`
+        :param now: time of the statistics, the current time by default
+        :return: a dictionary mapping each interface to a dictionary
+            mapping each client to its rates (`up` and `down`) in
+            bytes per second
+        """
+        if now is None:
+            now = time.time()
+        if self.previous is not None:
+            then, previous = self.previous
+            if now - then < self.interval:
+                return self.rates
+            rates = {}
+            for interface in stats:
+                old = previous.get(interface, {}).get('details', {})
+                rates[interface] = {}
+                for client, counters in stats[interface].get('details', {}).items():
+                    rates[interface][client] = rate = {}
+                    for counter in ('up', 'down'):
+                        if counter in counters and counter in old.get(client, {}):
+                            rate[counter] = (counters[counter] -
+                                             old[client][counter]) / (now - then)
+            self.rates = rates
+        self.previous = (now, stats)
+        return self.rates
+
+def select(stats, rates={}, interface=None, client=None,
+           details=True, top=None, sort="down"):
+    """Select a part of the statistics.
+
+    :param stats: statistics, as returned by :attr:`Router.stats`
+    :param rates: rates of each client, as returned by :meth:`Rates.update`
+    :param interface: only keep this interface
+    :param client: only keep the details of this client
+    :param details: keep the details of all clients when neither
+        `client` nor `top` is specified
+    :param top: only keep the details of the `top` clients with the
+        highest rate
+    :param sort: rate to use for `top`, `up` or `down`
+    :return: selected statistics
+    """
+    if sort not in ('up', 'down'):
+        raise ValueError("cannot sort by %r" % sort)
+    if top is not None and top < 0:
+        raise ValueError("invalid number of clients: %r" % top)
+    result = {}
+    for name, current in stats.items():
+        if interface is not None and name != interface:
+            continue
+        result[name] = dict((k, v) for k, v in current.items() if k != 'details')
+        clients = current.get('details', {})
+        if client is None and top is None:
+            if details:
+                result[name]['details'] = clients
+            continue
+        selected = {}
+        if top is not None:
+            r = rates.get(name, {})
+            for c in heapq.nlargest(top, clients,
+                                    key=lambda c: r.get(c, {}).get(sort, 0)):
+                selected[c] = clients[c]
+        if client in clients:
+            selected[client] = clients[client]
+        result[name]['details'] = selected
+    return result
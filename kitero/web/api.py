@@ -1,14 +1,23 @@
 import time
+import json
 import threading
+import collections
 import flask
+import logging
+logger = logging.getLogger("kitero.web.api")
 
 from kitero.web import app
-from kitero.web.decorators import jsonify, cache
+from kitero.web.decorators import jsonify, encode, conditional, cache
 from kitero.web.rpc import RPCClient, RPCException
+from kitero.web.replica import replica
+from kitero import codec
 
-def status(client):
-    """Return the status of the given client"""
-    current = RPCClient.call("client", client)
+def status(client, current):
+    """Return the status of the given client
+
+    :param client: IP address of the client
+    :param current: current binding as returned by `client` RPC call
+    """
     if current is None: # Not bound
         return { 'ip': client }
     return {
@@ -18,25 +27,261 @@ def status(client):
         }
 
 class Ping(object):
+    """Send heartbeats of alive clients to the helper.
+
+    The helper unbinds clients without heartbeat for ``EXPIRE``
+    seconds. Heartbeats are queued and sent in a batch, either with
+    the next request to the helper or by a background thread every
+    :attr:`interval` seconds.
+    """
+    interval = 1
+
     def __init__(self):
-        self.clients = {}
+        self.pending = set()    # Clients with a pending heartbeat
         self.lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
 
     def refresh(self, client):
-        self.clients[client] = time.time()
+        """Tell that a client is alive.
+
+        The background thread is started if needed.
+
+        :param client: IP address of the client
+        """
+        with self.lock:
+            self.pending.add(client)
+        if self._thread is None:
+            self.start()
+
+    def heartbeats(self):
+        """Return pending heartbeats.
+
+        They are not pending anymore.
+
+        :return: RPC calls to send the heartbeats
+        """
+        with self.lock:
+            pending, self.pending = self.pending, set()
+        return [("heartbeat", client, app.config['EXPIRE'])
+                for client in pending]
+
+    def flush(self):
+        """Send pending heartbeats.
+
+        If they cannot be sent, they are sent again later.
+        """
+        calls = self.heartbeats()
+        if not calls:
+            return
+        try:
+            RPCClient.batch(*calls)
+        except (IOError, RPCException) as e:
+            logger.warning("unable to send %d heartbeats: %s", len(calls), e)
+            self.requeue(calls)
+
+    def requeue(self, calls):
+        """Make heartbeats pending again.
+
+        :param calls: RPC calls returned by :meth:`heartbeats`
+        """
+        with self.lock:
+            self.pending.update(call[1] for call in calls)
+
+    def start(self):
+        """Start to send heartbeats in the background."""
+        with self.lock:
+            if self._thread is not None:
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run)
+            self._thread.setDaemon(True)
+            self._thread.start()
 
-    def expire(self):
+    def stop(self):
+        """Stop to send heartbeats and forget pending ones."""
         with self.lock:
-            clients = self.clients.keys()
-            current = time.time()
-            for client in clients:
-                if current - self.clients[client] > app.config['EXPIRE']:
-                    # Expiration of `client`
-                    del self.clients[client]
-                    RPCClient.call("unbind_client", client)
+            thread, self._thread = self._thread, None
+            self._stop.set()
+        if thread is not None:
+            thread.join()
+        self.pending = set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.flush()
+            except Exception: # pragma: no cover
+                logger.exception("unable to send heartbeats")
 
 ping = Ping()
 
+def replicated():
+    """Tell if the local replica of the helper can be used.
+
+    The replica is started on first use if enabled.
+    """
+    if not app.config.get('REPLICA'):
+        return False
+    replica.start()
+    return replica.ready
+
+class Catalogue(object):
+    """Local copy of the catalogue of interfaces of the helper.
+
+    The catalogue is kept encoded in JSON along with its version. When
+    the replica is used, its version is known without asking the
+    helper. Otherwise, the helper is asked at most every
+    :attr:`interval` seconds if the catalogue has changed.
+    """
+    interval = 10
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget the catalogue."""
+        self.version = None
+        self.interfaces = None
+        self.checked = None
+
+    def refresh(self):
+        """Refresh the catalogue if needed.
+
+        :return: current version of the catalogue
+        """
+        with self.lock:
+            now = time.time()
+            if replicated():
+                if replica.catalogue == self.version:
+                    return self.version
+            elif self.checked is not None and \
+                    now - self.checked < self.interval:
+                return self.version
+            answer = RPCClient.call("catalogue", self.version)
+            if answer is not None:
+                self.interfaces = codec.RawJSON(
+                    codec.get("json").dumps(answer['interfaces']))
+                self.version = answer['version']
+            self.checked = now
+            return self.version
+
+catalogue = Catalogue()
+
+def diff(old, new):
+    """Return the counters that changed between two samples.
+
+    :param old: previous sample
+    :param new: current sample
+    :return: dictionary with the counters of `new` that are different
+        in `old`. Nested dictionaries only contain what changed. The
+        value of a removed key is `None`.
+    """
+    result = {}
+    for key, value in new.items():
+        previous = old.get(key)
+        if type(value) is dict and type(previous) is dict:
+            changes = diff(previous, value)
+            if changes:
+                result[key] = changes
+        elif value != previous or key not in old:
+            result[key] = value
+    for key in old:
+        if key not in new:
+            result[key] = None
+    return result
+
+class Sample(object):
+    """A sample of the statistics of the helper."""
+
+    def __init__(self, seq, time, raw):
+        self.seq = seq
+        self.time = time
+        self.raw = raw          # Statistics, encoded in JSON
+        self._value = None
+
+    @property
+    def value(self):
+        """Decoded statistics."""
+        if self._value is None:
+            self._value = json.loads(self.raw)
+        return self._value
+
+class Samples(object):
+    """Recent samples of the statistics of the helper.
+
+    Each new sample gets a sequence number. Sequence numbers start
+    from the current time in milliseconds to keep increasing when the
+    web service is restarted. When the replica is used, a new sample
+    is available each time the helper pushes one. Otherwise, the
+    helper is asked at most every :attr:`interval` seconds.
+    """
+    interval = 1
+    keep = 10                   # Number of samples to keep
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget all samples."""
+        self.seq = int(time.time() * 1000)
+        self.history = collections.deque(maxlen=self.keep)
+        self.deltas = {}        # Encoded changes since a given sample
+        self.fetched = None
+
+    def refresh(self):
+        """Grab a new sample if needed.
+
+        :return: sequence number of the last sample
+        """
+        with self.lock:
+            now = time.time()
+            if replicated():
+                raw = replica.stats
+            elif self.fetched is None or now - self.fetched >= self.interval:
+                raw = RPCClient.raw("stats")
+                self.fetched = now
+            else:
+                return self.seq
+            if not self.history or self.history[-1].raw != raw:
+                self.seq += 1
+                self.history.append(Sample(self.seq, now, raw))
+                self.deltas = {}
+            return self.seq
+
+    def last(self):
+        """Return the last sample.
+
+        :rtype: :class:`Sample`
+        """
+        with self.lock:
+            return self.history[-1]
+
+    def delta(self, since):
+        """Return the changes since a given sample.
+
+        :param since: sequence number of the sample known by the client
+        :return: a tuple with the last sample and the changes encoded
+            in JSON
+        """
+        with self.lock:
+            last = self.history[-1]
+            if since not in self.deltas:
+                base = [s for s in self.history if s.seq == since]
+                if base:
+                    stats = codec.get("json").dumps(diff(base[0].value,
+                                                         last.value))
+                else:
+                    since, stats = None, last.raw
+                self.deltas[since] = codec.RawJSON(
+                    '{"seq":%d,"since":%s,"stats":%s}' % (
+                        last.seq, json.dumps(since), stats))
+            return last, self.deltas[since]
+
+samples = Samples()
+
 @app.route("/api/1.0/current", methods=['GET'])
 @jsonify
 def current():
@@ -56,15 +301,27 @@ def current():
     are absent of the answer.
     """
     client = flask.request.remote_addr
-    ping.expire()
     ping.refresh(client)
-    return status(client)
+    if replicated():
+        return status(client, replica.client(client))
+    calls = ping.heartbeats()
+    try:
+        answers = RPCClient.batch(*(calls + [("client", client)]))
+    except (IOError, RPCException):
+        ping.requeue(calls)     # Sent again later
+        raise
+    return status(client, answers[-1])
 
 @app.route("/api/1.0/interfaces", methods=['GET'])
+@conditional(catalogue.refresh)
 @jsonify
 def interfaces():
     """Return the list of available interfaces.
 
+    The answer carries the version of the catalogue as an entity
+    tag. A client providing it in ``If-None-Match`` gets a 304 answer
+    while the catalogue is unchanged.
+
     The returned value exhibits the following format::
 
       {
@@ -97,12 +354,42 @@ def interfaces():
         }
       }
     """
-    interfaces = RPCClient.call("interfaces")
-    return interfaces
+    return catalogue.interfaces
+
+def scope(args):
+    """Build a query for a part of the statistics.
+
+    :param args: arguments of the request
+    :return: query for the `stats` RPC call, empty if the whole
+        statistics are requested
+    """
+    query = {}
+    if 'interface' in args:
+        query['interface'] = args['interface']
+    if 'client' in args:
+        query['client'] = args['client'] or flask.request.remote_addr
+    if 'details' in args:
+        query['details'] = args['details'].lower() not in ('false', 'no', '0')
+    if 'top' in args:
+        query['top'] = args.get('top', type=int)
+        if query['top'] is None or query['top'] < 0:
+            flask.abort(400)
+    if 'sort' in args:
+        query['sort'] = args['sort']
+        if query['sort'] not in ('up', 'down'):
+            flask.abort(400)
+    return query
+
+@cache(1, stale=1)
+def scoped(*query):
+    """Request a part of the statistics from the helper.
+
+    :param query: items of the query built by :func:`scope`
+    :return: statistics encoded in JSON
+    """
+    return RPCClient.raw("stats", dict(query))
 
 @app.route("/api/1.0/stats", methods=['GET'])
-@cache(1)
-@jsonify
 def stats():
     """Return statistics for each interface.
 
@@ -118,10 +405,54 @@ def stats():
                 }
             }}
 
-    All fields are optional and may not appear.
+    All fields are optional and may not appear. The time of the
+    answer is the time of the sample. The sequence number of the
+    sample is sent as an entity tag.
+
+    With the ``since`` parameter, only the counters that changed since
+    the sample with the given sequence number are returned::
+
+            {"seq": 1312127745919,
+             "since": 1312127745917,
+             "stats": {"eth1": {
+                "up": 47,
+                "details": {
+                  "172.16.10.14": {"up": 2},
+                  "172.16.10.15": null
+                }}}}
+
+    A removed counter is `null`. When the sample is not known anymore,
+    ``since`` is `null` and ``stats`` contains the whole statistics.
+
+    A part of the statistics can be requested with the following
+    parameters. The helper only sends this part.
+
+     - ``interface``: only return this interface.
+     - ``client``: only return the details of this client. Without
+       value, the client making the request is used.
+     - ``details=false``: do not return the details of the clients.
+     - ``top``: only return the details of the given number of
+       clients with the highest rate.
+     - ``sort``: rate used by ``top``, ``up`` or ``down`` (the
+       default).
+
+    Those answers are neither sampled nor tagged but they are cached
+    for one second.
     """
-    stats = RPCClient.call("stats")
-    return stats
+    query = scope(flask.request.args)
+    if query:
+        return encode(scoped(*sorted(query.items())))
+    return sampled()
+
+@conditional(samples.refresh)
+def sampled():
+    """Return the last sample of the statistics or its changes."""
+    if 'since' in flask.request.args:
+        sample, value = samples.delta(flask.request.args.get('since', type=int))
+    else:
+        sample = samples.last()
+        value = sample.raw
+    return encode(value, sample.time)
 
 @app.route("/api/1.0/bind/<interface>/<qos>", methods=['GET', 'POST', 'PUT'])
 @jsonify
@@ -140,14 +471,18 @@ def bind(interface, qos):
     auth   = flask.request.authorization
     password = auth and auth.username or None
     try:
-        RPCClient.call("bind_client", client, interface, qos, password)
+        _, current, seq = RPCClient.batch(
+            ("bind_client", client, interface, qos, password),
+            ("client", client),
+            ("seq",))
     except RPCException as e:
         if e.exception == "AssertionError":
             # The password is incorrect or not provided
             flask.abort(401)
         raise
     ping.refresh(client)
-    return status(client)
+    replica.update(client, current, seq)
+    return status(client, current)
 
 @app.route("/api/1.0/unbind", methods=['GET', 'POST', 'PUT'])
 @jsonify
@@ -157,5 +492,8 @@ def unbind():
     The result of this function is the same as :func:`current`.
     """
     client = flask.request.remote_addr
-    RPCClient.call("unbind_client", client)
-    return status(client)
+    _, current, seq = RPCClient.batch(("unbind_client", client),
+                                      ("client", client),
+                                      ("seq",))
+    replica.update(client, current, seq)
+    return status(client, current)
@@ -1,20 +1,73 @@
 import json
 import time
+import threading
+import collections
 from functools import wraps
 from flask import request, Response, render_template
 
+from kitero.codec import RawJSON
+
+encoder = json.JSONEncoder(separators=(',', ':'))
+
+def encode(result, now=None):
+    """Build a JSON answer.
+
+    The answer is compact unless the ``pretty`` parameter is
+    present. A value already encoded as :class:`RawJSON` is included
+    as is.
+
+    :param result: value to send
+    :param now: time of the answer, the current time by default
+    :return: response to send
+    """
+    if now is None:
+        now = time.time()
+    if 'pretty' in request.args:
+        if isinstance(result, RawJSON):
+            result = json.loads(result)
+        result = json.dumps({ 'status': 0,
+                              'time': now,
+                              'value': result }, indent=2)
+    elif isinstance(result, RawJSON):
+        result = '{"status":0,"time":%s,"value":%s}' % (
+            encoder.encode(now), result)
+    else:
+        result = encoder.encode({ 'status': 0,
+                                  'time': now,
+                                  'value': result })
+    return Response("%s\n" % result,
+                    mimetype='application/json')
+
 def jsonify(f):
+    """Encode the returned value in JSON with :func:`encode`."""
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        result = f(*args, **kwargs)
-        result = { 'status': 0,
-                   'time': time.time(),
-                   'value': result }
-        return Response("%s\n" % json.dumps(result,
-                                            indent=None if request.is_xhr else 2),
-                        mimetype='application/json')
+        return encode(f(*args, **kwargs))
     return decorated_function
 
+def conditional(version):
+    """Answer conditional requests with an entity tag.
+
+    :param version: function returning the current version of the
+        answer. When the client already has this version, the
+        decorated function is not called and a 304 answer is sent
+        instead. The entity tag is weak since the answer contains the
+        current time.
+    """
+    def decorate(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            tag = str(version())
+            if request.if_none_match.contains_weak(tag):
+                response = Response(status=304)
+            else:
+                response = f(*args, **kwargs)
+            response.set_etag(tag, weak=True)
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+        return decorated_function
+    return decorate
+
 def templated(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -24,19 +77,99 @@ def templated(f):
         return render_template(template_name, **ctx)
     return decorated_function
 
-def cache(timeout=5):
-    def decorate(f):
-        @wraps(f)
-        def decorated_function(*args, **kwargs):
+class Entry(object):
+    """Entry of a :class:`Cache`."""
+
+    def __init__(self):
+        self.value = None
+        self.time = None        # When the value was computed
+        self.error = None       # Exception raised by the last computation
+        self.computing = False  # Is a new value being computed?
+        self.ready = threading.Event() # Set when the computation is done
+
+class Cache(object):
+    """Cache of the values returned by a function.
+
+    Values are cached for each set of arguments during `timeout`
+    seconds. Only `size` values are kept, the least recently used
+    ones being evicted first. For each set of arguments, only one
+    thread computes a new value. The other threads wait for it or,
+    if the previous value expired less than `stale` seconds ago, get
+    this previous value.
+
+    Each process has its own cache.
+    """
+
+    def __init__(self, f, timeout, size, stale):
+        self.f = f
+        self.timeout = timeout
+        self.size = size
+        self.stale = stale
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.counters = dict(hits=0, misses=0, stale=0, waits=0, evictions=0)
+
+    def __call__(self, *args, **kwargs):
+        key = (args, tuple(sorted(kwargs.items())))
+        with self.lock:
             now = time.time()
-            if f._cache is None:
-                value, last = f(*args, **kwargs), now
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                entry = Entry()
+            self.entries[key] = entry # Most recently used
+            age = None
+            if entry.time is not None:
+                age = now - entry.time
+            if age is not None and age <= self.timeout:
+                self.counters['hits'] += 1
+                return entry.value
+            if entry.computing:
+                if age is not None and age <= self.timeout + self.stale:
+                    self.counters['stale'] += 1
+                    return entry.value
+                self.counters['waits'] += 1
+                wait = True
             else:
-                value, last = f._cache
-                if now - last > timeout:
-                    value, last = f(*args, **kwargs), now
-            f._cache = (value, last)
-            return value
-        f._cache = None
-        return decorated_function
+                self.counters['misses'] += 1
+                entry.computing = True
+                entry.ready.clear()
+                wait = False
+        if wait:
+            entry.ready.wait()
+            if entry.error is not None:
+                raise entry.error
+            return entry.value
+        try:
+            value = self.f(*args, **kwargs)
+        except Exception as e:
+            with self.lock:
+                entry.error, entry.computing = e, False
+                entry.ready.set()
+            raise
+        with self.lock:
+            entry.value, entry.time, entry.error = value, time.time(), None
+            entry.computing = False
+            entry.ready.set()
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.counters['evictions'] += 1
+        return value
+
+    def invalidate(self):
+        """Forget all cached values."""
+        with self.lock:
+            self.entries.clear()
+
+def cache(timeout=5, size=128, stale=0):
+    """Cache the values returned by a function.
+
+    See :class:`Cache`.
+
+    :param timeout: number of seconds a value is valid
+    :param size: maximum number of cached values
+    :param stale: number of seconds an expired value may still be
+        returned while a new one is computed
+    """
+    def decorate(f):
+        return wraps(f)(Cache(f, timeout, size, stale))
     return decorate
@@ -0,0 +1,221 @@
+import threading
+import Queue
+import flask
+import logging
+logger = logging.getLogger("kitero.web.events")
+
+from kitero.web import app
+from kitero.web.api import samples, replicated, status, ping
+from kitero.web.rpc import RPCClient
+from kitero.web.replica import replica
+from kitero import codec
+
+def message(event, data):
+    """Encode a server-sent event.
+
+    :param event: name of the event
+    :param data: data of the event, to be encoded in JSON
+    :return: encoded event
+    """
+    return "event: %s\ndata: %s\n\n" % (event, codec.get("json").dumps(data))
+
+class Subscriber(object):
+    """A client listening to events.
+
+    Events are queued in a bounded queue. When the queue is full, the
+    oldest event is dropped.
+    """
+
+    def __init__(self, client, size):
+        """Create a new subscriber.
+
+        :param client: IP address of the client
+        :param size: maximum number of queued events
+        """
+        self.client = client
+        self.queue = Queue.Queue(size)
+        self.dropped = 0        # Number of dropped events
+
+    def put(self, event):
+        """Queue an event.
+
+        :param event: encoded event
+        """
+        while True:
+            try:
+                self.queue.put_nowait(event)
+                return
+            except Queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except Queue.Empty: # pragma: no cover
+                    pass
+
+    def get(self, timeout):
+        """Get the next event.
+
+        :param timeout: maximum time to wait in seconds
+        :return: encoded event or `None` if there is none
+        """
+        try:
+            return self.queue.get(timeout=timeout)
+        except Queue.Empty:
+            return None
+
+class Broadcaster(object):
+    """Send events to subscribers.
+
+    A single thread samples the statistics every :attr:`interval`
+    seconds, computes the rates of each interface and sends them to
+    all subscribers. The sample is taken from the replica when enabled.
+    Binding changes are sent to the subscribers of the affected
+    client only.
+    """
+    interval = 5
+    keepalive = 15              # Send a comment after this many idle seconds
+    size = 16                   # Maximum number of queued events
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = []
+        self.last = None        # Last sample used to compute rates
+        self._stop = threading.Event()
+        self._thread = None
+        replica.listeners.append(self.binding)
+
+    def subscribe(self, client):
+        """Subscribe to events.
+
+        The thread sending statistics is started if needed.
+
+        :param client: IP address of the client
+        :return: a new subscriber
+        :rtype: :class:`Subscriber`
+        """
+        subscriber = Subscriber(client, self.size)
+        with self.lock:
+            self.subscribers.append(subscriber)
+            if self._thread is None:
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run)
+                self._thread.setDaemon(True)
+                self._thread.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        """Unsubscribe from events.
+
+        :param subscriber: subscriber to remove
+        """
+        with self.lock:
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+
+    def publish(self, event, client=None):
+        """Send an event to subscribers.
+
+        :param event: encoded event
+        :param client: only send the event to subscribers for this
+            client
+        """
+        with self.lock:
+            subscribers = self.subscribers[:]
+        for subscriber in subscribers:
+            if client is None or subscriber.client == client:
+                subscriber.put(event)
+
+    def binding(self, client, binding):
+        """Send the new binding of a client.
+
+        :param client: IP address of the client
+        :param binding: tuple (interface, qos) or `None`
+        """
+        self.publish(message("status", status(client, binding)), client)
+
+    def sample(self):
+        """Send the rates of each interface since the last sample."""
+        samples.refresh()
+        sample = samples.last()
+        last, self.last = self.last, sample
+        if last is not None and last.seq == sample.seq:
+            return
+        rates = {}
+        for interface, stats in sample.value.items():
+            rates[interface] = rate = dict(clients=stats.get('clients', 0))
+            for counter in ('up', 'down'):
+                rate[counter] = None
+                if last is None or counter not in stats:
+                    continue
+                previous = last.value.get(interface, {}).get(counter)
+                if previous is not None and sample.time > last.time:
+                    rate[counter] = (stats[counter] - previous) / \
+                        (sample.time - last.time)
+        self.publish(message("stats", dict(seq=sample.seq,
+                                           time=sample.time,
+                                           interfaces=rates)))
+
+    def stop(self):
+        """Stop to send statistics."""
+        with self.lock:
+            thread, self._thread = self._thread, None
+            self._stop.set()
+        if thread is not None:
+            thread.join()
+        self.last = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            if not self.subscribers:
+                continue
+            try:
+                self.sample()
+            except Exception:
+                logger.exception("unable to sample statistics")
+
+broadcaster = Broadcaster()
+
+@app.route("/api/1.0/events", methods=['GET'])
+def events():
+    """Stream events for the client.
+
+    Events are sent as server-sent events. The first event is the
+    current binding of the client. The following events are:
+
+     - ``status``: the binding of the client has changed. Data is the
+       same as the value returned by :func:`current`.
+     - ``stats``: the rates of each interface. Data exhibits the
+       following format::
+
+         {"seq": 1312127745919,
+          "time": 1312127745.918855,
+          "interfaces": {
+            "eth1": {"clients": 5, "up": 453.4, "down": 4578.1}
+          }}
+
+       Rates are in bytes per second. They are `null` when unknown.
+
+    While the stream is open, the client is considered alive.
+    """
+    client = flask.request.remote_addr
+    subscriber = broadcaster.subscribe(client) # Before the lookup to miss nothing
+    try:
+        if replicated():
+            current = replica.client(client)
+        else:
+            current = RPCClient.call("client", client)
+    except:
+        broadcaster.unsubscribe(subscriber)
+        raise
+    def stream():
+        try:
+            yield "retry: 5000\n%s" % message("status", status(client, current))
+            while True:
+                ping.refresh(client)
+                event = subscriber.get(broadcaster.keepalive)
+                yield event or ": keepalive\n\n"
+        finally:
+            broadcaster.unsubscribe(subscriber)
+    return flask.Response(stream(),
+                          mimetype="text/event-stream",
+                          headers={"Cache-Control": "no-cache"})
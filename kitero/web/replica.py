@@ -0,0 +1,219 @@
+import threading
+import logging
+logger = logging.getLogger("kitero.web.replica")
+
+from kitero.web import app
+from kitero.web.rpc import RPCClient, RPCConnection, RPCException
+from kitero import codec
+
+class Replica(object):
+    """Local replica of the bindings and statistics of the helper.
+
+    The replica subscribes to the changes of the router on a dedicated
+    connection to the helper and applies the events pushed by the
+    helper. It can then answer queries without any RPC. The replica is
+    only usable when :attr:`ready` is true: while the helper cannot be
+    contacted, queries should be sent to the helper.
+
+    Functions in :attr:`listeners` are called with a client and its
+    new binding each time the binding of a client changes. Changes
+    made by this process are notified even when the replica is not
+    ready.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ready = False
+        self.seq = None         # Sequence number of the last event
+        self.clients = {}       # Current bindings
+        self.ahead = {}         # Sequence number of local updates of clients
+        self.stats = None       # Last stats sample, encoded in JSON
+        self.catalogue = None   # Version of the catalogue
+        self.buffer = []        # Events received before the snapshot
+        self.listeners = []     # Functions to call on binding changes
+        self._connection = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start to replicate the helper.
+
+        Nothing happens if the replica is already running.
+        """
+        with self.lock:
+            if self._thread is not None:
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run)
+            self._thread.setDaemon(True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop to replicate the helper."""
+        with self.lock:
+            thread, self._thread = self._thread, None
+            self._stop.set()
+            if self._connection is not None:
+                self._connection.close()
+        if thread is not None:
+            thread.join()
+
+    def client(self, client):
+        """Return client current binding.
+
+        :param client: IP address of the client
+        :return: a tuple (interface, qos) or `None` if the client is
+            not bound
+        """
+        return self.clients.get(client)
+
+    def update(self, client, binding, seq):
+        """Update the binding of a client after a change.
+
+        This allows a change made by this process to be seen before
+        the helper pushes the corresponding event. The binding is
+        ignored if events up to `seq` have already been applied.
+        Otherwise, pending events for this client up to `seq` are
+        ignored when received since they are older.
+
+        :param client: IP address of the client
+        :param binding: tuple (interface, qos) or `None`
+        :param seq: sequence number of the last event published by the
+            helper when the binding was retrieved
+        """
+        with self.lock:
+            if not self.ready:
+                self.notify(client, binding)
+                return
+            if seq <= self.seq:
+                return
+            self.ahead[client] = seq
+            self.change(client, binding)
+
+    def _run(self):
+        backoff = 0
+        while not self._stop.isSet():
+            try:
+                connection = RPCConnection(RPCClient.address(),
+                                           app.config['CODEC'],
+                                           listener=self.event)
+                with self.lock:
+                    self._connection = connection
+                    if self._stop.isSet():
+                        break
+                answer = connection.call("subscribe")
+                if answer['status'] != 0:
+                    raise RPCException(answer['exception']['class'],
+                                       answer['exception']['message'],
+                                       answer['exception']['traceback'])
+                self.load(answer['value'])
+                logger.info("replica of the helper is ready")
+                backoff = 0
+                connection.wait()
+            except Exception as e:
+                logger.warning("unable to replicate the helper: %s", e)
+            self.reset()
+            backoff = min(max(backoff * 2, 0.1), 5)
+            self._stop.wait(backoff)
+        self.reset()
+        with self.lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def reset(self):
+        """Forget the replicated state."""
+        with self.lock:
+            self.ready = False
+            self.seq = None
+            self.clients = {}
+            self.ahead = {}
+            self.stats = None
+            self.catalogue = None
+            self.buffer = []
+
+    def load(self, snapshot):
+        """Load a snapshot of the helper.
+
+        :param snapshot: snapshot as returned by `subscribe` RPC call
+        """
+        with self.lock:
+            self.seq = snapshot['seq']
+            self.clients = dict((client, tuple(binding))
+                                for client, binding in snapshot['clients'].items())
+            self.stats = codec.RawJSON(codec.get("json").dumps(snapshot['stats']))
+            self.catalogue = snapshot.get('catalogue')
+            for event in self.buffer:
+                self.apply(event)
+            self.buffer = []
+            self.ready = True
+
+    def event(self, event):
+        """Handle an event pushed by the helper.
+
+        :param event: decoded event
+        """
+        with self.lock:
+            if self.seq is None:
+                self.buffer.append(event)
+            else:
+                self.apply(event)
+
+    def apply(self, event):
+        """Apply an event to the replica.
+
+        Should be called with the lock held.
+
+        :param event: decoded event
+        """
+        if event['seq'] <= self.seq:
+            return
+        self.seq = event['seq']
+        if event['event'] in ("bind", "unbind"):
+            client = event['client']
+            ahead = self.ahead.get(client)
+            if ahead is not None and ahead >= self.seq:
+                pass            # Older than a local update
+            elif event['event'] == "bind":
+                self.change(client, (event['interface'], event['qos']))
+            else:
+                self.change(client, None)
+            if ahead is not None and ahead <= self.seq:
+                del self.ahead[client]
+        elif event['event'] == "stats":
+            self.stats = codec.RawJSON(codec.get("json").dumps(event['stats']))
+        elif event['event'] == "catalogue":
+            self.catalogue = event['version']
+
+    def change(self, client, binding):
+        """Change the binding of a client and notify listeners.
+
+        Should be called with the lock held. Listeners are not
+        notified if the binding is unchanged.
+
+        :param client: IP address of the client
+        :param binding: tuple (interface, qos) or `None`
+        """
+        if binding is not None:
+            binding = tuple(binding)
+        if self.clients.get(client) == binding:
+            return
+        if binding is None:
+            del self.clients[client]
+        else:
+            self.clients[client] = binding
+        self.notify(client, binding)
+
+    def notify(self, client, binding):
+        """Notify listeners of a binding change.
+
+        :param client: IP address of the client
+        :param binding: tuple (interface, qos) or `None`
+        """
+        for listener in self.listeners:
+            try:
+                listener(client, binding)
+            except Exception: # pragma: no cover
+                logger.exception("unable to notify binding change")
+
+replica = Replica()
@@ -3,6 +3,7 @@ import socket
 from kitero.web import app
 from kitero.web.decorators import templated
 import kitero.web.api
+import kitero.web.events
 
 hostname=socket.gethostname()
 try:
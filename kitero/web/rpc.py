@@ -1,12 +1,13 @@
 import threading
+import itertools
 import time
 import socket
-import json
-import traceback
+import struct
 import logging
 logger = logging.getLogger("kitero.web.rpc")
 
 from kitero.web import app
+from kitero import codec
 
 class RPCException(Exception):
     def __init__(self, exception, message, traceback):
@@ -18,15 +19,262 @@ class RPCException(Exception):
         return "RPC error: %s(%r)" % (self.exception,
                                       self.message)
 
+class RPCCall(object):
+    """Pending call to the helper."""
+
+    def __init__(self, raw=False):
+        """Create a new pending call.
+
+        :param raw: should the answer be kept encoded?
+        """
+        self.event = threading.Event()
+        self.raw = raw
+        self.answer = None
+
+    def done(self, answer):
+        """Signal the answer for this call.
+
+        :param answer: answer or `None` if the connection was lost
+        """
+        self.answer = answer
+        self.event.set()
+
+    def wait(self, timeout=None):
+        """Wait for the answer.
+
+        :param timeout: maximum number of seconds to wait or `None`
+            to wait forever
+        :return: answer
+        """
+        if not self.event.wait(timeout):
+            raise IOError("no answer from RPC server after %s seconds" % timeout)
+        if self.answer is None:
+            raise IOError("connection to RPC server lost")
+        return self.answer
+
+class RPCConnection(object):
+    """One connection to the helper.
+
+    Calls are multiplexed over the connection: each request carries
+    an identifier and a reader thread dispatches answers to the
+    waiting callers. The lock is only held to send a request.
+    """
+
+    timeout = 5                 # Seconds to connect and negotiate the codec
+
+    def __init__(self, address, preferred="json", listener=None):
+        """Connect to the helper.
+
+        :param address: tuple IP and port of the helper or path to
+            its Unix socket
+        :param preferred: name of the preferred codec
+        :param listener: function to call with each event pushed by
+            the helper
+        """
+        self.lock = threading.Lock()
+        self.ids = itertools.count()
+        self.pending = {}       # Pending calls
+        self.closed = False
+        self.listener = listener
+        self.finished = threading.Event() # Set when the reader exits
+        if isinstance(address, basestring):
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.settimeout(self.timeout)
+            try:
+                self.socket.connect(address)
+            except:
+                self.socket.close()
+                raise
+        else:
+            self.socket = socket.create_connection(address, self.timeout)
+        read = self.socket.makefile('rb')
+        self.codec = codec.get("json")
+        if preferred != self.codec.name:
+            self.negotiate(read, preferred)
+        self.socket.settimeout(None) # The reader waits for answers and events
+        self.last = time.time() # Last time we received something
+        reader = threading.Thread(target=self.receive, args=(read,))
+        reader.setDaemon(True)
+        reader.start()
+
+    def negotiate(self, read, preferred):
+        """Negotiate the codec to use with the helper.
+
+        If the helper does not support the preferred codec, we keep
+        using JSON.
+
+        :param read: file object to read answers from
+        :param preferred: name of the preferred codec
+        """
+        codec.get(preferred)    # Check we support it
+        self.socket.sendall(self.codec.frame(
+                self.codec.dumps(["negotiate", preferred, self.codec.name])))
+        answer = self.codec.loads(read.readline())
+        if answer['status'] == 0:
+            self.codec = codec.get(answer['value'])
+        else:
+            logger.warning("unable to negotiate codec %r with helper: %s",
+                           preferred, answer['exception']['message'])
+
+    def call(self, method, *args):
+        """Invoke a remote method.
+
+        :param method: method to invoke
+        :type method: string
+        :return: decoded answer
+        """
+        return self.request([method] + list(args))
+
+    def request(self, data, raw=False, timeout=None):
+        """Send a request and wait for the answer.
+
+        When no answer is received in time, the call is forgotten and
+        :exc:`IOError` is raised. A late answer is ignored.
+
+        :param data: method to invoke followed by its arguments
+        :type data: list
+        :param raw: should the value be kept encoded in JSON?
+        :param timeout: maximum number of seconds to wait for the
+            answer or `None` to wait forever
+        :return: decoded answer. When `raw` is true, the value is a
+            :class:`RawJSON` string.
+        """
+        encoded = raw and isinstance(self.codec, codec.JSONCodec)
+        pending = RPCCall(encoded)
+        with self.lock:
+            if self.closed:
+                raise IOError("connection to RPC server lost")
+            ident = next(self.ids)
+            self.pending[ident] = pending
+            request = {'id': ident, 'call': data}
+            if encoded:
+                request['raw'] = True
+            try:
+                self.socket.sendall(self.codec.frame(self.codec.dumps(request)))
+            except socket.error:
+                del self.pending[ident]
+                self.close()
+                raise IOError("connection to RPC server lost")
+        try:
+            answer = pending.wait(timeout)
+        except IOError:
+            with self.lock:
+                self.pending.pop(ident, None)
+            raise
+        if encoded and isinstance(answer, str):
+            prefix = '{"id":%d,"status":0,"value":' % ident
+            if answer.startswith(prefix):
+                return {'status': 0,
+                        'value': codec.RawJSON(
+                        answer[len(prefix):answer.rindex("}")])}
+            answer = self.codec.loads(answer)
+        elif raw and answer['status'] == 0:
+            answer['value'] = codec.RawJSON(
+                codec.get("json").dumps(answer['value']))
+        return answer
+
+    def messages(self, read):
+        """Iterate over received messages.
+
+        :param read: file object to read messages from
+        """
+        if not self.codec.framed:
+            for line in iter(read.readline, ""):
+                yield line
+            return
+        while True:
+            header = read.read(4)
+            if len(header) < 4:
+                return
+            length, = struct.unpack("!I", header)
+            data = read.read(length)
+            if len(data) < length:
+                return
+            yield data
+
+    def receive(self, read):
+        """Dispatch answers received on the connection.
+
+        This method is run in a dedicated thread until the connection
+        is closed. Answers to raw requests are not decoded.
+
+        :param read: file object to read answers from
+        """
+        try:
+            for message in self.messages(read):
+                self.last = time.time()
+                if message.startswith('{"id":'):
+                    # Maybe an answer to a raw request
+                    ident = message[6:message.find(",")]
+                    call = ident.isdigit() and self.pending.get(int(ident))
+                    if call and call.raw:
+                        del self.pending[int(ident)]
+                        call.done(message)
+                        continue
+                answer = self.codec.loads(message)
+                if 'event' in answer:
+                    if self.listener is not None:
+                        self.listener(answer)
+                    continue
+                call = self.pending.pop(answer.get('id'), None)
+                if call is not None:
+                    call.done(answer)
+        except Exception:
+            logger.debug("connection to RPC server lost", exc_info=True)
+        finally:
+            read.close()
+            self.close()
+            with self.lock:
+                for call in self.pending.values():
+                    call.done(None)
+                self.pending.clear()
+            self.finished.set()
+
+    def wait(self, timeout=None):
+        """Wait for the connection to be closed.
+
+        :param timeout: maximum time to wait in seconds
+        :return: is the connection closed?
+        """
+        self.finished.wait(timeout)
+        return self.finished.isSet()
+
+    def load(self):
+        """Return the number of pending calls."""
+        return len(self.pending)
+
+    def close(self):
+        """Close the connection."""
+        self.closed = True
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.socket.close()
+
 class RPCClient(object):
     """Singleton object for communication with the helper.
 
     This object should not be instantiated. The methods should be used
     only inside a request: the application configuration is grabbed
     from the request.
+
+    Calls are spread over a pool of persistent connections. A
+    connection is only opened when all the existing ones are busy and
+    the pool is not full. Connections idle for too long are checked
+    with a ping before being used. When the helper cannot be
+    contacted, we wait before trying again, longer on each failure.
+    Calls without an answer after ``TIMEOUT`` seconds fail with
+    :exc:`IOError`.
     """
-    client = None               # No connection made yet
+    pool = []                   # Connections to the helper
+    connecting = 0              # Connections being opened
     lock = threading.Lock()
+    connected = threading.Condition(lock) # Notified when a connection attempt ends
+    idle = 30                   # Check connections idle for this many seconds
+    backoff = 0                 # Current delay before trying to reconnect
+    retry = 0                   # Do not try to connect before this time
+    counters = dict(calls=0, connections=0, failures=0, checks=0)
 
     @classmethod
     def call(cls, method, *args):
@@ -36,59 +284,187 @@ class RPCClient(object):
         :type method: string
         :return: requested value
         """
-        cls.connect()
+        return cls.request([method] + list(args))
+
+    @classmethod
+    def raw(cls, method, *args):
+        """Request an attribute from remote service, encoded in JSON.
+
+        The value is not decoded and can be included as is in a JSON
+        answer.
+
+        :param method: method to invoke
+        :type method: string
+        :return: requested value encoded in JSON
+        :rtype: :class:`RawJSON`
+        """
+        return cls.request([method] + list(args), raw=True)
+
+    @classmethod
+    def request(cls, data, raw=False):
+        """Send a request to remote service.
+
+        :param data: method to invoke followed by its arguments
+        :param raw: should the value be kept encoded in JSON?
+        :return: requested value
+        """
+        connection = cls.connection()
         with cls.lock:
-            data = [method,]
-            data.extend(args)
-            cls.write.write("%s\n" % json.dumps(data))
-            answer = json.loads(cls.read.readline())
+            cls.counters['calls'] += 1
+        answer = connection.request(data, raw, app.config['TIMEOUT'])
+        if answer['status'] != 0:
+            raise RPCException(answer['exception']['class'],
+                               answer['exception']['message'],
+                               answer['exception']['traceback'])
+        return answer['value']
+
+    @classmethod
+    def batch(cls, *calls):
+        """Request several attributes from remote service at once.
+
+        The calls are sent in a single request and executed in order.
+
+        :param calls: calls to execute, each of them being a tuple
+            whose first member is the method to invoke and the
+            remaining members are the arguments
+        :return: list of requested values
+        :raise RPCException: the first exception raised by a call
+        """
+        answers = cls.call("batch", calls)
+        for answer in answers:
             if answer['status'] != 0:
                 raise RPCException(answer['exception']['class'],
                                    answer['exception']['message'],
                                    answer['exception']['traceback'])
-            return answer['value']
+        return [answer['value'] for answer in answers]
 
     @classmethod
-    def clean(cls):
-        """Try to cleanup.
+    def connection(cls):
+        """Get a healthy connection from the pool.
 
-        Only used for unittests.
+        The lock is not held while connecting: a slot of the pool is
+        reserved instead. When the pool is empty, we wait for a
+        connection attempt in progress.
+
+        :return: a connection to the helper
+        :rtype: :class:`RPCConnection`
         """
-        try:
-            if cls.client is not None:
-                cls.read.close()
-                cls.write.close()
-                cls.client.close()
-        except: # pragma: no cover
-            pass
+        while True:
+            with cls.lock:
+                while True:
+                    cls.pool = [c for c in cls.pool if not c.closed]
+                    connection = cls.pool and min(cls.pool, key=RPCConnection.load) or None
+                    if connection is not None or not cls.connecting:
+                        break
+                    cls.connected.wait() # Another call is connecting
+                grow = connection is None or \
+                    (connection.load() and
+                     len(cls.pool) + cls.connecting < app.config['POOL'])
+                if grow:
+                    cls.connecting += 1 # Reserve a slot in the pool
+            if grow:
+                # Connect without the lock: other calls can use the pool
+                new = None
+                try:
+                    new = cls.connect()
+                except IOError:
+                    if connection is None:
+                        raise
+                finally:
+                    with cls.lock:
+                        cls.connecting -= 1
+                        if new is not None:
+                            cls.pool.append(new)
+                        cls.connected.notify_all()
+                if new is not None:
+                    return new
+            if time.time() - connection.last < cls.idle:
+                return connection
+            # Health check
+            with cls.lock:
+                cls.counters['checks'] += 1
+            try:
+                connection.request(["ping"], timeout=app.config['TIMEOUT'])
+                return connection
+            except IOError:
+                connection.close()
 
     @classmethod
     def connect(cls):
-        """Connect to RPC client."""
+        """Connect to RPC client.
+
+        Should be called without the lock held: the lock is only taken
+        to update counters and the delay before reconnecting. A few
+        attempts are made before giving up, each of them bounded by
+        :attr:`RPCConnection.timeout`. After a failure, we do not try
+        again before some time, doubling this delay on each failure.
+
+        :return: a new connection to the helper
+        :rtype: :class:`RPCConnection`
+        """
+        address = cls.address()
+        if time.time() < cls.retry:
+            raise IOError("unable to contact RPC server (%s)" % (address,))
+        i = 0
+        while True:
+            try:
+                connection = RPCConnection(address, app.config['CODEC'])
+                with cls.lock:
+                    cls.backoff = 0
+                    cls.counters['connections'] += 1
+                return connection
+            except Exception: # Not the best, but we don't have better
+                with cls.lock:
+                    cls.counters['failures'] += 1
+                i = i + 1
+                if i < 4:
+                    time.sleep(0.1 * i)
+                    continue
+                with cls.lock:
+                    cls.backoff = min(max(cls.backoff * 2, 1), 30)
+                    cls.retry = time.time() + cls.backoff
+                logger.exception("unable to contact RPC server")
+                raise IOError("unable to contact RPC server (%s)" % (address,))
+
+    @classmethod
+    def address(cls):
+        """Return the address of the helper.
+
+        :return: tuple IP and port or path to a Unix socket
+        """
+        return app.config.get('HELPERSOCKET') or \
+            (app.config['HELPERIP'], app.config['HELPERPORT'])
+
+    @classmethod
+    def metrics(cls):
+        """Return metrics about the pool of connections.
+
+        :return: a dictionary with the number of open connections
+            (`size`), the maximum number of connections (`max`), the
+            number of pending calls (`pending`), the number of calls
+            (`calls`), the number of connections made
+            (`connections`), the number of failed connection attempts
+            (`failures`), the number of health checks (`checks`) and
+            the current reconnect delay (`backoff`).
+        """
         with cls.lock:
-            i = 0
-            client = None
-            while client is None:
-                try:
-                    if cls.client is None:
-                        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                        client.connect((app.config['HELPERIP'], app.config['HELPERPORT']))
-                        read, write = client.makefile('rb'), client.makefile('wb', 0)
-                    else:
-                        client, cls.client = cls.client, None
-                        read, write = cls.read, cls.write
-                    # Try to ping
-                    write.write("%s\n" % json.dumps(("ping",)))
-                    answer = json.loads(read.readline())
-                except Exception as e: # Not the best, but we don't have better
-                    i = i + 1
-                    if i < 4:
-                        client = None
-                        time.sleep(0.1)
-                        continue
-                    logger.exception("unable to contact RPC server")
-                    raise IOError(
-                        "unable to contact RPC server (%s:%d)" % (app.config['HELPERIP'],
-                                                                  app.config['HELPERPORT']))
-            cls.client = client
-            cls.read, cls.write = read, write
+            pool = [c for c in cls.pool if not c.closed]
+            metrics = dict(size=len(pool),
+                           max=app.config['POOL'],
+                           pending=sum(c.load() for c in pool),
+                           backoff=cls.backoff)
+            metrics.update(cls.counters)
+            return metrics
+
+    @classmethod
+    def clean(cls):
+        """Try to cleanup.
+
+        Only used for unittests.
+        """
+        with cls.lock:
+            pool, cls.pool = cls.pool, []
+            cls.backoff = cls.retry = 0
+            cls.counters = dict.fromkeys(cls.counters, 0)
+        for connection in pool:
+            connection.close()
@@ -8,7 +8,8 @@ def run(config={}):
     """ 
     app = application(config)
     app.run(host=app.config['LISTEN'],
-            port=app.config['PORT'])
+            port=app.config['PORT'],
+            threaded=True)  # Event streams are long-lived
 
 def application(config={}):
     """Return Kitero application.
@@ -26,6 +27,7 @@ def configure(app, config={}):
     # Configure helper
     app.config['HELPERIP'] = config['helper']['listen']
     app.config['HELPERPORT'] = config['helper']['port']
+    app.config['HELPERSOCKET'] = config['helper'].get('socket')
     # Configure the remaining
     config = config['web']
     for key in config:
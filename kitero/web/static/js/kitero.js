@@ -195,19 +195,41 @@ $(function() {
     });
 
     // Stats about all interfaces
+    // Only changes since the last sample are fetched.
     kitero.model.Stats = Backbone.Model.extend({
-	url: "api/1.0/stats",
+	url: function() {
+	    return "api/1.0/stats?since=" + (_.isNull(this.seq)?"":this.seq);
+	},
 	initialize: function() {
 	    this.last = {
 		time: null,
 		value: null
 	    };
+	    this.seq = null;	// Sequence number of the last sample
 	    this.keep = 60;	// Keep 60 values
 	},
 	parse: function(response) {
+	    var merge = function(base, changes) {
+		// Apply `changes' to a copy of `base'. A null value
+		// is a removed key.
+		var result = _.clone(base);
+		_(changes).each(function(value, key) {
+		    if (_.isNull(value))
+			delete result[key];
+		    else if (_.isObject(value) && _.isObject(result[key]))
+			result[key] = merge(result[key], value);
+		    else
+			result[key] = value;
+		});
+		return result;
+	    };
+	    var stats = response.value.stats;
+	    if (!_.isNull(response.value.since) && !_.isNull(this.last.value))
+		stats = merge(this.last.value, stats);
+	    this.seq = response.value.seq;
 	    var now = {
 		time: response.time,
-		value: response.value
+		value: stats
 	    };
 	    if (_(this.last.time).isNull()) {
 		this.last = now;
@@ -290,6 +312,22 @@ $(function() {
 				 this.toJSON(), delta, this.keep);
 	    this.last = now;
 	    return result;
+	},
+	// Append rates pushed by the web service
+	push: function(rates) {
+	    var result = {};
+	    _(rates).each(function(value, iface) {
+		var current = this.get(iface) || {};
+		result[iface] = {};
+		_(value).each(function(val, key) {
+		    var series = _.clone(current[key] || []);
+		    series.unshift(val);
+		    if (series.length > this.keep) series.pop();
+		    result[iface][key] = series;
+		}, this);
+	    }, this);
+	    this.set(result);
+	    this.trigger("poll");
 	}
     });
 
@@ -504,7 +542,8 @@ $(function() {
 	    // Fetch settings and interfaces from the web service
 	    this.unavailable = _.once(this.unavailable);
 	    this.settings.fetch({ error: this.unavailable, cache: false });
-	    this.interfaces.fetch({ error: this.unavailable, cache: false });
+	    // Interfaces are revalidated by the browser with their ETag
+	    this.interfaces.fetch({ error: this.unavailable });
 	},
 	// Display a dialog stating the unavailibility of the web service
 	unavailable: function(what, error) {
@@ -583,6 +622,18 @@ $(function() {
 			cache: false
 		    });
 		}, 30100);
+		if (window.EventSource) {
+		    // Stats and status are pushed by the web service
+		    this.events = new EventSource("api/1.0/events");
+		    this.events.addEventListener("stats", function(e) {
+			kitero.stats.push(JSON.parse(e.data).interfaces);
+		    }, false);
+		    this.events.addEventListener("status", function(e) {
+			var settings = kitero.settings;
+			settings.set(settings.parse({ value: JSON.parse(e.data) }));
+		    }, false);
+		    return this;
+		}
 		this.scheduled.stats = window.setInterval(function() {
 		    kitero.stats.fetch({
 			success: function() {
@@ -26,7 +26,7 @@ setup(
     description = "Interface and QoS switcher for router",
 
     # List of provided packages
-    packages = find_packages(exclude=("tests",)),
+    packages = find_packages(exclude=("tests", "bench")),
     package_data = { 'kitero.web': [ 'templates/*.html',
                                      'static/css/*.css',
                                      'static/js/*.js',
@@ -5,6 +5,7 @@ except ImportError: # pragma: no cover
 
 import yaml
 import os
+import re
 import stat
 import tempfile
 import shutil
@@ -12,6 +13,7 @@ from functools import wraps
 
 from kitero.helper.binder import LinuxBinder, LinuxBinderIPv4
 from kitero.helper.router import Router
+from kitero.helper.commands import CommandError
 
 # SaveBinder is tested in test_service.py
 
@@ -66,6 +68,7 @@ qos:
     name: "unlimited"
     description: "My fourth QoS"
 """
+        self.router_doc = doc
         self.router = Router.load(yaml.load(doc))
         self.router.register(self.binder)
         # Provide fake binaries for `ip`, `iptables`, `tc`
@@ -99,6 +102,24 @@ EOF
 -A kitero-ACCOUNTING -o eth0 -m connmark --mark 0x20000000/0xffe00000 -m comment --comment "down-eth1-2001:db8::2" -c 8885 12111
 EOF
   ;;
+   "ip neigh show")
+  cat <<EOF
+172.29.7.14 dev eth0 lladdr 00:16:3e:00:00:01 REACHABLE
+172.29.7.15 dev eth0 lladdr 00:16:3e:00:00:02 STALE
+172.29.7.16 dev eth0  FAILED
+172.29.7.17 dev eth0 lladdr 00:16:3e:00:00:03 DELAY
+10.0.0.1 dev eth1 lladdr 00:16:3e:00:00:04 REACHABLE
+EOF
+  ;;
+   "ip -6 neigh show")
+  cat <<EOF
+2001:db8::1 dev eth0 lladdr 00:16:3e:00:00:05 router REACHABLE
+fe80::1 dev eth0 lladdr 00:16:3e:00:00:06 STALE
+EOF
+  ;;
+   "tc -batch "*|"iptables-restore --noflush "*|"ip6tables-restore --noflush "*)
+  cat "$2" >> "$(dirname $0)/../output.txt"
+  ;;
 esac
 exit 0
 """ % os.path.join(self.temp, "output.txt"))
@@ -106,13 +127,20 @@ exit 0
         os.chmod(os.path.join(biny, "fake"),
                  stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH |
                  stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
-        for ex in ['iptables', 'ip6tables', 'tc', 'ip']:
+        for ex in ['iptables', 'ip6tables', 'tc', 'ip',
+                   'iptables-restore', 'ip6tables-restore']:
             os.symlink("fake", os.path.join(biny, ex))
 
     def tearDown(self):
         os.environ['PATH'] = self.oldpath
         shutil.rmtree(self.temp)
 
+    def reloaded(self, change):
+        """Reload the router with a modified configuration"""
+        doc = yaml.load(self.router_doc)
+        change(doc)
+        self.router.reload(Router.load(doc))
+
 class TestBinderIPv4IPv6(TestBinderAny):
 
     BINDER = LinuxBinder
@@ -317,6 +345,158 @@ ip6tables -t mangle -D kitero-ACCOUNTING -o eth0 -m connmark --mark 0x80000000/0
         self.assertIn("--mark 0x80400000", file(self.cur).read())
         self.assertIn("--set-class 1:50", file(self.cur).read())
 
+    @out
+    def test_hints(self):
+        """Restore a binding using hints"""
+        self.router.bind("192.168.15.2", "eth1", "qos1")
+        self.router.bind("192.168.15.3", "eth1", "qos1")
+        self.assertEqual(self.router.hints("192.168.15.3"), dict(slot=1, ticket=2))
+        self.assertEqual(self.router.hints("192.168.15.4"), {})
+        self.router.unbind("192.168.15.2")
+        self.router.unbind("192.168.15.3")
+        os.unlink(self.cur)
+        # Without hints, we would get slot 0 and ticket 1
+        self.router.bind("192.168.15.3", "eth1", "qos1", hints=dict(slot=1, ticket=2))
+        self.assertIn("--mark 0x40400000", file(self.cur).read())
+        self.assertIn("--set-class 1:20", file(self.cur).read())
+        self.assertEqual(self.router.hints("192.168.15.3"), dict(slot=1, ticket=2))
+        # Conflicting hints are ignored
+        self.router.bind("192.168.15.2", "eth1", "qos1", hints=dict(slot=1, ticket=2))
+        self.assertEqual(self.router.hints("192.168.15.2"), dict(slot=0, ticket=1))
+
+    @out
+    def test_rebind(self):
+        """Change the QoS of a client in place"""
+        self.router.bind("192.168.15.2", "eth1", "qos1")
+        self.router.bind("192.168.15.3", "eth2", "qos3")
+        os.unlink(self.cur)
+        self.router.rebind("192.168.15.2", "eth1", "qos2")
+        self.router.rebind("192.168.15.3", "eth2", "qos4")
+        self.router.rebind("192.168.15.3", "eth2", "qos4")
+        self.assertEqual(file(self.cur).read().split("\n"),
+"""tc qdisc change dev eth1 parent 1:10 handle 10: tbf rate 10mbps buffer 10Mbit latency 1s
+tc qdisc change dev eth1 parent 10:1 handle 11: netem delay 200ms 10ms
+tc qdisc change dev eth0 parent 1:10 handle 10: tbf rate 10mbps buffer 10Mbit latency 1s
+tc qdisc change dev eth0 parent 10:1 handle 11: netem delay 200ms 10ms
+tc qdisc del dev eth2 parent 1:20
+tc qdisc add dev eth2 parent 1:20 handle 20: sfq
+tc qdisc del dev eth0 parent 1:20
+tc qdisc add dev eth0 parent 1:20 handle 20: sfq
+""".split("\n"))
+        self.assertEqual(self.router.hints("192.168.15.2"), dict(slot=0, ticket=1))
+        self.assertEqual(self.router.hints("192.168.15.3"), dict(slot=0, ticket=2))
+
+    @out
+    def test_reload_interfaces(self):
+        """Reload with an interface added and another removed"""
+        self.router.bind("192.168.15.2", "eth1", "qos1")
+        self.router.bind("192.168.15.3", "eth2", "qos3")
+        os.unlink(self.cur)
+        def change(doc):
+            doc['interfaces']['eth3'] = doc['interfaces'].pop('eth1')
+        self.reloaded(change)
+        self.assertEqual(self.binder.interfaces, ["eth3", "eth2"])
+        self.assertEqual(self.router.clients.keys(), ["192.168.15.3"])
+        output = file(self.cur).read()
+        self.assertNotIn("eth2", output)
+        for command in ["ip rule del fwmark 0x40000000/0xc0000000 table eth1",
+                        "tc qdisc del dev eth1 root",
+                        "tc qdisc add dev eth3 root handle 1: drr",
+                        "ip rule add fwmark 0x40000000/0xc0000000 table eth3"]:
+            self.assertIn(command, output)
+        self.assertNotIn("ip rule add fwmark 0x40000000/0xc0000000 table eth1", output)
+
+    @out
+    def test_reload_qos(self):
+        """Reload with new QoS settings"""
+        self.router.bind("192.168.15.2", "eth1", "qos1")
+        self.router.bind("192.168.15.3", "eth2", "qos3")
+        os.unlink(self.cur)
+        def change(doc):
+            doc['qos']['qos1']['netem'] = "delay 50ms"
+        self.reloaded(change)
+        self.assertEqual(file(self.cur).read().split("\n")[1:],
+"""qdisc change dev eth1 parent 10:1 handle 11: netem delay 50ms
+qdisc change dev eth0 parent 10:1 handle 11: netem delay 50ms
+""".split("\n"))
+        self.assertEqual(self.router.clients["192.168.15.2"], ("eth1", "qos1"))
+
+    @out
+    def test_reload_marks(self):
+        """Bind clients again when marks need more bits"""
+        self.router.bind("192.168.15.2", "eth2", "qos1")
+        os.unlink(self.cur)
+        def change(doc):
+            doc['interfaces']['eth3'] = doc['interfaces']['eth1']
+            doc['interfaces']['eth4'] = doc['interfaces']['eth1']
+        self.reloaded(change)
+        self.assertEqual(self.binder.interfaces, ["eth1", "eth2", "eth3", "eth4"])
+        output = file(self.cur).read()
+        for command in ["ip rule del fwmark 0x80000000/0xc0000000 table eth2",
+                        "ip rule add fwmark 0x40000000/0xe0000000 table eth2",
+                        "-D kitero-POSTROUTING -o eth2 -m connmark --mark 0x80000000/0xffc00000 -j CLASSIFY --set-class 1:10",
+                        "-A kitero-POSTROUTING -o eth2 -m connmark --mark 0x40000000/0xffe00000 -j CLASSIFY --set-class 1:10",
+                        "tc qdisc add dev eth4 root handle 1: drr"]:
+            self.assertIn(command, output)
+        self.assertNotIn("tc qdisc del dev eth2 root", output)
+
+    @out
+    def test_reload_invalid(self):
+        """Keep the current configuration when the new one is invalid"""
+        self.router.bind("192.168.15.2", "eth1", "qos1")
+        os.unlink(self.cur)
+        interfaces = self.router.interfaces
+        def change(doc):
+            doc['interfaces']['eth3'] = doc['interfaces']['eth1']
+            doc['qos']['qos1']['bandwidth'] = "100mbps"
+        with self.assertRaises(ValueError):
+            self.reloaded(change)
+        self.assertEqual(self.router.interfaces, interfaces)
+        self.assertEqual(self.binder.interfaces, ["eth1", "eth2"])
+        self.assertFalse(os.path.exists(self.cur))
+
+    @out
+    def test_reload_invalid_unbound(self):
+        """Bind again clients unbound by an invalid configuration"""
+        self.router.bind("192.168.15.2", "eth1", "qos1")
+        self.router.bind("192.168.15.3", "eth1", "qos2")
+        ticket = self.binder.tickets.get("192.168.15.3")
+        def change(doc):
+            doc['interfaces']['eth1']['qos'] = ["qos1"]
+            doc['qos']['qos1']['bandwidth'] = "100mbps"
+        with self.assertRaises(ValueError):
+            self.reloaded(change)
+        self.assertEqual(self.router.clients["192.168.15.3"], ("eth1", "qos2"))
+        self.assertEqual(self.binder.tickets.get("192.168.15.3"), ticket)
+        self.assertIn("tc class add dev eth1 parent 1: classid 1:%d0 drr" % ticket,
+                      file(self.cur).read().split("tc class del")[-1])
+
+    @out
+    def test_invalid_qos(self):
+        """Reject invalid QoS settings before setup"""
+        router = Router.load(yaml.load("""
+clients: eth0
+interfaces:
+  eth1:
+    name: LAN
+    description: "My first interface"
+    qos:
+      - qos1
+qos:
+  qos1:
+    name: "100M"
+    description: "My first QoS"
+    bandwidth: 100mbps
+"""))
+        router.register(self.binder)
+        with self.assertRaises(ValueError):
+            router.notify("start")
+        self.assertFalse(os.path.exists(self.cur))
+
+    def test_no_hints(self):
+        """Grab hints when not initialized"""
+        self.assertEqual(self.binder.hints("192.168.15.2"), {})
+
     def test_bind_once(self):
         """The binder should be bound to only one router"""
         self.binder.notify("unknown", self.router)
@@ -369,6 +549,78 @@ iptables -t mangle -A kitero-ACCOUNTING -o eth0 -m connmark --mark 0x80400000/0x
         """Grab stats when not initialized"""
         self.assertEqual(self.binder.stats(), {})
 
+    @out
+    def test_batch(self):
+        """Bind and unbind several clients at once"""
+        self.router.bind("192.168.15.11", "eth2", "qos1") # For initialization
+        os.unlink(self.cur)
+        self.router.bind_many([("192.168.15.5", "eth2", "qos4"),
+                               ("2001:db8::5", "eth1", "qos2")])
+        self.assertEqual(re.sub(r"(-batch|--noflush) \S+", r"\1 FILE",
+                                file(self.cur).read()).split("\n"),
+"""tc -batch FILE
+class add dev eth2 parent 1: classid 1:20 drr
+qdisc add dev eth2 parent 1:20 handle 20: sfq
+class add dev eth0 parent 1: classid 1:20 drr
+qdisc add dev eth0 parent 1:20 handle 20: sfq
+class add dev eth1 parent 1: classid 1:30 drr
+qdisc add dev eth1 parent 1:30 handle 30: tbf rate 10mbps buffer 10Mbit latency 1s
+qdisc add dev eth1 parent 30:1 handle 31: netem delay 200ms 10ms
+class add dev eth0 parent 1: classid 1:30 drr
+qdisc add dev eth0 parent 1:30 handle 30: tbf rate 10mbps buffer 10Mbit latency 1s
+qdisc add dev eth0 parent 30:1 handle 31: netem delay 200ms 10ms
+ip6tables-restore --noflush FILE
+*mangle
+-A kitero-PREROUTING -i eth0 -s 2001:db8::5 -j MARK --set-mark 0x40000000/0xffc00000
+-A kitero-POSTROUTING -o eth1 -s 2001:db8::5 -m mark --mark 0x40000000/0xffc00000 -j CONNMARK --save-mark --nfmask 0xffc00000 --ctmask 0xffc00000
+-A kitero-POSTROUTING -o eth1 -m connmark --mark 0x40000000/0xffc00000 -j CLASSIFY --set-class 1:30
+-A kitero-POSTROUTING -o eth0 -m connmark --mark 0x40000000/0xffc00000 -j CLASSIFY --set-class 1:30
+-A kitero-ACCOUNTING -o eth1 -m connmark --mark 0x40000000/0xffc00000 -m comment --comment up-eth1-2001:db8::5
+-A kitero-ACCOUNTING -o eth0 -m connmark --mark 0x40000000/0xffc00000 -m comment --comment down-eth1-2001:db8::5
+COMMIT
+iptables-restore --noflush FILE
+*mangle
+-A kitero-PREROUTING -i eth0 -s 192.168.15.5 -j MARK --set-mark 0x80400000/0xffc00000
+-A kitero-POSTROUTING -o eth2 -s 192.168.15.5 -m mark --mark 0x80400000/0xffc00000 -j CONNMARK --save-mark --nfmask 0xffc00000 --ctmask 0xffc00000
+-A kitero-POSTROUTING -o eth2 -m connmark --mark 0x80400000/0xffc00000 -j CLASSIFY --set-class 1:20
+-A kitero-POSTROUTING -o eth0 -m connmark --mark 0x80400000/0xffc00000 -j CLASSIFY --set-class 1:20
+-A kitero-ACCOUNTING -o eth2 -m connmark --mark 0x80400000/0xffc00000 -m comment --comment up-eth2-192.168.15.5
+-A kitero-ACCOUNTING -o eth0 -m connmark --mark 0x80400000/0xffc00000 -m comment --comment down-eth2-192.168.15.5
+COMMIT
+""".split("\n"))
+        os.unlink(self.cur)
+        self.router.unbind_many(["192.168.15.5", "2001:db8::5"])
+        output = file(self.cur).read().split("\n")
+        self.assertEqual(output[1:5], """class del dev eth2 parent 1: classid 1:20 drr
+class del dev eth0 parent 1: classid 1:20 drr
+class del dev eth1 parent 1: classid 1:30 drr
+class del dev eth0 parent 1: classid 1:30 drr""".split("\n"))
+        self.assertEqual(len([line for line in output if line.startswith("-D ")]), 12)
+        self.assertEqual(self.router.hints("192.168.15.5"), {})
+
+    @out
+    def test_batch_failure(self):
+        """Give back slots and tickets when a batch fails"""
+        self.router.bind("192.168.15.11", "eth2", "qos1") # For initialization
+        os.unlink(os.path.join(self.temp, "bin", "iptables-restore"))
+        os.symlink("/bin/false", os.path.join(self.temp, "bin", "iptables-restore"))
+        with self.assertRaises(CommandError):
+            self.router.bind_many([("192.168.15.5", "eth2", "qos4"),
+                                   ("192.168.15.6", "eth2", "qos4")])
+        self.assertEqual(self.router.clients.keys(), ["192.168.15.11"])
+        self.router.bind("192.168.15.6", "eth2", "qos4")
+        self.assertEqual(self.router.hints("192.168.15.6"), dict(slot=1, ticket=2))
+
+    def test_neighbors(self):
+        """Grab clients present in the neighbor table"""
+        self.router.bind("192.168.15.11", "eth2", "qos1") # For initialization
+        self.assertEqual(self.router.neighbors,
+                         set(["172.29.7.14", "172.29.7.17", "2001:db8::1"]))
+
+    def test_no_neighbors(self):
+        """Grab neighbors when not initialized"""
+        self.assertEqual(self.binder.neighbors(), set())
+
 class TestBinderIPv4(TestBinderAny):
 
     BINDER = LinuxBinderIPv4
@@ -388,6 +640,268 @@ class TestBinderIPv4(TestBinderAny):
         with self.assertRaises(NotImplementedError):
             self.router.bind("2001:db8::1", "eth2", "qos1")
 
+class TestBinderHTB(TestBinderAny):
+
+    BINDER = staticmethod(lambda: LinuxBinderIPv4(scheduler="htb"))
+
+    def setUp(self):
+        TestBinderAny.setUp(self)
+        doc = yaml.load(self.router_doc)
+        doc['interfaces']['eth2']['bandwidth'] = dict(up="20mbit", down="100mbit")
+        doc['qos']['qos1']['ceil'] = dict(up="80mbps")
+        self.router = Router.load(doc)
+        self.router.register(self.binder)
+
+    @out
+    def test_setup(self):
+        """Setup a class for each link"""
+        self.router.notify("start")
+        output = file(self.cur).read()
+        for command in ["tc qdisc add dev eth2 root handle 1: htb",
+                        "tc class add dev eth2 parent 1: classid 1:1 htb rate 20mbit ceil 20mbit",
+                        "tc class add dev eth2 parent 1:1 classid 1:2 htb rate 20mbit ceil 20mbit",
+                        "tc class add dev eth1 parent 1: classid 1:1 htb rate 10gbit ceil 10gbit",
+                        "tc qdisc add dev eth0 root handle 1: htb",
+                        "tc class add dev eth0 parent 1: classid 1:2 htb rate 10gbit ceil 10gbit",
+                        "tc class add dev eth0 parent 1: classid 1:a0 htb rate 10gbit ceil 10gbit",
+                        "tc class add dev eth0 parent 1: classid 1:a1 htb rate 100mbit ceil 100mbit"]:
+            self.assertIn(command, output)
+        self.assertNotIn("drr", output)
+
+    @out
+    def test_scheduler_from_config(self):
+        """Use the scheduler from the configuration of the helper"""
+        self.router.notify("start", config=dict(scheduler="hfsc"))
+        self.assertIn("tc class add dev eth0 parent 1: classid 1:a1 hfsc"
+                      " sc rate 100mbit ul rate 100mbit",
+                      file(self.cur).read())
+
+    def test_unknown_scheduler(self):
+        """Reject unknown schedulers"""
+        with self.assertRaises(ValueError):
+            self.router.notify("start", config=dict(scheduler="cbq"))
+
+    @out
+    def test_bind(self):
+        """Bind clients to classes with rate and ceil"""
+        self.router.bind("192.168.15.2", "eth2", "qos1")
+        self.router.bind("192.168.15.3", "eth2", "qos4")
+        os.unlink(self.cur)
+        self.router.bind("192.168.15.4", "eth2", "qos1")
+        output = file(self.cur).read()
+        self.assertEqual(output.split("\n")[:4],
+"""tc class add dev eth2 parent 1:1 classid 1:30 htb rate 50mbps ceil 80mbps
+tc qdisc add dev eth2 parent 1:30 handle 30: netem delay 100ms 10ms distribution experimental
+tc class add dev eth0 parent 1:a1 classid 1:30 htb rate 100mbps ceil 100mbps
+tc qdisc add dev eth0 parent 1:30 handle 30: netem delay 100ms 10ms distribution experimental""".split("\n"))
+        self.assertNotIn("tbf", output)
+        self.router.unbind("192.168.15.3")
+        self.assertIn("tc class del dev eth2 parent 1:1 classid 1:20 htb rate 20mbit ceil 20mbit",
+                      file(self.cur).read())
+
+    @out
+    def test_rebind(self):
+        """Change the class of a client in place"""
+        self.router.bind("192.168.15.2", "eth2", "qos1")
+        os.unlink(self.cur)
+        self.router.rebind("192.168.15.2", "eth2", "qos4")
+        self.assertEqual(file(self.cur).read().split("\n"),
+"""tc class change dev eth2 parent 1:1 classid 1:10 htb rate 20mbit ceil 20mbit
+tc qdisc del dev eth2 parent 1:10
+tc qdisc add dev eth2 parent 1:10 handle 10: sfq
+tc class change dev eth0 parent 1:a1 classid 1:10 htb rate 100mbit ceil 100mbit
+tc qdisc del dev eth0 parent 1:10
+tc qdisc add dev eth0 parent 1:10 handle 10: sfq
+""".split("\n"))
+
+    @out
+    def test_reload_bandwidth(self):
+        """Change the bandwidth of a link"""
+        self.router.bind("192.168.15.2", "eth2", "qos4")
+        os.unlink(self.cur)
+        doc = yaml.load(self.router_doc)
+        doc['interfaces']['eth2']['bandwidth'] = "30mbit"
+        doc['qos']['qos1']['ceil'] = dict(up="80mbps")
+        self.router.reload(Router.load(doc))
+        output = file(self.cur).read().split("\n")
+        self.assertEqual(output[:2],
+"""tc class change dev eth2 parent 1: classid 1:1 htb rate 30mbit ceil 30mbit
+tc class change dev eth0 parent 1: classid 1:a1 htb rate 30mbit ceil 30mbit""".split("\n"))
+        self.assertEqual(output[3:5],
+"""class change dev eth2 parent 1:1 classid 1:10 htb rate 30mbit ceil 30mbit
+class change dev eth0 parent 1:a1 classid 1:10 htb rate 30mbit ceil 30mbit""".split("\n"))
+
+class TestBinderCake(TestBinderAny):
+
+    BINDER = staticmethod(lambda: LinuxBinderIPv4(scheduler="cake"))
+
+    @out
+    def test_setup(self):
+        """Setup a tier for each interface and QoS"""
+        self.router.notify("start")
+        output = file(self.cur).read()
+        for command in ["tc class add dev eth1 parent 1: classid 1:c10 drr",
+                        "tc qdisc add dev eth1 parent 1:c10 handle c10: netem delay 100ms 10ms distribution experimental",
+                        "tc qdisc add dev eth1 parent c10:1 handle c11: cake bandwidth 50mbps dual-srchost nat",
+                        "tc class add dev eth0 parent 1: classid 1:c10 drr",
+                        "tc qdisc add dev eth0 parent c10:1 handle c11: cake bandwidth 100mbps dual-dsthost",
+                        "tc qdisc add dev eth1 parent c20:1 handle c21: cake bandwidth 10mbps dual-srchost nat",
+                        "tc qdisc add dev eth2 parent 1:c50 handle c50: cake bandwidth 10gbit dual-srchost nat"]:
+            self.assertIn(command, output)
+        self.assertEqual(len(self.binder.tiers.clients), 5)
+
+    @out
+    def test_bind(self):
+        """Only classify clients"""
+        self.router.bind("192.168.15.2", "eth2", "qos1")
+        os.unlink(self.cur)
+        self.router.bind("192.168.15.3", "eth2", "qos4")
+        output = file(self.cur).read()
+        self.assertNotIn("tc ", output)
+        self.assertIn("iptables -t mangle -A kitero-POSTROUTING -o eth2 -m connmark"
+                      " --mark 0x80400000/0xffc00000 -j CLASSIFY --set-class 1:c50",
+                      output)
+        os.unlink(self.cur)
+        self.router.rebind("192.168.15.3", "eth2", "qos3")
+        self.assertEqual(file(self.cur).read().split("\n"),
+"""iptables -t mangle -A kitero-POSTROUTING -o eth2 -m connmark --mark 0x80400000/0xffc00000 -j CLASSIFY --set-class 1:c40
+iptables -t mangle -A kitero-POSTROUTING -o eth0 -m connmark --mark 0x80400000/0xffc00000 -j CLASSIFY --set-class 1:c40
+iptables -t mangle -D kitero-POSTROUTING -o eth2 -m connmark --mark 0x80400000/0xffc00000 -j CLASSIFY --set-class 1:c50
+iptables -t mangle -D kitero-POSTROUTING -o eth0 -m connmark --mark 0x80400000/0xffc00000 -j CLASSIFY --set-class 1:c50
+""".split("\n"))
+
+    @out
+    def test_reload(self):
+        """Reshape, add and remove tiers"""
+        self.router.bind("192.168.15.2", "eth2", "qos1")
+        os.unlink(self.cur)
+        def change(doc):
+            doc['qos']['qos1']['netem'] = "delay 50ms"
+            doc['interfaces']['eth1']['qos'] = ["qos1", "qos4"]
+        self.reloaded(change)
+        output = file(self.cur).read()
+        for command in ["tc class del dev eth1 parent 1: classid 1:c20 drr",
+                        "tc class del dev eth0 parent 1: classid 1:c20 drr",
+                        "tc class add dev eth1 parent 1: classid 1:c20 drr",
+                        "tc qdisc add dev eth1 parent 1:c20 handle c20: cake bandwidth 10gbit dual-srchost nat",
+                        "qdisc change dev eth2 parent 1:c30 handle c30: netem delay 50ms",
+                        "qdisc change dev eth0 parent 1:c10 handle c10: netem delay 50ms"]:
+            self.assertIn(command, output)
+        self.assertEqual(sorted(self.binder.tiers.clients),
+                         [("eth1", "qos1"), ("eth1", "qos4"),
+                          ("eth2", "qos1"), ("eth2", "qos3"), ("eth2", "qos4")])
+
+class TestBinderIFB(TestBinderAny):
+
+    BINDER = staticmethod(lambda: LinuxBinderIPv4(scheduler="htb", ifb="ifb0"))
+
+    def setUp(self):
+        TestBinderAny.setUp(self)
+        doc = yaml.load(self.router_doc)
+        doc['clients'] = ["eth0", "eth3"]
+        self.router = Router.load(doc)
+        self.router.register(self.binder)
+
+    @out
+    def test_setup(self):
+        """Redirect incoming interfaces to the IFB device"""
+        self.router.notify("start")
+        output = file(self.cur).read()
+        for command in ["ip link add dev ifb0 numtxqueues 1 type ifb",
+                        "ip link set up dev ifb0",
+                        "tc qdisc add dev eth0 clsact",
+                        "tc filter add dev eth0 egress matchall action mirred egress redirect dev ifb0",
+                        "tc filter add dev eth3 egress matchall action mirred egress redirect dev ifb0",
+                        "tc qdisc add dev ifb0 root handle 1: htb",
+                        "tc class add dev ifb0 parent 1: classid 1:a1 htb rate 10gbit ceil 10gbit",
+                        "iptables -t mangle -A kitero-POSTROUTING -o eth0 -j CLASSIFY --set-class 1:2",
+                        "iptables -t mangle -A kitero-POSTROUTING -o eth3 -j CLASSIFY --set-class 1:2"]:
+            self.assertIn(command, output)
+        self.assertNotIn("tc qdisc add dev eth0 root", output)
+        self.assertNotIn("-o ifb0", output)
+
+    @out
+    def test_ifb_from_config(self):
+        """Use the IFB device from the configuration of the helper"""
+        self.binder.config['ifb'] = None
+        self.router.notify("start", config=dict(ifb="ifb1"))
+        self.assertIn("tc qdisc add dev ifb1 root handle 1: htb", file(self.cur).read())
+
+    @out
+    def test_bind(self):
+        """Build download classes only on the IFB device"""
+        self.router.bind("192.168.15.2", "eth2", "qos4")
+        os.unlink(self.cur)
+        self.router.bind("192.168.15.3", "eth2", "qos1")
+        output = file(self.cur).read()
+        self.assertEqual([line for line in output.split("\n") if line.startswith("tc ")],
+"""tc class add dev eth2 parent 1:1 classid 1:20 htb rate 50mbps ceil 50mbps
+tc qdisc add dev eth2 parent 1:20 handle 20: netem delay 100ms 10ms distribution experimental
+tc class add dev ifb0 parent 1:a1 classid 1:20 htb rate 100mbps ceil 100mbps
+tc qdisc add dev ifb0 parent 1:20 handle 20: netem delay 100ms 10ms distribution experimental""".split("\n"))
+        for incoming in ["eth0", "eth3"]:
+            self.assertIn("iptables -t mangle -A kitero-POSTROUTING -o %s -m connmark"
+                          " --mark 0x80400000/0xffc00000 -j CLASSIFY --set-class 1:20" % incoming,
+                          output)
+
+class TestBinderQueues(TestBinderAny):
+
+    BINDER = staticmethod(lambda: LinuxBinderIPv4(queues=4))
+
+    @out
+    def test_setup(self):
+        """Setup a tree of classes for each queue"""
+        self.router.notify("start")
+        output = file(self.cur).read()
+        for command in ["tc qdisc add dev eth2 root handle 1: mq",
+                        "tc qdisc add dev eth2 clsact",
+                        "tc qdisc add dev eth2 parent 1:1 handle b1: drr",
+                        "tc class add dev eth2 parent b1: classid b1:2 drr",
+                        "tc qdisc add dev eth2 parent b1:2 handle d1: sfq",
+                        "tc filter add dev eth2 parent b1: prio 1 matchall flowid b1:2",
+                        "tc filter add dev eth2 egress prio 1 basic"
+                        " match meta(priority mask 0xffff0000 eq 0xb10000)"
+                        " action skbedit queue_mapping 0",
+                        "tc qdisc add dev eth0 parent 1:4 handle b4: drr",
+                        "iptables -t mangle -A kitero-POSTROUTING -o eth0 -j CLASSIFY --set-class 1:2"]:
+            self.assertIn(command, output)
+        self.assertNotIn("parent 1:5", output)
+
+    @out
+    def test_bind(self):
+        """Spread clients over queues"""
+        self.router.bind("192.168.15.2", "eth2", "qos4")
+        os.unlink(self.cur)
+        self.router.bind("192.168.15.3", "eth1", "qos2")
+        output = file(self.cur).read()
+        for command in ["tc class add dev eth1 parent b3: classid b3:20 drr",
+                        "tc qdisc add dev eth1 parent b3:20 handle 20: tbf rate 10mbps buffer 10Mbit latency 1s",
+                        "tc qdisc add dev eth1 parent 20:1 handle 21: netem delay 200ms 10ms",
+                        "tc class add dev eth0 parent b3: classid b3:20 drr",
+                        "iptables -t mangle -A kitero-POSTROUTING -o eth0 -m connmark"
+                        " --mark 0x40000000/0xffc00000 -j CLASSIFY --set-class b3:20"]:
+            self.assertIn(command, output)
+        os.unlink(self.cur)
+        self.router.rebind("192.168.15.3", "eth1", "qos1")
+        self.assertIn("tc qdisc change dev eth0 parent b3:20 handle 20: tbf rate 100mbps",
+                      file(self.cur).read())
+
+    def test_shaping(self):
+        """Reject trees sharing bandwidth"""
+        self.binder.config['scheduler'] = "htb"
+        with self.assertRaises(ValueError):
+            self.router.notify("start")
+
+    @out
+    def test_tiers(self):
+        """Spread tiers over queues"""
+        self.router.notify("start", config=dict(scheduler="cake"))
+        output = file(self.cur).read()
+        self.assertIn("tc class add dev eth1 parent b2: classid b2:c10 drr", output)
+        self.assertIn("tc qdisc add dev eth0 parent b2:c10 handle c10: netem"
+                      " delay 100ms 10ms distribution experimental", output)
+        self.assertIn("tc class add dev eth2 parent b1: classid b1:c40 drr", output)
+
 from kitero.helper.binder import Mark
 
 class TestMark(unittest.TestCase):
@@ -491,6 +1005,15 @@ class TestSlots(unittest.TestCase):
         with self.assertRaises(ValueError):
             s.get("192.168.1.10")
 
+    def test_preferred_slots(self):
+        """Request preferred slots"""
+        s = SlotsProvider(10)
+        self.assertEqual(s.request("eth1", "192.168.1.1", 4), 4)
+        self.assertEqual(s.request("eth1", "192.168.1.2"), 0)
+        self.assertEqual(s.request("eth1", "192.168.1.3", 4), 1)
+        self.assertEqual(s.request("eth1", "192.168.1.4", 10), 2)
+        self.assertEqual(s.request("eth2", "192.168.1.5", 4), 4)
+
 from kitero.helper.binder import TicketsProvider
 
 class TestTickets(unittest.TestCase):
@@ -533,3 +1056,12 @@ class TestTickets(unittest.TestCase):
         self.assertEqual(t.release("192.168.1.2"), 2)
         with self.assertRaises(ValueError):
             t.release("192.168.1.2")
+
+    def test_preferred_tickets(self):
+        """Request preferred tickets"""
+        t = TicketsProvider()
+        self.assertEqual(t.request("192.168.1.1", 5), 5)
+        self.assertEqual(t.request("192.168.1.2"), 1)
+        self.assertEqual(t.request("192.168.1.3", 5), 2)
+        self.assertEqual(t.request("192.168.1.4", 0), 3)
+        self.assertEqual(t.request("192.168.1.5", 4), 4)
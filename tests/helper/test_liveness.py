@@ -0,0 +1,118 @@
+try:
+    import unittest2 as unittest
+except ImportError: # pragma: no cover
+    import unittest
+
+import time
+import threading
+import zope.interface
+
+from kitero.helper.router import Router, Interface, QoS
+from kitero.helper.liveness import Liveness
+from kitero.helper.interface import IBinder, IStatsProvider, INeighborsProvider
+
+class FakeBinder(object):
+    zope.interface.implements(IBinder, IStatsProvider, INeighborsProvider)
+
+    def __init__(self):
+        self.counters = {}
+        self.present = set()
+
+    def notify(self, event, source, **kwargs):
+        pass
+
+    def stats(self):
+        return {'eth1': {'details': dict((client, dict(up=up, down=down))
+                                         for client, (up, down)
+                                         in self.counters.items())}}
+
+    def neighbors(self):
+        return self.present
+
+class TestLiveness(unittest.TestCase):
+    def setUp(self):
+        q1 = QoS("100M", "My first QoS")
+        i1 = Interface("LAN", "My first interface", {'qos1': q1})
+        self.router = Router("eth0", interfaces={'eth1': i1})
+        self.router.bind("192.168.15.1", "eth1", "qos1")
+        self.liveness = Liveness(self.router, threading.RLock(), 10)
+        self.router.register(self.liveness)
+
+    def test_bound_clients(self):
+        """Track bound clients only"""
+        self.router.bind("192.168.15.2", "eth1", "qos1")
+        self.assertIn("192.168.15.1", self.liveness.expiry)
+        self.assertIn("192.168.15.2", self.liveness.expiry)
+        self.assertTrue(self.liveness.heartbeat("192.168.15.2"))
+        self.assertFalse(self.liveness.heartbeat("192.168.15.3"))
+        self.assertNotIn("192.168.15.3", self.liveness.expiry)
+        self.router.unbind("192.168.15.2")
+        self.assertNotIn("192.168.15.2", self.liveness.expiry)
+
+    def test_expire(self):
+        """Unbind clients without heartbeat"""
+        self.router.bind("192.168.15.2", "eth1", "qos1")
+        self.liveness.heartbeat("192.168.15.2", 100)
+        self.assertEqual(self.liveness.expire(time.time() + 50),
+                         ["192.168.15.1"])
+        self.assertEqual(self.router.clients.keys(), ["192.168.15.2"])
+        self.assertEqual(self.liveness.expire(time.time() + 150),
+                         ["192.168.15.2"])
+        self.assertEqual(self.router.clients, {})
+
+    def test_background(self):
+        """Unbind clients in the background"""
+        self.liveness.heartbeat("192.168.15.1", 0.1)
+        self.liveness.start()
+        try:
+            time.sleep(0.3)
+            self.assertEqual(self.router.clients, {})
+        finally:
+            self.liveness.stop()
+
+class TestIdle(unittest.TestCase):
+    def setUp(self):
+        q1 = QoS("100M", "My first QoS")
+        i1 = Interface("LAN", "My first interface", {'qos1': q1})
+        self.router = Router("eth0", interfaces={'eth1': i1})
+        self.binder = FakeBinder()
+        self.router.register(self.binder)
+        self.liveness = Liveness(self.router, threading.RLock(), 10, idle=60)
+        self.router.register(self.liveness)
+        for client in ["192.168.15.1", "192.168.15.2", "192.168.15.3"]:
+            self.router.bind(client, "eth1", "qos1")
+
+    def test_idle(self):
+        """Unbind clients without traffic and without neighbor entry"""
+        self.binder.counters = {"192.168.15.1": (10, 10),
+                                "192.168.15.2": (10, 10)}
+        self.binder.present = set(["192.168.15.3"])
+        self.assertEqual(self.liveness.detect(1000), [])
+        self.binder.counters["192.168.15.1"] = (20, 10)
+        self.assertEqual(self.liveness.detect(1030), [])
+        self.binder.counters["192.168.15.1"] = (30, 10)
+        self.assertEqual(self.liveness.detect(1070), ["192.168.15.2"])
+        self.assertEqual(sorted(self.router.clients.keys()),
+                         ["192.168.15.1", "192.168.15.3"])
+
+    def test_heartbeat(self):
+        """Activity counts as a heartbeat"""
+        self.liveness.heartbeat("192.168.15.1", 1)
+        self.binder.present = set(["192.168.15.1"])
+        self.liveness.detect()
+        self.assertEqual(self.liveness.expire(time.time() + 5), [])
+
+    def test_no_activity(self):
+        """Unbind idle clients even when heartbeats are received"""
+        self.liveness.detect(1000)
+        self.liveness.heartbeat("192.168.15.1")
+        self.assertEqual(sorted(self.liveness.detect(1061)),
+                         ["192.168.15.1", "192.168.15.2", "192.168.15.3"])
+        self.assertEqual(self.router.clients, {})
+
+    def test_no_information(self):
+        """Do not unbind clients when nothing is known about them"""
+        self.router._neighbors = None
+        self.liveness.detect(1000)
+        self.assertEqual(self.liveness.detect(2000), [])
+        self.assertEqual(len(self.router.clients), 3)
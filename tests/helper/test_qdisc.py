@@ -0,0 +1,122 @@
+try:
+    import unittest2 as unittest
+except ImportError: # pragma: no cover
+    import unittest
+
+from kitero.helper.qdisc import plan, link, Plan, Qdisc, Class, Classes, TREES
+
+class TestPlan(unittest.TestCase):
+
+    def test_no_qos(self):
+        """Use SFQ without QoS settings"""
+        sfq = (Qdisc("1:%(ticket)s0", "%(ticket)s0:", "sfq", ()),)
+        self.assertEqual(plan({}), Plan(up=sfq, down=sfq))
+        self.assertEqual(sfq[0].spec, "sfq")
+
+    def test_bandwidth(self):
+        """Use TBF for bandwidth limits"""
+        p = plan({'bandwidth': {'up': "1mbit buffer 20kbit latency 1s"}})
+        self.assertEqual(p.up, (Qdisc("1:%(ticket)s0", "%(ticket)s0:", "tbf",
+                                      ("rate", "1mbit", "buffer", "20kbit",
+                                       "latency", "1s")),))
+        self.assertEqual(p.up[0].spec, "tbf rate 1mbit buffer 20kbit latency 1s")
+        self.assertEqual(p.down[0].kind, "sfq")
+
+    def test_netem(self):
+        """Use netem alone or below TBF"""
+        p = plan({'netem': "delay 100ms 10ms distribution experimental",
+                  'bandwidth': {'down': "10mbps burst 10Mbit limit 15000"}})
+        self.assertEqual([q.kind for q in p.up], ["netem"])
+        self.assertEqual([q.kind for q in p.down], ["tbf", "netem"])
+        self.assertEqual(p.down[1].parent, "%(ticket)s0:1")
+        self.assertEqual(p.down[1].handle, "%(ticket)s1:")
+        self.assertEqual(p.down[1].spec, "netem delay 100ms 10ms distribution experimental")
+        p = plan({'netem': {'up': "delay 10ms 2ms loss 0.01%"}})
+        self.assertEqual(p.up[0].spec, "netem delay 10ms 2ms loss 0.01%")
+
+    def test_immutable(self):
+        """Plans cannot be modified"""
+        p = plan({'netem': "delay 100ms"})
+        with self.assertRaises(AttributeError):
+            p.up = ()
+        with self.assertRaises(TypeError):
+            p.up[0] = None
+
+    def test_invalid(self):
+        """Reject invalid settings"""
+        for settings in [{'bandwidth': "fast"},
+                         {'bandwidth': "10mbit"},
+                         {'bandwidth': "10mbit buffer 10kbit"},
+                         {'bandwidth': "10mbit buffer 10kbit latency"},
+                         {'bandwidth': "10mbit buffer 10kbit latency soon"},
+                         {'bandwidth': "10mbit buffer 10kbit latency 1s speed 4"},
+                         {'bandwidth': {'upload': "10mbit buffer 10kbit latency 1s"}},
+                         {'netem': ""},
+                         {'netem': "100ms"},
+                         {'netem': "delay 100ms jitter 10ms"},
+                         {'netem': {'down': "delay 100ms; reboot"}}]:
+            with self.assertRaises(ValueError):
+                plan(settings)
+
+class TestTree(unittest.TestCase):
+
+    def test_drr(self):
+        """Use DRR classes by default"""
+        p = plan({'bandwidth': "1mbit buffer 20kbit latency 1s", 'ceil': "2mbit"})
+        self.assertEqual(p.classes, Classes(Class("drr", ()), Class("drr", ())))
+        self.assertEqual(p.up[0].kind, "tbf")
+        self.assertEqual(TREES['drr'].parent(3), "1:")
+
+    def test_htb(self):
+        """Limit bandwidth with HTB classes"""
+        htb = TREES['htb']
+        p = plan({'bandwidth': {'up': "1mbit", 'down': "2mbit buffer 20kbit latency 1s"},
+                  'ceil': {'up': "4mbit"},
+                  'netem': "delay 100ms"}, htb, link(dict(up="10mbit")))
+        self.assertEqual(p.classes.up.spec, "htb rate 1mbit ceil 4mbit")
+        self.assertEqual(p.classes.down.spec, "htb rate 2mbit ceil 2mbit")
+        self.assertEqual(p.up, (Qdisc("1:%(ticket)s0", "%(ticket)s0:", "netem",
+                                      ("delay", "100ms")),))
+        p = plan({}, htb, link(dict(up="10mbit")))
+        self.assertEqual(p.classes.up.spec, "htb rate 10mbit ceil 10mbit")
+        self.assertEqual(p.classes.down.spec, "htb rate 10gbit ceil 10gbit")
+        self.assertEqual(p.up[0].kind, "sfq")
+        self.assertEqual(htb.parent(), "1:1")
+        self.assertEqual(htb.parent(12), "1:a12")
+
+    def test_hfsc(self):
+        """Limit bandwidth with HFSC classes"""
+        p = plan({'ceil': "4mbit"}, TREES['hfsc'])
+        self.assertEqual(p.classes.up.spec, "hfsc sc rate 4mbit ul rate 4mbit")
+
+    def test_cake(self):
+        """Use CAKE for tiers"""
+        cake = TREES['cake']
+        p = plan({'bandwidth': {'up': "1mbit buffer 20kbit latency 1s"},
+                  'netem': {'down': "delay 100ms"}}, cake, link(dict(down="20mbit")))
+        self.assertEqual(p.classes.up.spec, "drr")
+        self.assertEqual(p.up, (Qdisc("1:%(ticket)s0", "%(ticket)s0:", "cake",
+                                      ("bandwidth", "1mbit", "dual-srchost", "nat")),))
+        self.assertEqual([q.spec for q in p.down],
+                         ["netem delay 100ms", "cake bandwidth 20mbit dual-dsthost"])
+        self.assertEqual(p.down[1].parent, "%(ticket)s0:1")
+        self.assertTrue(cake.tiers)
+        self.assertFalse(TREES['htb'].tiers)
+
+    def test_link(self):
+        """Check the bandwidth of a link"""
+        self.assertEqual(link(None), dict(up="10gbit", down="10gbit"))
+        self.assertEqual(link("100mbit"), dict(up="100mbit", down="100mbit"))
+        self.assertEqual(link(dict(down="1gbit")), dict(up="10gbit", down="1gbit"))
+        for rates in ["fast", dict(upload="1mbit"), dict(up="1mbit; reboot")]:
+            with self.assertRaises(ValueError):
+                link(rates)
+
+    def test_invalid(self):
+        """Reject invalid ceilings and bandwidths"""
+        for settings in [{'ceil': "fast"},
+                         {'ceil': {'up': "1mbit", 'side': "1mbit"}},
+                         {'bandwidth': "1mbit buffer"},
+                         {'bandwidth': "1mbit speed 4"}]:
+            with self.assertRaises(ValueError):
+                plan(settings, TREES['htb'])
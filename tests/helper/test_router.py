@@ -11,7 +11,8 @@ import cPickle as pickle
 import zope.interface
 
 from kitero.helper.router import Router, Interface, QoS
-from kitero.helper.interface import IBinder, IStatsProvider
+from kitero.helper.interface import IBinder, IStatsProvider, IHintsProvider, \
+    IBatchBinder, IRebinder
 
 class TestQoSBasic(unittest.TestCase):
     def test_build_empty_qos(self):
@@ -356,6 +357,28 @@ interfaces:
         r = Router.load(yaml.load(doc))
         self.assertEqual(r.incoming, ["eth0", "eth2"])
 
+    def test_load_bandwidth(self):
+        """Load router with the bandwidth of interfaces"""
+        doc = """
+clients: eth0
+interfaces:
+  eth1:
+    name: LAN
+    description: "My first interface"
+    bandwidth: 100mbit
+  eth2:
+    name: WAN
+    description: "My second interface"
+    bandwidth:
+      up: 1mbit
+      down: 20mbit
+"""
+        r = Router.load(yaml.load(doc))
+        self.assertEqual(r.interfaces["eth1"].bandwidth, "100mbit")
+        self.assertEqual(r.interfaces["eth2"].bandwidth, dict(up="1mbit", down="20mbit"))
+        self.assertNotEqual(r.interfaces["eth1"],
+                            Interface("LAN", "My first interface"))
+
     def test_load_unknown_qos(self):
         """Load router from YAML with unknown QoS"""
         doc = """
@@ -428,6 +451,7 @@ class TestRouterObserver(unittest.TestCase):
         self.assertEqual(last['args']['client'], '192.168.15.2')
         self.assertEqual(last['args']['interface'], 'eth2')
         self.assertEqual(last['args']['qos'], 'qos1')
+        self.assertEqual(last['args']['hints'], {})
         self.router.bind("192.168.15.3", "eth2", "qos1")
         self.assertEqual(last['event'], 'bind')
         self.assertEqual(last['source'], self.router)
@@ -481,6 +505,23 @@ class TestRouterObserver(unittest.TestCase):
         finally:
             shutil.rmtree(temp)
 
+    def test_hints(self):
+        """Register an observer that also implements IHintsProvider"""
+        class Observer(object):
+            zope.interface.implements(IBinder, IHintsProvider)
+            def __init__(self):
+                self.received = {}
+            def notify(self, event, source, **kwargs):
+                if event == "bind":
+                    self.received[kwargs['client']] = kwargs['hints']
+            def hints(self, client):
+                return {'slot': 4}
+        obs = Observer()
+        self.router.register(obs)
+        self.router.bind("192.168.15.2", "eth2", "qos1", hints={'slot': 7})
+        self.assertEqual(obs.received, {"192.168.15.2": {'slot': 7}})
+        self.assertEqual(self.router.hints("192.168.15.2"), {'slot': 4})
+
     def test_stats(self):
         """Register an observer that also implements IStatsProvider"""
         class Observer(object):
@@ -498,6 +539,146 @@ class TestRouterObserver(unittest.TestCase):
                          {'eth1': {'clients': 0, 'up': 47, 'down': 255, 'details': {}},
                           'eth2': {'clients': 0, 'details': {}}})
 
+    def test_batch(self):
+        """Bind and unbind several clients at once"""
+        class Observer(object):
+            zope.interface.implements(IBinder)
+            def __init__(self):
+                self.events = []
+            def notify(self, event, source, **kwargs):
+                self.events.append((event, kwargs['client']))
+        class BatchObserver(Observer):
+            zope.interface.implements(IBatchBinder)
+            def notify(self, event, source, **kwargs):
+                self.events.append((event, [(e, kw['client'])
+                                            for e, kw in kwargs['events']]))
+        obs, batch = Observer(), BatchObserver()
+        self.router.register(obs)
+        self.router.register(batch)
+        self.router.bind_many([("192.168.15.2", "eth2", "qos1"),
+                               ("192.168.15.3", "eth1", "qos2", {'slot': 4})])
+        self.assertEqual(self.router.clients, {"192.168.15.2": ("eth2", "qos1"),
+                                               "192.168.15.3": ("eth1", "qos2")})
+        self.router.unbind_many(["192.168.15.3", "192.168.15.4",
+                                 "192.168.15.3", "192.168.15.2"])
+        self.assertEqual(self.router.clients, {})
+        self.assertEqual(obs.events, [("bind", "192.168.15.2"),
+                                      ("bind", "192.168.15.3"),
+                                      ("unbind", "192.168.15.3"),
+                                      ("unbind", "192.168.15.2")])
+        self.assertEqual(batch.events,
+                         [("batch", [("bind", "192.168.15.2"),
+                                     ("bind", "192.168.15.3")]),
+                          ("batch", [("unbind", "192.168.15.3"),
+                                     ("unbind", "192.168.15.2")])])
+        # Nothing to do
+        self.router.bind_many([])
+        self.router.unbind_many(["192.168.15.2"])
+        self.assertEqual(len(batch.events), 2)
+
+    def test_rebind(self):
+        """Change the binding of a client"""
+        class Observer(object):
+            zope.interface.implements(IBinder)
+            def __init__(self):
+                self.events = []
+            def notify(self, event, source, **kwargs):
+                self.events.append((event, kwargs['client'], kwargs.get('qos')))
+        class Rebinder(Observer):
+            zope.interface.implements(IRebinder)
+        obs, rebinder = Observer(), Rebinder()
+        self.router.register(obs)
+        self.router.register(rebinder)
+        self.router.rebind("192.168.15.2", "eth1", "qos1")
+        self.router.rebind("192.168.15.2", "eth1", "qos1")
+        self.router.rebind("192.168.15.2", "eth1", "qos2")
+        self.assertEqual(self.router.clients["192.168.15.2"], ("eth1", "qos2"))
+        self.router.rebind("192.168.15.2", "eth2", "qos1")
+        self.assertEqual(self.router.clients["192.168.15.2"], ("eth2", "qos1"))
+        self.assertEqual(obs.events, [("bind", "192.168.15.2", "qos1"),
+                                      ("unbind", "192.168.15.2", None),
+                                      ("bind", "192.168.15.2", "qos2"),
+                                      ("unbind", "192.168.15.2", None),
+                                      ("bind", "192.168.15.2", "qos1")])
+        self.assertEqual(rebinder.events, [("bind", "192.168.15.2", "qos1"),
+                                           ("rebind", "192.168.15.2", "qos2"),
+                                           ("unbind", "192.168.15.2", None),
+                                           ("bind", "192.168.15.2", "qos1")])
+
+    def test_rebind_password(self):
+        """Keep the binding of a client providing an incorrect password"""
+        q1 = QoS("100M", "My first QoS")
+        self.router = Router("eth0", interfaces={
+                'eth1': Interface("LAN", "My first interface", {'qos1': q1}),
+                'eth2': Interface("WAN", "My second interface", {'qos1': q1},
+                                  password="1234")})
+        self.router.bind("192.168.15.2", "eth1", "qos1")
+        with self.assertRaises(AssertionError):
+            self.router.rebind("192.168.15.2", "eth2", "qos1", "4321")
+        self.assertEqual(self.router.clients["192.168.15.2"], ("eth1", "qos1"))
+        self.router.rebind("192.168.15.2", "eth2", "qos1", "1234")
+        self.assertEqual(self.router.clients["192.168.15.2"], ("eth2", "qos1"))
+
+    def test_batch_invalid(self):
+        """Do not bind anything if a binding is invalid"""
+        self.router.bind("192.168.15.2", "eth2", "qos1")
+        for bindings in [[("192.168.15.3", "eth1", "qos1"),
+                          ("192.168.15.3", "eth1", "qos2")],
+                         [("192.168.15.3", "eth1", "qos1"),
+                          ("192.168.15.2", "eth1", "qos2")],
+                         [("192.168.15.3", "eth1", "qos1"),
+                          ("192.168.15.4", "eth2", "qos2")],
+                         [("192.168.15.3", "eth1", "qos1"),
+                          ("192.168.15.4", "eth3", "qos1")]]:
+            with self.assertRaises((ValueError, KeyError)):
+                self.router.bind_many(bindings)
+            self.assertEqual(self.router.clients.keys(), ["192.168.15.2"])
+
+    def test_reload(self):
+        """Reload the interfaces of a router"""
+        class Observer(object):
+            zope.interface.implements(IBinder)
+            def __init__(self):
+                self.events = []
+            def notify(self, event, source, **kwargs):
+                if event == "reload":
+                    self.events.append((event, sorted(kwargs['previous'])))
+                else:
+                    self.events.append((event, kwargs['client']))
+        obs = Observer()
+        self.router.register(obs)
+        self.router.bind("192.168.15.2", "eth1", "qos1")
+        self.router.bind("192.168.15.3", "eth1", "qos2")
+        self.router.bind("192.168.15.4", "eth2", "qos1")
+        q1 = QoS("1G", "My new QoS")
+        self.router.reload(Router("eth0", interfaces={
+                    'eth1': Interface("LAN", "My interface", {'qos1': q1}),
+                    'eth3': Interface("DMZ", "My new interface", {'qos1': q1})}))
+        self.assertEqual(sorted(self.router.interfaces), ["eth1", "eth3"])
+        self.assertEqual(self.router.clients, {"192.168.15.2": ("eth1", "qos1")})
+        self.assertEqual(sorted(obs.events[3:5]), [("unbind", "192.168.15.3"),
+                                                   ("unbind", "192.168.15.4")])
+        self.assertEqual(obs.events[5:], [("reload", ["eth1", "eth2"])])
+        with self.assertRaises(ValueError):
+            self.router.reload(Router("eth4"))
+
+    def test_reload_failure(self):
+        """Keep the interfaces of a router when an observer fails"""
+        class Observer(object):
+            zope.interface.implements(IBinder)
+            def notify(self, event, source, **kwargs):
+                if event == "reload":
+                    raise ValueError("invalid")
+        self.router.register(Observer())
+        self.router.bind("192.168.15.2", "eth1", "qos1")
+        self.router.bind("192.168.15.3", "eth2", "qos1")
+        interfaces = self.router.interfaces
+        clients = self.router.clients
+        with self.assertRaises(ValueError):
+            self.router.reload(Router("eth0"))
+        self.assertEqual(self.router.interfaces, interfaces)
+        self.assertEqual(self.router.clients, clients)
+
 class PickableObserver(object):
     zope.interface.implements(IBinder)
     def __init__(self, target):
@@ -6,8 +6,15 @@ except ImportError: # pragma: no cover
 import socket
 import json
 import time
+import threading
+import tempfile
+import shutil
+import os
+import struct
+import stat
 
 from kitero.helper.rpc import RPCRequestHandler, RPCServer, expose
+from kitero import codec
 
 class DummyRPCHandler(RPCRequestHandler):
     def not_exposed(self): # pragma: no cover
@@ -33,6 +40,15 @@ class DummyRPCHandler(RPCRequestHandler):
                 "Bli": "Blo"
                 }}
 
+    @expose
+    def with_encoded_result(self):
+        return codec.RawJSON('{"s1":[1,2]}')
+
+    @expose
+    def slow(self, delay):
+        time.sleep(delay)
+        return delay
+
     @expose
     def with_exception(self):
         raise RuntimeError("Sorry...")
@@ -117,7 +133,224 @@ class TestRPCServer(unittest.TestCase):
         self.assertEqual(answer["exception"]["class"], u"ValueError")
         sock.close()
 
+    def test_many_connections(self):
+        """Serve many connections without a thread for each of them"""
+        threads = threading.active_count()
+        socks = []
+        for i in range(50):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.connect(('127.0.0.1', 18861))
+            socks.append(sock)
+        # Send all requests before reading any answer
+        for i, sock in enumerate(socks):
+            sock.sendall("%s\n" % json.dumps(("with_arguments", i, "x")))
+        for i, sock in enumerate(socks):
+            answer = json.loads(sock.makefile('rb').readline())
+            self.assertEqual(answer, {u"status": 0,
+                                      u"value": [u"Hello", i, u"and", u"x"]})
+        self.assertLessEqual(threading.active_count(), threads)
+        for sock in socks:
+            sock.close()
+
+    def test_pipelined_requests(self):
+        """Answer pipelined requests in order"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect(('127.0.0.1', 18861))
+        sock.sendall("".join(["%s\n" % json.dumps(("with_arguments", i, "x"))
+                              for i in range(20)]))
+        read = sock.makefile('rb')
+        for i in range(20):
+            answer = json.loads(read.readline())
+            self.assertEqual(answer["value"], [u"Hello", i, u"and", u"x"])
+        sock.close()
+
+    def test_batch(self):
+        """Execute several calls at once"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect(('127.0.0.1', 18861))
+        read, write = sock.makefile('rb'), sock.makefile('wb', 0)
+        write.write("%s\n" % json.dumps(("batch", [
+                        ("with_arguments", 1, 2),
+                        ("with_exception",),
+                        ("not_exposed",),
+                        ("without_args",)])))
+        answer = json.loads(read.readline())
+        self.assertEqual(answer["status"], 0)
+        answers = answer["value"]
+        self.assertEqual(answers[0], {u"status": 0,
+                                      u"value": [u"Hello", 1, u"and", 2]})
+        self.assertEqual(answers[1]["exception"]["class"], u"RuntimeError")
+        self.assertEqual(answers[2]["exception"]["class"], u"ValueError")
+        self.assertEqual(answers[3], {u"status": 0, u"value": u"Hi!"})
+        # Not a list
+        write.write("%s\n" % json.dumps(("batch", "without_args")))
+        answer = json.loads(read.readline())
+        self.assertEqual(answer["status"], -1)
+        self.assertEqual(answer["exception"]["class"], u"ValueError")
+        sock.close()
+
+    def test_request_ids(self):
+        """Answer requests with an identifier out of order"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect(('127.0.0.1', 18861))
+        read = sock.makefile('rb')
+        sock.sendall("%s\n%s\n" % (
+                json.dumps({"id": 1, "call": ("slow", 0.5)}),
+                json.dumps({"id": "second", "call": ("with_arguments", 1, 2)})))
+        answer = json.loads(read.readline())
+        self.assertEqual(answer, {u"id": u"second", u"status": 0,
+                                  u"value": [u"Hello", 1, u"and", 2]})
+        answer = json.loads(read.readline())
+        self.assertEqual(answer, {u"id": 1, u"status": 0, u"value": 0.5})
+        # Errors also carry the identifier
+        sock.sendall("%s\n" % json.dumps({"id": 3, "call": ("not_exist",)}))
+        answer = json.loads(read.readline())
+        self.assertEqual(answer["id"], 3)
+        self.assertEqual(answer["status"], -1)
+        self.assertEqual(answer["exception"]["class"], u"AttributeError")
+        sock.close()
+
+    def test_raw_requests(self):
+        """Answer raw requests with the value last"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect(('127.0.0.1', 18861))
+        read = sock.makefile('rb')
+        sock.sendall("%s\n" % json.dumps({"id": 4, "raw": True,
+                                           "call": ("with_complex_result",)}))
+        answer = read.readline()
+        self.assertTrue(answer.startswith('{"id":4,"status":0,"value":{'))
+        self.assertEqual(json.loads(answer)["value"]["s1"]["s2"], u"Hello")
+        sock.close()
+
+    def test_encoded_results(self):
+        """Include already encoded results as is"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect(('127.0.0.1', 18861))
+        read = sock.makefile('rb')
+        sock.sendall("%s\n" % json.dumps(("with_encoded_result",)))
+        self.assertEqual(read.readline(), '{"status":0,"value":{"s1":[1,2]}}\n')
+        sock.sendall("%s\n" % json.dumps({"id": 4, "call": ("with_encoded_result",)}))
+        self.assertEqual(read.readline(), '{"id":4,"status":0,"value":{"s1":[1,2]}}\n')
+        sock.sendall("%s\n" % json.dumps(("batch", [("with_encoded_result",)])))
+        self.assertEqual(json.loads(read.readline())["value"],
+                         [{"status": 0, "value": {"s1": [1, 2]}}])
+        sock.close()
+
+    def test_negotiate(self):
+        """Negotiate a codec"""
+        if "msgpack" not in codec.codecs:
+            self.skipTest("msgpack not available")
+        msgpack = codec.get("msgpack")
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect(('127.0.0.1', 18861))
+        read = sock.makefile('rb')
+        # Unknown codec
+        sock.sendall("%s\n" % json.dumps(("negotiate", "xml")))
+        answer = json.loads(read.readline())
+        self.assertEqual(answer["status"], -1)
+        self.assertEqual(answer["exception"]["class"], u"ValueError")
+        # Switch to msgpack
+        sock.sendall("%s\n" % json.dumps(("negotiate", "xml", "msgpack", "json")))
+        answer = json.loads(read.readline())
+        self.assertEqual(answer, {u"status": 0, u"value": u"msgpack"})
+        def call(request):
+            sock.sendall(msgpack.frame(msgpack.dumps(request)))
+            length, = struct.unpack("!I", read.read(4))
+            return msgpack.loads(read.read(length))
+        self.assertEqual(call(("with_arguments", 1, "\n")),
+                         {u"status": 0, u"value": [u"Hello", 1, u"and", u"\n"]})
+        self.assertEqual(call({"id": 7, "call": ("without_args",)}),
+                         {u"id": 7, u"status": 0, u"value": u"Hi!"})
+        # Raw requests are not supported with msgpack
+        self.assertEqual(call({"id": 8, "raw": True, "call": ("without_args",)}),
+                         {u"id": 8, u"status": 0, u"value": u"Hi!"})
+        self.assertEqual(call(("with_encoded_result",)),
+                         {u"status": 0, u"value": {u"s1": [1, 2]}})
+        # Empty message
+        sock.sendall(struct.pack("!I", 0))
+        length, = struct.unpack("!I", read.read(4))
+        self.assertEqual(msgpack.loads(read.read(length))["status"], -1)
+        sock.close()
+
+    def test_mixed_requests(self):
+        """Requests without identifier wait for previous requests"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect(('127.0.0.1', 18861))
+        read = sock.makefile('rb')
+        sock.sendall("%s\n%s\n%s\n" % (
+                json.dumps({"id": 1, "call": ("slow", 0.3)}),
+                json.dumps(("without_args",)),
+                json.dumps({"id": 2, "call": ("without_args",)})))
+        answers = [json.loads(read.readline()) for i in range(3)]
+        self.assertEqual(answers, [{u"id": 1, u"status": 0, u"value": 0.3},
+                                   {u"status": 0, u"value": u"Hi!"},
+                                   {u"id": 2, u"status": 0, u"value": u"Hi!"}])
+        sock.close()
+
     def tearDown(self):
         self.server.stop()
         del self.server
 
+class TestUnixRPCServer(unittest.TestCase):
+    def setUp(self):
+        self.temp = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp, "kitero.sock")
+        self.server = RPCServer.run(self.path, None, DummyRPCHandler)
+
+    def test_unix_socket(self):
+        """Run RPC over a Unix socket"""
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        read, write = sock.makefile('rb'), sock.makefile('wb', 0)
+        write.write("%s\n" % json.dumps(("with_arguments", 45, u"hello")))
+        answer = json.loads(read.readline())
+        self.assertEqual(answer, {u"status": 0, u"value": [u"Hello", 45, u"and", u"hello"]})
+        sock.close()
+        self.server.stop()
+        self.assertFalse(os.path.exists(self.path))
+        # Stale socket is removed
+        open(self.path, "w").close()
+        with self.assertRaises(socket.error):
+            RPCServer(self.path)
+        os.unlink(self.path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.path)
+        sock.close()
+        self.server = RPCServer.run(self.path, None, DummyRPCHandler)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        sock.sendall("%s\n" % json.dumps(("ping",)))
+        answer = json.loads(sock.makefile('rb').readline())
+        self.assertEqual(answer, {u"status": 0, u"value": None})
+        sock.close()
+
+    def test_credentials(self):
+        """Refuse connections from unauthorized users"""
+        self.assertEqual(self.server.uids, set([os.getuid()]))
+        self.server.uids = set()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        self.assertEqual(sock.makefile('rb').readline(), "")
+        sock.close()
+
+    def test_mode(self):
+        """Let any user connect to the socket, whatever the umask"""
+        self.server.stop()
+        umask = os.umask(077)
+        try:
+            self.server = RPCServer.run(self.path, None, DummyRPCHandler)
+        finally:
+            os.umask(umask)
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0666)
+
+    def test_users(self):
+        """Resolve allowed users"""
+        self.server.stop()
+        self.server = RPCServer.run(self.path, None, DummyRPCHandler,
+                                    users=["root", 1000])
+        self.assertEqual(self.server.uids, set([os.getuid(), 0, 1000]))
+
+    def tearDown(self):
+        self.server.stop()
+        del self.server
+        shutil.rmtree(self.temp)
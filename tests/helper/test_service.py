@@ -13,11 +13,12 @@ import time
 import yaml
 import socket
 import json
+import cPickle as pickle
 import zope.interface
 
-from kitero.helper.serve import Service
+from kitero.helper.serve import Service, RouterRPCService, Catalogue
 from kitero.helper.router import Router, Interface, QoS
-from kitero.helper.interface import IBinder
+from kitero.helper.interface import IBinder, IHintsProvider
 
 class TestBadOptions(unittest.TestCase):
     def test_without_args(self):
@@ -331,6 +332,189 @@ qos:
         unbind('192.168.1.1')
         check('192.168.1.1', None)
 
+        # Several clients at once
+        write.write("%s\n" % json.dumps(("unbind_clients",
+                                         ["192.168.1.2", "192.168.1.4"])))
+        self.assertEqual(json.loads(read.readline())["value"], 1)
+        check('192.168.1.2', None)
+        write.write("%s\n" % json.dumps(("unbind_clients",)))
+        self.assertEqual(json.loads(read.readline())["value"], 2)
+        check('192.168.1.3', None)
+        check('2001:db8::1', None)
+
+        sock.close()
+
+    def test_catalogue(self):
+        """Grab the catalogue with its version"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect(('127.0.0.1', 18861))
+        read, write = sock.makefile('rb'), sock.makefile('wb', 0)
+        write.write("%s\n" % json.dumps(("catalogue",)))
+        answer = json.loads(read.readline())
+        self.assertEqual(answer["status"], 0)
+        version = answer["value"]["version"]
+        self.assertEqual(len(version), 40)
+        self.assertEqual(sorted(answer["value"]["interfaces"]), ["eth1", "eth2"])
+        write.write("%s\n" % json.dumps(("interfaces",)))
+        self.assertEqual(json.loads(read.readline())["value"],
+                         answer["value"]["interfaces"])
+        # Already known version
+        write.write("%s\n" % json.dumps(("catalogue", version)))
+        self.assertEqual(json.loads(read.readline()),
+                         {"status": 0, "value": None})
+        # Tagged request and batch
+        write.write("%s\n" % json.dumps({"id": 4, "call": ["catalogue", "1234"]}))
+        tagged = json.loads(read.readline())
+        self.assertEqual(tagged["id"], 4)
+        self.assertEqual(tagged["value"], answer["value"])
+        write.write("%s\n" % json.dumps(("batch", [("interfaces",)])))
+        self.assertEqual(json.loads(read.readline())["value"],
+                         [{"status": 0,
+                           "value": answer["value"]["interfaces"]}])
+        # The version only depends on the content
+        self.assertEqual(Catalogue(RouterRPCService.router).version, version)
+        sock.close()
+
+    def test_heartbeat(self):
+        """Unbind clients without heartbeat"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect(('127.0.0.1', 18861))
+        read, write = sock.makefile('rb'), sock.makefile('wb', 0)
+        write.write("%s\n" % json.dumps(("bind_client", "192.168.1.1", "eth2", "qos3")))
+        self.assertEqual(json.loads(read.readline())["status"], 0)
+        write.write("%s\n" % json.dumps(("heartbeat", "192.168.1.2")))
+        self.assertEqual(json.loads(read.readline())["value"], False)
+        write.write("%s\n" % json.dumps(("heartbeat", "192.168.1.1", 0.2)))
+        self.assertEqual(json.loads(read.readline())["value"], True)
+        time.sleep(0.5)
+        write.write("%s\n" % json.dumps(("client", "192.168.1.1")))
+        self.assertEqual(json.loads(read.readline())["value"], None)
+        sock.close()
+
+    def test_batch(self):
+        """Execute several calls at once"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect(('127.0.0.1', 18861))
+        read, write = sock.makefile('rb'), sock.makefile('wb', 0)
+        write.write("%s\n" % json.dumps(("batch", [
+                        ("bind_client", "192.168.1.1", "eth2", "qos3"),
+                        ("bind_client", "192.168.1.2", "eth2", "qos2"),
+                        ("client", "192.168.1.1"),
+                        ("client", "192.168.1.2")])))
+        answer = json.loads(read.readline())
+        self.assertEqual(answer["status"], 0)
+        answers = answer["value"]
+        self.assertEqual(len(answers), 4)
+        self.assertEqual(answers[0], {"status": 0, "value": None})
+        self.assertEqual(answers[1]["status"], -1)
+        self.assertEqual(answers[2], {"status": 0, "value": ["eth2", "qos3"]})
+        self.assertEqual(answers[3], {"status": 0, "value": None})
+        sock.close()
+
+    def test_subscribe(self):
+        """Subscribe to changes"""
+        sub = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sub.connect(('127.0.0.1', 18861))
+        sread = sub.makefile('rb')
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect(('127.0.0.1', 18861))
+        read, write = sock.makefile('rb'), sock.makefile('wb', 0)
+        write.write("%s\n" % json.dumps(("bind_client", "192.168.1.1", "eth2", "qos3")))
+        self.assertEqual(json.loads(read.readline())["status"], 0)
+        # Subscribe
+        sub.sendall("%s\n" % json.dumps(("subscribe",)))
+        answer = json.loads(sread.readline())
+        self.assertEqual(answer["status"], 0)
+        seq = answer["value"]["seq"]
+        self.assertEqual(answer["value"]["clients"],
+                         {"192.168.1.1": ["eth2", "qos3"]})
+        self.assertEqual(answer["value"]["stats"]["eth2"]["clients"], 1)
+        # Changes
+        write.write("%s\n" % json.dumps(("bind_client", "192.168.1.1", "eth1", "qos1")))
+        self.assertEqual(json.loads(read.readline())["status"], 0)
+        self.assertEqual(json.loads(sread.readline()),
+                         {"event": "unbind", "seq": seq + 1,
+                          "client": "192.168.1.1"})
+        self.assertEqual(json.loads(sread.readline()),
+                         {"event": "bind", "seq": seq + 2,
+                          "client": "192.168.1.1",
+                          "interface": "eth1", "qos": "qos1"})
+        write.write("%s\n" % json.dumps(("seq",)))
+        self.assertEqual(json.loads(read.readline())["value"], seq + 2)
+        # Stats
+        self.service.publisher.sample()
+        event = json.loads(sread.readline())
+        self.assertEqual(event["event"], "stats")
+        self.assertEqual(event["seq"], seq + 3)
+        self.assertEqual(event["stats"]["eth1"]["clients"], 1)
+        # Unsubscribe by closing the connection
+        sread.close()
+        sub.close()
+        time.sleep(0.1)
+        self.service.publisher.sample()
+        self.assertEqual(self.service.publisher.subscribers, [])
+        sock.close()
+
+    def test_reload(self):
+        """Reload the configuration of the router"""
+        sub = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sub.connect(('127.0.0.1', 18861))
+        sread = sub.makefile('rb')
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect(('127.0.0.1', 18861))
+        read, write = sock.makefile('rb'), sock.makefile('wb', 0)
+        # Nothing to reload
+        write.write("%s\n" % json.dumps(("reload",)))
+        self.assertEqual(json.loads(read.readline())["status"], -1)
+        write.write("%s\n" % json.dumps(("bind_client", "192.168.1.1", "eth2", "qos3")))
+        self.assertEqual(json.loads(read.readline())["status"], 0)
+        write.write("%s\n" % json.dumps(("bind_client", "192.168.1.2", "eth1", "qos1")))
+        self.assertEqual(json.loads(read.readline())["status"], 0)
+        version = Catalogue(RouterRPCService.router).version
+        sub.sendall("%s\n" % json.dumps(("subscribe",)))
+        seq = json.loads(sread.readline())["value"]["seq"]
+        # Remove an interface
+        temp = tempfile.mkdtemp()
+        try:
+            self.service.source = os.path.join(temp, "kitero.yaml")
+            f = file(self.service.source, "w")
+            f.write("""
+router:
+  clients: eth0
+  interfaces:
+    eth1:
+      name: LAN
+      description: "My first interface"
+      qos:
+        - qos1
+  qos:
+    qos1:
+      name: 100M
+      description: "My first QoS"
+      bandwidth: 100mbps
+""")
+            f.close()
+            write.write("%s\n" % json.dumps(("reload",)))
+            answer = json.loads(read.readline())
+        finally:
+            shutil.rmtree(temp)
+        self.assertEqual(answer["status"], 0)
+        self.assertNotEqual(answer["value"], version)
+        self.assertEqual(json.loads(sread.readline()),
+                         {"event": "unbind", "seq": seq + 1,
+                          "client": "192.168.1.1"})
+        self.assertEqual(json.loads(sread.readline()),
+                         {"event": "catalogue", "seq": seq + 2,
+                          "version": answer["value"]})
+        write.write("%s\n" % json.dumps(("catalogue",)))
+        catalogue = json.loads(read.readline())["value"]
+        self.assertEqual(catalogue["version"], answer["value"])
+        self.assertEqual(catalogue["interfaces"]["eth1"]["qos"]["qos1"]["bandwidth"],
+                         "100mbps")
+        self.assertNotIn("netem", catalogue["interfaces"]["eth1"]["qos"]["qos1"])
+        write.write("%s\n" % json.dumps(("client", "192.168.1.2")))
+        self.assertEqual(json.loads(read.readline())["value"], ["eth1", "qos1"])
+        sub.close()
         sock.close()
 
     def test_stats(self):
@@ -339,6 +523,28 @@ qos:
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.connect(('127.0.0.1', 18861))
         read, write = sock.makefile('rb'), sock.makefile('wb', 0)
+        write.write("%s\n" % json.dumps(("bind_client", "192.168.1.1", "eth2", "qos3")))
+        self.assertEqual(json.loads(read.readline())["status"], 0)
+        write.write("%s\n" % json.dumps(("stats",)))
+        answer = json.loads(read.readline())
+        self.assertEqual(answer["value"],
+                         {"eth1": {"clients": 0, "details": {}},
+                          "eth2": {"clients": 1, "details": {"192.168.1.1": {}}}})
+        # Part of the stats
+        write.write("%s\n" % json.dumps(("stats", {"interface": "eth2",
+                                                   "details": False})))
+        answer = json.loads(read.readline())
+        self.assertEqual(answer["value"], {"eth2": {"clients": 1}})
+        write.write("%s\n" % json.dumps(("stats", {"client": "192.168.1.1",
+                                                   "top": 0})))
+        answer = json.loads(read.readline())
+        self.assertEqual(answer["value"],
+                         {"eth1": {"clients": 0, "details": {}},
+                          "eth2": {"clients": 1, "details": {"192.168.1.1": {}}}})
+        write.write("%s\n" % json.dumps(("stats", {"sort": "left"})))
+        answer = json.loads(read.readline())
+        self.assertEqual(answer["status"], -1)
+        sock.close()
 
     def tearDown(self):
         self.service.stop()
@@ -405,6 +611,127 @@ qos:
         self.assertEqual(self.router.clients["2001:db8::1"], ("eth1", "qos1"))
         self.assertEqual(self.router.clients["2001:db8::2"], ("eth1", "qos2"))
 
+    def test_persistency_hints(self):
+        """Test the use of persistency with hints"""
+        class Observer(object):
+            zope.interface.implements(IBinder, IHintsProvider)
+            def __init__(self):
+                self.received = {}
+            def notify(self, event, source, **kwargs):
+                if event == "bind":
+                    self.received[kwargs['client']] = kwargs['hints']
+            def hints(self, client):
+                return {'ticket': client.split(".")[-1]}
+        self.router.bind("192.168.1.15", "eth1", "qos1")
+        self.service.stop()
+        self.router = Router.load(self.config)
+        obs = Observer()
+        self.router.register(obs)
+        self.service = Service(dict(helper=dict(save=os.path.join(self.temp, "save.pickle"))),
+                               self.router)
+        self.router.bind("192.168.1.16", "eth1", "qos2")
+        self.service.stop()
+        self.router = Router.load(self.config)
+        obs = Observer()
+        self.router.register(obs)
+        self.service = Service(dict(helper=dict(save=os.path.join(self.temp, "save.pickle"))),
+                               self.router)
+        self.assertEqual(obs.received, {"192.168.1.15": {'ticket': '15'},
+                                        "192.168.1.16": {'ticket': '16'}})
+
+    def test_persistency_format(self):
+        """Check the format of the persistency file"""
+        self.router.bind("192.168.1.15", "eth1", "qos1")
+        self.router.bind("2001:db8::1", "eth1", "qos2")
+        self.router.unbind("192.168.1.15")
+        self.assertEqual(file(os.path.join(self.temp, "save.pickle")).read(),
+                         """# kitero bindings 1
++ 192.168.1.15 eth1 qos1
++ 2001:db8::1 eth1 qos2
+- 192.168.1.15
+""")
+        self.service.stop()
+        self.realSetup()
+        # The journal has been compacted
+        self.assertEqual(file(os.path.join(self.temp, "save.pickle")).read(),
+                         """# kitero bindings 1
++ 2001:db8::1 eth1 qos2
+""")
+
+    def test_persistency_compaction(self):
+        """Check that the journal is compacted"""
+        for i in range(100):
+            self.router.bind("192.168.1.15", "eth1", "qos1")
+            self.router.unbind("192.168.1.15")
+        self.router.bind("192.168.1.16", "eth1", "qos1")
+        self.assertLess(len(file(os.path.join(self.temp,
+                                              "save.pickle")).readlines()),
+                        110)
+
+    def test_persistency_batch(self):
+        """Record several bindings at once"""
+        self.router.bind("192.168.1.14", "eth1", "qos1")
+        self.router.bind_many([("192.168.1.15", "eth1", "qos1"),
+                               ("192.168.1.16", "eth1", "qos2")])
+        self.router.unbind_many(["192.168.1.15", "192.168.1.17"])
+        self.assertEqual(file(os.path.join(self.temp, "save.pickle")).read(),
+                         """# kitero bindings 1
++ 192.168.1.14 eth1 qos1
++ 192.168.1.15 eth1 qos1
++ 192.168.1.16 eth1 qos2
+- 192.168.1.15
+""")
+
+    def test_persistency_rebind(self):
+        """Record a change of QoS"""
+        self.router.bind("192.168.1.15", "eth1", "qos1")
+        self.router.rebind("192.168.1.15", "eth1", "qos2")
+        self.assertEqual(file(os.path.join(self.temp, "save.pickle")).read(),
+                         """# kitero bindings 1
++ 192.168.1.15 eth1 qos1
++ 192.168.1.15 eth1 qos2
+""")
+        self.service.stop()
+        self.realSetup()
+        self.assertEqual(self.router.clients["192.168.1.15"], ("eth1", "qos2"))
+
+    def test_persistency_invalid(self):
+        """Restore valid bindings only"""
+        self.service.stop()
+        file(os.path.join(self.temp, "save.pickle"), "w").write("""# kitero bindings 1
++ 192.168.1.15 eth1 qos1
++ 192.168.1.16 eth2 qos1
++ 192.168.1.17 eth1 qos3
++ 192.168.1.18 eth1 qos2
+""")
+        self.realSetup()
+        self.assertEqual(self.router.clients, {"192.168.1.15": ("eth1", "qos1"),
+                                               "192.168.1.18": ("eth1", "qos2")})
+
+    def test_legacy_persistency(self):
+        """Restore bindings saved in the previous format"""
+        self.service.stop()
+        pickle.dump({"192.168.1.15": ("eth1", "qos1"),
+                     "192.168.1.16": ("eth1", "qos2")},
+                    file(os.path.join(self.temp, "save.pickle"), "w"))
+        self.realSetup()
+        self.assertEqual(self.router.clients["192.168.1.15"], ("eth1", "qos1"))
+        self.assertEqual(self.router.clients["192.168.1.16"], ("eth1", "qos2"))
+        self.assertEqual(file(os.path.join(self.temp, "save.pickle")).readline(),
+                         "# kitero bindings 1\n")
+
+    def test_bogus_persistency(self):
+        """Restore bindings from a file with invalid records"""
+        self.service.stop()
+        file(os.path.join(self.temp, "save.pickle"), "w").write("""# kitero bindings 1
++ 192.168.1.15 eth1 qos1
+? 192.168.1.16 eth1 qos1
++ 192.168.1.17 eth1 qos2 {bogus
++ 192.168.1.18
+""")
+        self.realSetup()
+        self.assertEqual(self.router.clients, {"192.168.1.15": ("eth1", "qos1")})
+
     def test_partial_persistency(self):
         """Test the use of persistency when configuration has changed"""
         self.router.bind("192.168.1.15", "eth1", "qos1")
@@ -0,0 +1,85 @@
+try:
+    import unittest2 as unittest
+except ImportError: # pragma: no cover
+    import unittest
+
+from kitero.helper.stats import Rates, select
+
+def sample(**clients):
+    """Build statistics for eth1 with the given clients."""
+    details = {}
+    for client, (up, down) in clients.items():
+        details[client.replace("_", ".")] = dict(up=up, down=down)
+    return {'eth1': {'clients': len(details),
+                     'up': sum(c['up'] for c in details.values()),
+                     'down': sum(c['down'] for c in details.values()),
+                     'details': details},
+            'eth2': {'clients': 0, 'details': {}}}
+
+class TestRates(unittest.TestCase):
+
+    def test_rates(self):
+        """Compute rates of clients"""
+        r = Rates()
+        self.assertEqual(r.update(sample(c1=(0, 0), c2=(0, 0)), 10), {})
+        rates = r.update(sample(c1=(100, 1000), c2=(50, 40), c3=(5, 5)), 12)
+        self.assertEqual(rates['eth1'], {'c1': dict(up=50, down=500),
+                                         'c2': dict(up=25, down=20),
+                                         'c3': {}})
+        self.assertEqual(rates['eth2'], {})
+
+    def test_interval(self):
+        """Keep previous rates until enough time has passed"""
+        r = Rates(interval=5)
+        r.update(sample(c1=(0, 0)), 10)
+        self.assertEqual(r.update(sample(c1=(10, 10)), 12), {})
+        self.assertEqual(r.update(sample(c1=(60, 60)), 20)['eth1']['c1'],
+                         dict(up=6, down=6))
+        self.assertEqual(r.update(sample(c1=(70, 70)), 21)['eth1']['c1'],
+                         dict(up=6, down=6))
+
+class TestSelect(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = sample(c1=(100, 1000), c2=(200, 50), c3=(5, 5))
+        self.rates = {'eth1': {'c1': dict(up=1, down=30),
+                               'c2': dict(up=20, down=3),
+                               'c3': dict(up=2, down=1)}}
+
+    def test_all(self):
+        """Select everything"""
+        self.assertEqual(select(self.stats), self.stats)
+
+    def test_interface(self):
+        """Select one interface"""
+        self.assertEqual(select(self.stats, interface="eth2"),
+                         {'eth2': {'clients': 0, 'details': {}}})
+        self.assertEqual(select(self.stats, interface="eth3"), {})
+
+    def test_details(self):
+        """Select totals only"""
+        result = select(self.stats, details=False)
+        self.assertEqual(result['eth1'], {'clients': 3, 'up': 305, 'down': 1055})
+
+    def test_client(self):
+        """Select one client"""
+        result = select(self.stats, client="c2")
+        self.assertEqual(result['eth1']['details'], {'c2': dict(up=200, down=50)})
+        self.assertEqual(result['eth1']['clients'], 3)
+        self.assertEqual(result['eth2']['details'], {})
+
+    def test_top(self):
+        """Select clients with the highest rates"""
+        result = select(self.stats, self.rates, top=2)
+        self.assertEqual(sorted(result['eth1']['details']), ['c1', 'c2'])
+        result = select(self.stats, self.rates, top=1, sort="up")
+        self.assertEqual(sorted(result['eth1']['details']), ['c2'])
+        result = select(self.stats, self.rates, top=1, client="c3")
+        self.assertEqual(sorted(result['eth1']['details']), ['c1', 'c3'])
+        result = select(self.stats, top=1)
+        self.assertEqual(len(result['eth1']['details']), 1)
+
+    def test_invalid(self):
+        """Reject invalid queries"""
+        self.assertRaises(ValueError, select, self.stats, sort="left")
+        self.assertRaises(ValueError, select, self.stats, top=-1)
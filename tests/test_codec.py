@@ -0,0 +1,49 @@
+try:
+    import unittest2 as unittest
+except ImportError: # pragma: no cover
+    import unittest
+
+import struct
+
+from kitero import codec
+
+class TestCodec(unittest.TestCase):
+    value = {"eth1": {"clients": 2,
+                      "details": {"192.168.1.1": {"up": 45, "down": 78},
+                                  "2001:db8::1": {}}},
+             "eth2": [u"Hi\n\nBye", None, True, 1.5]}
+
+    def roundtrip(self, name):
+        c = codec.get(name)
+        encoded = c.dumps(self.value)
+        self.assertEqual(c.loads(encoded), self.value)
+        self.assertTrue(c.ismap(encoded))
+        self.assertFalse(c.ismap(c.dumps(["ping"])))
+        return c, encoded
+
+    def test_json(self):
+        """Encode and decode compact JSON"""
+        c, encoded = self.roundtrip("json")
+        self.assertNotIn("\n", encoded)
+        self.assertNotIn(", ", encoded)
+        self.assertEqual(c.frame(encoded), "%s\n" % encoded)
+
+    def test_fastjson(self):
+        """Encode and decode with a fast JSON library"""
+        if "fastjson" not in codec.codecs:
+            self.skipTest("no fast JSON library available")
+        c, encoded = self.roundtrip("fastjson")
+        self.assertNotIn("\n", encoded)
+
+    def test_msgpack(self):
+        """Encode and decode with MessagePack"""
+        if "msgpack" not in codec.codecs:
+            self.skipTest("msgpack not available")
+        c, encoded = self.roundtrip("msgpack")
+        self.assertEqual(c.frame(encoded),
+                         struct.pack("!I", len(encoded)) + encoded)
+
+    def test_unknown(self):
+        """Request an unknown codec"""
+        with self.assertRaises(ValueError):
+            codec.get("xml")
@@ -0,0 +1,50 @@
+try:
+    import unittest2 as unittest
+except ImportError: # pragma: no cover
+    import unittest
+
+from kitero.expiry import Expiry
+
+class TestExpiry(unittest.TestCase):
+
+    def test_expire(self):
+        """Expire clients in order of their deadline"""
+        e = Expiry()
+        self.assertEqual(e.next(), None)
+        e.refresh("c1", 10)
+        e.refresh("c2", 5)
+        e.refresh("c3", 20)
+        self.assertEqual(len(e), 3)
+        self.assertEqual(e.next(), 5)
+        self.assertEqual(e.expire(4), [])
+        self.assertEqual(e.expire(10), ["c2", "c1"])
+        self.assertEqual(len(e), 1)
+        self.assertNotIn("c1", e)
+        self.assertIn("c3", e)
+
+    def test_refresh(self):
+        """Only the last deadline of a client counts"""
+        e = Expiry()
+        e.refresh("c1", 10)
+        e.refresh("c2", 11)
+        e.refresh("c1", 30)
+        self.assertEqual(e.expire(20), ["c2"])
+        self.assertEqual(e.expire(30), ["c1"])
+        self.assertEqual(e.expire(100), [])
+
+    def test_remove(self):
+        """Forget a client"""
+        e = Expiry()
+        e.refresh("c1", 10)
+        e.remove("c1")
+        e.remove("c2")
+        self.assertEqual(e.expire(20), [])
+
+    def test_compaction(self):
+        """Outdated entries are dropped from the heap"""
+        e = Expiry()
+        for i in range(1000):
+            e.refresh("c%d" % (i % 10), i)
+        self.assertLessEqual(len(e.heap), 2 * 10 + 64)
+        self.assertEqual(sorted(e.expire(1000)), ["c%d" % i for i in range(10)])
+        self.assertEqual(e.heap, [])
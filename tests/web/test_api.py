@@ -9,13 +9,17 @@ import json
 import time
 import base64
 
-from kitero.web import app
+from kitero.web import app, api
 from kitero.web.rpc import RPCClient
+from kitero.web.replica import replica, Replica
 from kitero.web.serve import configure
 from kitero.helper.router import Router
-from kitero.helper.serve import Service
+from kitero.helper.serve import Service, RouterRPCService
 
 class TestApi(unittest.TestCase):
+    helper = {}
+    web = dict(expire=2)
+
     def setUp(self):
         r = Router.load(yaml.load("""
 clients: eth0
@@ -44,14 +48,19 @@ qos:
     bandwidth: 10mbps
     netem: delay 200ms 10ms
 """))
-        self.service = Service({}, r) # helper
-        configure(app, dict(web=dict(expire=2)))
+        self.service = Service(dict(helper=self.helper), r) # helper
+        configure(app, dict(web=self.web))
         self.app = app.test_client() # web
         time.sleep(0.1)
 
     def tearDown(self):
+        api.ping.stop()
+        replica.stop()
         RPCClient.clean()
         self.service.stop()
+        api.samples.reset()
+        api.scoped.invalidate()
+        api.catalogue.reset()
 
 class TestApiIPv4(TestApi):
 
@@ -96,6 +105,32 @@ class TestApiIPv4(TestApi):
                                    'name': 'LAN',
                                    'description': 'My first interface'}})
 
+    def test_interfaces_etag(self):
+        """Revalidate the list of interfaces with its entity tag."""
+        rv = self.app.get("/api/1.0/interfaces")
+        self.assertEqual(rv.status_code, 200)
+        etag = rv.headers['ETag']
+        self.assertTrue(etag.startswith('W/"'))
+        self.assertEqual(rv.headers['Cache-Control'], 'no-cache')
+        calls = RPCClient.metrics()['calls']
+        rv = self.app.get("/api/1.0/interfaces",
+                          headers={"If-None-Match": etag})
+        self.assertEqual(rv.status_code, 304)
+        self.assertEqual(rv.data, "")
+        self.assertEqual(rv.headers['ETag'], etag)
+        rv = self.app.get("/api/1.0/interfaces",
+                          headers={"If-None-Match": 'W/"1234"'})
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(len(json.loads(rv.data)['value']), 2)
+        self.assertEqual(RPCClient.metrics()['calls'], calls)
+        # Revalidation against the helper
+        api.catalogue.checked -= api.catalogue.interval
+        rv = self.app.get("/api/1.0/interfaces",
+                          headers={"If-None-Match": etag})
+        self.assertEqual(rv.status_code, 304)
+        self.assertEqual(RPCClient.metrics()['calls'],
+                         replica.ready and calls or calls + 1)
+
     def test_bind(self):
         """Try to bind some clients."""
         # First client
@@ -245,7 +280,7 @@ class TestApiIPv4(TestApi):
         self.assertEqual(result['value'], dict(ip='192.168.1.16',
                                                interface='eth1',
                                                qos='qos1'))
-        time.sleep(2.5)
+        time.sleep(3.5)         # Heartbeats may be delayed by one second
         # Expired
         rv = self.app.get("/api/1.0/current",
                           environ_overrides={"REMOTE_ADDR": "192.168.1.16"})
@@ -270,6 +305,58 @@ class TestApiIPv4(TestApi):
                                                interface='eth1',
                                                qos='qos1'))
 
+    def test_heartbeats_failure(self):
+        """Keep heartbeats pending when the current status cannot be retrieved"""
+        if self.web.get('replica'):
+            self.skipTest("status taken from the replica")
+        api.ping.refresh("192.168.1.16")
+        def batch(*calls):
+            raise IOError("helper unreachable")
+        self.patch = RPCClient.__dict__['batch']
+        RPCClient.batch = staticmethod(batch)
+        try:
+            rv = self.app.get("/api/1.0/current",
+                              environ_overrides={"REMOTE_ADDR": "192.168.1.15"})
+            self.assertEqual(rv.status_code, 500)
+        finally:
+            RPCClient.batch = self.patch
+        self.assertEqual(sorted(api.ping.heartbeats()),
+                         [("heartbeat", "192.168.1.15", 2),
+                          ("heartbeat", "192.168.1.16", 2)])
+
+    def test_heartbeats(self):
+        """Send heartbeats to the helper"""
+        for client in ("192.168.1.15", "192.168.1.16"):
+            rv = self.app.put("/api/1.0/bind/eth1/qos1",
+                              environ_overrides={"REMOTE_ADDR": client})
+            self.assertEqual(rv.status_code, 200)
+        api.ping.flush()
+        liveness = RouterRPCService.liveness
+        for client in ("192.168.1.15", "192.168.1.16"):
+            self.assertLess(liveness.expiry.deadlines[client], time.time() + 3)
+        api.ping.refresh("192.168.1.15")
+        self.assertEqual(api.ping.heartbeats(),
+                         [("heartbeat", "192.168.1.15", 2)])
+        self.assertEqual(api.ping.heartbeats(), [])
+        self.assertEqual(sorted(liveness.expire(time.time() + 10)),
+                         ["192.168.1.15", "192.168.1.16"])
+        time.sleep(0.1)         # Let the replica catch up
+        rv = self.app.get("/api/1.0/current",
+                          environ_overrides={"REMOTE_ADDR": "192.168.1.15"})
+        self.assertEqual(json.loads(rv.data)['value'], dict(ip='192.168.1.15'))
+
+    def test_pretty(self):
+        """Pretty print answers only on request"""
+        rv = self.app.get("/api/1.0/stats")
+        self.assertEqual(rv.data.count("\n"), 1)
+        self.assertEqual(rv.data[:10], '{"status":')
+        rv = self.app.get("/api/1.0/interfaces?pretty")
+        self.assertGreater(rv.data.count("\n"), 1)
+        self.assertEqual(sorted(json.loads(rv.data)['value']),
+                         ['eth1', 'eth2'])
+        rv = self.app.get("/api/1.0/current?pretty")
+        self.assertGreater(rv.data.count("\n"), 1)
+
     def test_stats(self):
         """Test statistics"""
         rv = self.app.get("/api/1.0/stats")
@@ -290,8 +377,8 @@ class TestApiIPv4(TestApi):
                          {'eth1': {'clients': 0, 'details': {}},
                           'eth2': {'clients': 0, 'details': {}}})
         self.assertEqual(result['time'], when)
-        # Wait a bit
-        time.sleep(2)
+        # Wait a bit, but not enough for the client to expire
+        time.sleep(1.5)
         rv = self.app.get("/api/1.0/stats")
         self.assertEqual(rv.status_code, 200)
         result = json.loads(rv.data)
@@ -300,6 +387,87 @@ class TestApiIPv4(TestApi):
                                    'details': {'192.168.1.16': {}}},
                           'eth2': {'clients': 0, 'details': {}}})
 
+    def test_stats_etag(self):
+        """Revalidate statistics with their sequence number"""
+        rv = self.app.get("/api/1.0/stats")
+        self.assertEqual(rv.status_code, 200)
+        etag = rv.headers['ETag']
+        rv = self.app.get("/api/1.0/stats", headers={"If-None-Match": etag})
+        self.assertEqual(rv.status_code, 304)
+        self.assertEqual(rv.data, "")
+
+    def test_stats_delta(self):
+        """Only get statistics that changed"""
+        rv = self.app.get("/api/1.0/stats?since=")
+        self.assertEqual(rv.status_code, 200)
+        result = json.loads(rv.data)['value']
+        self.assertEqual(result['since'], None)
+        self.assertEqual(result['stats'],
+                         {'eth1': {'clients': 0, 'details': {}},
+                          'eth2': {'clients': 0, 'details': {}}})
+        seq = result['seq']
+        self.assertEqual(rv.headers['ETag'], 'W/"%d"' % seq)
+        # Nothing changed
+        rv = self.app.get("/api/1.0/stats?since=%d" % seq)
+        result = json.loads(rv.data)['value']
+        self.assertEqual(result, dict(seq=seq, since=seq, stats={}))
+        # Bind a client
+        rv = self.app.put("/api/1.0/bind/eth1/qos1",
+                          environ_overrides={"REMOTE_ADDR": "192.168.1.16"})
+        self.assertEqual(rv.status_code, 200)
+        time.sleep(1.1)
+        rv = self.app.get("/api/1.0/stats?since=%d" % seq)
+        result = json.loads(rv.data)['value']
+        self.assertEqual(result['since'], seq)
+        self.assertGreater(result['seq'], seq)
+        self.assertEqual(result['stats'],
+                         {'eth1': {'clients': 1,
+                                   'details': {'192.168.1.16': {}}}})
+        # Unknown sample
+        rv = self.app.get("/api/1.0/stats?since=%d" % (seq - 1))
+        result = json.loads(rv.data)['value']
+        self.assertEqual(result['since'], None)
+        self.assertEqual(result['stats']['eth1']['clients'], 1)
+
+    def test_stats_scope(self):
+        """Only get a part of the statistics"""
+        rv = self.app.put("/api/1.0/bind/eth1/qos1",
+                          environ_overrides={"REMOTE_ADDR": "192.168.1.16"})
+        self.assertEqual(rv.status_code, 200)
+        rv = self.app.get("/api/1.0/stats?interface=eth1&details=false")
+        self.assertEqual(rv.status_code, 200)
+        self.assertNotIn('ETag', rv.headers)
+        self.assertEqual(json.loads(rv.data)['value'], {'eth1': {'clients': 1}})
+        rv = self.app.get("/api/1.0/stats?client",
+                          environ_overrides={"REMOTE_ADDR": "192.168.1.16"})
+        self.assertEqual(json.loads(rv.data)['value'],
+                         {'eth1': {'clients': 1,
+                                   'details': {'192.168.1.16': {}}},
+                          'eth2': {'clients': 0, 'details': {}}})
+        rv = self.app.get("/api/1.0/stats?client=192.168.1.17&top=5&sort=up")
+        self.assertEqual(json.loads(rv.data)['value']['eth1']['details'],
+                         {'192.168.1.16': {}})
+        for query in ("top=-1", "top=many", "sort=left"):
+            rv = self.app.get("/api/1.0/stats?%s" % query)
+            self.assertEqual(rv.status_code, 400)
+
+    def test_diff(self):
+        """Compute changes between two samples"""
+        old = {'eth1': {'clients': 2, 'up': 10, 'down': 100,
+                        'details': {'192.168.1.1': {'up': 4, 'down': 50},
+                                    '192.168.1.2': {'up': 6, 'down': 50}}},
+               'eth2': {'clients': 0, 'details': {}}}
+        new = {'eth1': {'clients': 2, 'up': 12, 'down': 100,
+                        'details': {'192.168.1.1': {'up': 6, 'down': 50},
+                                    '192.168.1.3': {'up': 0, 'down': 0}}},
+               'eth2': {'clients': 0, 'details': {}}}
+        self.assertEqual(api.diff(old, new),
+                         {'eth1': {'up': 12,
+                                   'details': {'192.168.1.1': {'up': 6},
+                                               '192.168.1.2': None,
+                                               '192.168.1.3': {'up': 0,
+                                                               'down': 0}}}})
+        self.assertEqual(api.diff(new, new), {})
 
 class TestApiIPv6(TestApi):
 
@@ -386,3 +554,78 @@ class TestApiIPv6(TestApi):
                          {'eth1': {'clients': 1,
                                    'details': {'2001:db8::1': {}}},
                           'eth2': {'clients': 0, 'details': {}}})
+
+class TestReplica(unittest.TestCase):
+
+    def setUp(self):
+        self.replica = Replica()
+        self.replica.load(dict(seq=10, clients={}, stats={}))
+
+    def test_stale_update(self):
+        """Ignore local updates older than applied events"""
+        r = self.replica
+        r.event(dict(event="bind", seq=11, client="192.168.1.15",
+                     interface="eth1", qos="qos1"))
+        r.event(dict(event="unbind", seq=12, client="192.168.1.15"))
+        r.update("192.168.1.15", ("eth1", "qos1"), 11)
+        self.assertEqual(r.client("192.168.1.15"), None)
+
+    def test_update_ahead(self):
+        """Ignore pushed events older than local updates"""
+        r = self.replica
+        r.update("192.168.1.15", ("eth2", "qos1"), 14)
+        self.assertEqual(r.client("192.168.1.15"), ("eth2", "qos1"))
+        r.event(dict(event="bind", seq=13, client="192.168.1.15",
+                     interface="eth1", qos="qos1"))
+        self.assertEqual(r.client("192.168.1.15"), ("eth2", "qos1"))
+        r.event(dict(event="bind", seq=14, client="192.168.1.15",
+                     interface="eth2", qos="qos1"))
+        r.event(dict(event="unbind", seq=15, client="192.168.1.15"))
+        self.assertEqual(r.client("192.168.1.15"), None)
+        self.assertEqual(r.ahead, {})
+
+class TestApiReplica(TestApiIPv4):
+    helper = dict(sample=0.5)
+    web = dict(expire=2, replica=True)
+
+    def setUp(self):
+        TestApiIPv4.setUp(self)
+        replica.start()
+        for i in range(50):
+            if replica.ready:
+                break
+            time.sleep(0.02)
+        self.assertTrue(replica.ready)
+
+    def test_replica(self):
+        """Answer from the replica"""
+        rv = self.app.put("/api/1.0/bind/eth1/qos1",
+                          environ_overrides={"REMOTE_ADDR": "192.168.1.16"})
+        self.assertEqual(rv.status_code, 200)
+        calls = RPCClient.metrics()['calls']
+        rv = self.app.get("/api/1.0/current",
+                          environ_overrides={"REMOTE_ADDR": "192.168.1.16"})
+        self.assertEqual(json.loads(rv.data)['value'],
+                         dict(ip='192.168.1.16', interface='eth1', qos='qos1'))
+        rv = self.app.get("/api/1.0/stats")
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(RPCClient.metrics()['calls'], calls)
+        # Changes made by another process are pushed
+        with RouterRPCService.router_lock:
+            RouterRPCService.router.bind("192.168.1.17", "eth2", "qos1", "1234")
+        time.sleep(0.1)
+        self.assertEqual(replica.client("192.168.1.17"), ("eth2", "qos1"))
+        # Stats are pushed periodically
+        time.sleep(0.6)
+        self.assertEqual(json.loads(replica.stats)['eth2']['clients'], 1)
+        # New catalogue after a reload
+        with RouterRPCService.router_lock:
+            self.service.publisher.publish("catalogue", version="1234")
+        time.sleep(0.1)
+        self.assertEqual(replica.catalogue, "1234")
+        # Helper is restarted
+        self.service.stop()
+        time.sleep(0.1)
+        self.assertFalse(replica.ready)
+        self.setUp()
+        self.assertEqual(replica.client("192.168.1.16"), None)
@@ -0,0 +1,106 @@
+try:
+    import unittest2 as unittest
+except ImportError: # pragma: no cover
+    import unittest
+
+import time
+import threading
+
+from kitero.web.decorators import cache
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+
+    def test_arguments(self):
+        """Cache values for each set of arguments"""
+        @cache(10)
+        def double(x):
+            """Double a number."""
+            self.calls.append(x)
+            return x * 2
+        self.assertEqual(double.__name__, "double")
+        self.assertEqual(double.__doc__, "Double a number.")
+        self.assertEqual(double(1), 2)
+        self.assertEqual(double(2), 4)
+        self.assertEqual(double(1), 2)
+        self.assertEqual(double(x=1), 2)
+        self.assertEqual(self.calls, [1, 2, 1])
+        self.assertEqual(double.counters['hits'], 1)
+        self.assertEqual(double.counters['misses'], 3)
+        double.invalidate()
+        self.assertEqual(double(1), 2)
+        self.assertEqual(self.calls, [1, 2, 1, 1])
+
+    def test_timeout(self):
+        """Compute values again when they expire"""
+        @cache(0.1)
+        def value():
+            self.calls.append(None)
+            return len(self.calls)
+        self.assertEqual(value(), 1)
+        self.assertEqual(value(), 1)
+        time.sleep(0.2)
+        self.assertEqual(value(), 2)
+
+    def test_size(self):
+        """Evict least recently used values"""
+        @cache(10, size=2)
+        def identity(x):
+            self.calls.append(x)
+            return x
+        identity(1), identity(2), identity(1), identity(3)
+        self.assertEqual(identity.counters['evictions'], 1)
+        identity(1), identity(3)
+        self.assertEqual(self.calls, [1, 2, 3])
+        identity(2)
+        self.assertEqual(self.calls, [1, 2, 3, 2])
+
+    def test_errors(self):
+        """Do not cache errors"""
+        @cache(10)
+        def fail():
+            self.calls.append(None)
+            raise ValueError("nope")
+        self.assertRaises(ValueError, fail)
+        self.assertRaises(ValueError, fail)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_single_flight(self):
+        """Only compute one value at a time for the same arguments"""
+        @cache(10)
+        def slow():
+            self.calls.append(None)
+            time.sleep(0.2)
+            return len(self.calls)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(slow()))
+                   for i in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, [1] * 5)
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(slow.counters['waits'], 4)
+
+    def test_stale(self):
+        """Return the expired value while a new one is computed"""
+        @cache(0.1, stale=10)
+        def slow():
+            self.calls.append(None)
+            if len(self.calls) > 1:
+                time.sleep(0.3)
+            return len(self.calls)
+        self.assertEqual(slow(), 1)
+        time.sleep(0.2)
+        results = []
+        refresh = threading.Thread(target=lambda: results.append(slow()))
+        refresh.start()
+        time.sleep(0.1)
+        self.assertEqual(slow(), 1)
+        self.assertEqual(slow.counters['stale'], 1)
+        refresh.join()
+        self.assertEqual(results, [2])
+        self.assertEqual(slow(), 2)
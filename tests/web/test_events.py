@@ -0,0 +1,121 @@
+try:
+    import unittest2 as unittest
+except ImportError: # pragma: no cover
+    import unittest
+
+import json
+import time
+
+from kitero.web.events import Subscriber, broadcaster
+from kitero.web.replica import replica
+from kitero.web.rpc import RPCClient
+from tests.web.test_api import TestApi
+
+def parse(event):
+    """Decode a server-sent event."""
+    fields = dict(line.split(": ", 1) for line in event.strip().split("\n")
+                  if not line.startswith("retry:"))
+    return fields['event'], json.loads(fields['data'])
+
+class TestSubscriber(unittest.TestCase):
+
+    def test_bounded_queue(self):
+        """Drop oldest events when the queue is full"""
+        s = Subscriber("192.168.1.15", 2)
+        for i in range(5):
+            s.put(i)
+        self.assertEqual(s.dropped, 3)
+        self.assertEqual(s.get(0), 3)
+        self.assertEqual(s.get(0), 4)
+        self.assertEqual(s.get(0), None)
+
+class TestEvents(TestApi):
+
+    def tearDown(self):
+        broadcaster.stop()
+        TestApi.tearDown(self)
+
+    def stream(self, client):
+        rv = self.app.get("/api/1.0/events", buffered=False,
+                          environ_overrides={"REMOTE_ADDR": client})
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.mimetype, "text/event-stream")
+        return rv, iter(rv.response)
+
+    def test_status(self):
+        """Receive binding changes of the client"""
+        rv, stream = self.stream("192.168.1.15")
+        self.assertEqual(parse(next(stream)),
+                         ("status", dict(ip="192.168.1.15")))
+        self.app.put("/api/1.0/bind/eth1/qos1",
+                     environ_overrides={"REMOTE_ADDR": "192.168.1.15"})
+        self.app.put("/api/1.0/bind/eth1/qos1",
+                     environ_overrides={"REMOTE_ADDR": "192.168.1.16"})
+        self.assertEqual(parse(next(stream)),
+                         ("status", dict(ip="192.168.1.15",
+                                         interface="eth1", qos="qos1")))
+        self.app.put("/api/1.0/unbind",
+                     environ_overrides={"REMOTE_ADDR": "192.168.1.15"})
+        self.assertEqual(parse(next(stream)),
+                         ("status", dict(ip="192.168.1.15")))
+        rv.close()
+        self.assertEqual(broadcaster.subscribers, [])
+
+    def test_stats(self):
+        """Receive rates of each interface"""
+        rv1, stream1 = self.stream("192.168.1.15")
+        rv2, stream2 = self.stream("192.168.1.16")
+        next(stream1), next(stream2)
+        broadcaster.sample()
+        for stream in (stream1, stream2):
+            event, data = parse(next(stream))
+            self.assertEqual(event, "stats")
+            self.assertEqual(data['interfaces'],
+                             {'eth1': {'clients': 0, 'up': None, 'down': None},
+                              'eth2': {'clients': 0, 'up': None, 'down': None}})
+        # Same sample, no event
+        broadcaster.sample()
+        self.assertEqual(broadcaster.subscribers[0].get(0), None)
+        rv1.close()
+        rv2.close()
+
+    def test_keepalive(self):
+        """Send a comment when idle"""
+        self.patch = broadcaster.keepalive
+        broadcaster.keepalive = 0.1
+        try:
+            rv, stream = self.stream("192.168.1.15")
+            next(stream)
+            self.assertEqual(next(stream), ": keepalive\n\n")
+            rv.close()
+        finally:
+            broadcaster.keepalive = self.patch
+
+    def test_unreachable(self):
+        """Unsubscribe when the status cannot be retrieved"""
+        def call(*args, **kwargs):
+            raise IOError("helper unreachable")
+        self.patch = RPCClient.__dict__['call']
+        RPCClient.call = staticmethod(call)
+        replica.client = call
+        try:
+            rv = self.app.get("/api/1.0/events",
+                              environ_overrides={"REMOTE_ADDR": "192.168.1.15"})
+            self.assertEqual(rv.status_code, 500)
+        finally:
+            RPCClient.call = self.patch
+            del replica.client
+        self.assertEqual(broadcaster.subscribers, [])
+
+class TestEventsReplica(TestEvents):
+    helper = dict(sample=0.5)
+    web = dict(expire=2, replica=True)
+
+    def setUp(self):
+        TestEvents.setUp(self)
+        replica.start()
+        for i in range(50):
+            if replica.ready:
+                break
+            time.sleep(0.02)
+        self.assertTrue(replica.ready)
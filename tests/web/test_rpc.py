@@ -4,13 +4,18 @@ except ImportError: # pragma: no cover
     import unittest
 
 import threading
+import json
 import time
+import tempfile
+import shutil
+import os
 
 from kitero.web import app
 from kitero.web.serve import configure
 from kitero.web.rpc import RPCClient, RPCException
 from kitero.helper.router import Router
-from kitero.helper.serve import Service
+from kitero.helper.serve import Service, RouterRPCService
+from kitero import codec
 
 class TestRPCClient(unittest.TestCase):
     def setUp(self):
@@ -41,6 +46,84 @@ class TestRPCClient(unittest.TestCase):
             t.join()
         self.assertEqual(self.i, 9)
 
+    def test_pool(self):
+        """Concurrent calls share a bounded pool of connections"""
+        results = []
+        def work(i):
+            results.append(RPCClient.call("client", "192.168.1.%d" % i))
+        threads = [threading.Thread(target=work, args=(i,))
+                   for i in range(30)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, [None]*30)
+        metrics = RPCClient.metrics()
+        self.assertEqual(metrics['max'], 4)
+        self.assertTrue(1 <= metrics['size'] <= 4)
+        self.assertEqual(metrics['size'], metrics['connections'])
+        self.assertEqual(metrics['pending'], 0)
+        self.assertEqual(metrics['calls'], 30)
+
+    def test_health_check(self):
+        """Idle connections are checked before being used"""
+        RPCClient.call("interfaces")
+        self.assertEqual(RPCClient.metrics()['checks'], 0)
+        RPCClient.pool[0].last -= RPCClient.idle
+        RPCClient.call("interfaces")
+        self.assertEqual(RPCClient.metrics()['checks'], 1)
+        # Helper restarted: the connection is replaced
+        self.service.stop()
+        self.setUp()
+        RPCClient.call("interfaces")
+        self.assertEqual(RPCClient.metrics()['size'], 1)
+
+    def test_connect_unlocked(self):
+        """Connect without holding the lock of the pool"""
+        locked = []
+        connect = RPCClient.__dict__['connect']
+        def check(cls):
+            locked.append(RPCClient.lock.locked())
+            return connect.__get__(None, RPCClient)()
+        RPCClient.connect = classmethod(check)
+        try:
+            RPCClient.call("interfaces")
+        finally:
+            RPCClient.connect = connect
+        self.assertEqual(locked, [False])
+        self.assertEqual(RPCClient.metrics()['size'], 1)
+
+    def test_timeout(self):
+        """Fail calls without an answer in time"""
+        RPCClient.call("interfaces")
+        connection = RPCClient.pool[0]
+        timeout, app.config['TIMEOUT'] = app.config['TIMEOUT'], 0.2
+        try:
+            with RouterRPCService.router_lock: # Stall the helper
+                with self.assertRaises(IOError):
+                    RPCClient.call("client", "192.168.1.1")
+                self.assertEqual(connection.pending, {})
+            time.sleep(0.1)     # Late answer is ignored
+            self.assertEqual(RPCClient.call("client", "192.168.1.1"), None)
+        finally:
+            app.config['TIMEOUT'] = timeout
+        self.assertFalse(connection.closed)
+
+    def test_backoff(self):
+        """Do not try to reconnect immediately after a failure"""
+        self.tearDown()
+        with self.assertRaises(IOError):
+            RPCClient.call("interfaces")
+        failures = RPCClient.metrics()['failures']
+        self.assertEqual(RPCClient.metrics()['backoff'], 1)
+        self.service = Service({}, Router.load({'clients': 'eth0'}))
+        with self.assertRaises(IOError):
+            RPCClient.call("interfaces")
+        self.assertEqual(RPCClient.metrics()['failures'], failures)
+        RPCClient.retry = 0
+        RPCClient.call("interfaces")
+        self.assertEqual(RPCClient.metrics()['backoff'], 0)
+
     def test_reconnection(self):
         """Check if we can reconnect"""
         RPCClient.call("interfaces")
@@ -52,8 +135,57 @@ class TestRPCClient(unittest.TestCase):
             RPCClient.call("interfaces")
         self.setUp()
 
+    def test_batch(self):
+        """Request several attributes at once"""
+        interfaces, client = RPCClient.batch(("interfaces",),
+                                             ("client", "192.168.1.1"))
+        self.assertEqual(interfaces, RPCClient.call("interfaces"))
+        self.assertIsNone(client)
+        self.assertEqual(RPCClient.metrics()['calls'], 2)
+        with self.assertRaises(RPCException) as e:
+            RPCClient.batch(("interfaces",), ("unknown",))
+        self.assertEqual(e.exception.exception, "AttributeError")
+
+    def test_raw(self):
+        """Request an attribute encoded in JSON"""
+        value = RPCClient.raw("interfaces")
+        self.assertIsInstance(value, codec.RawJSON)
+        self.assertEqual(json.loads(value), RPCClient.call("interfaces"))
+        with self.assertRaises(RPCException):
+            RPCClient.raw("unknown")
+
+    def test_codecs(self):
+        """Use other codecs"""
+        for name in codec.codecs:
+            RPCClient.clean()
+            configure(app, dict(web=dict(codec=name)))
+            self.assertEqual(RPCClient.call("client", "192.168.1.1"), None)
+            self.assertEqual(RPCClient.pool[0].codec.name, name)
+            self.assertEqual(json.loads(RPCClient.raw("interfaces")),
+                             RPCClient.call("interfaces"))
+        configure(app)
+
     def test_exception(self):
         """Check that we get exceptions"""
         with self.assertRaises(RPCException) as e:
             RPCClient.call("unknown")
         str(e.exception)
+
+class TestUnixRPCClient(unittest.TestCase):
+    def setUp(self):
+        self.temp = tempfile.mkdtemp()
+        config = {'helper': {'socket': os.path.join(self.temp, "kitero.sock")}}
+        r = Router.load({'clients': 'eth0'})
+        self.service = Service(config, r)
+        configure(app, config)
+
+    def tearDown(self):
+        RPCClient.clean()
+        self.service.stop()
+        configure(app)
+        shutil.rmtree(self.temp)
+
+    def test_unix_socket(self):
+        """Request some attributes over a Unix socket"""
+        self.assertEqual(RPCClient.call("client", "192.168.1.1"), None)
+        self.assertEqual(RPCClient.metrics()['size'], 1)